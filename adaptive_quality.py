@@ -0,0 +1,116 @@
+import time
+
+from constants import Options
+from screen_share import ScreenShare
+from terminal import Terminal
+
+class AdaptiveQuality:
+    # Watches how long sending and encoding take and how many captured frames get dropped,
+    # and moves the stream's CRF, scale and frame rate within their Options bounds.
+    # A thin link gives up picture quality first, a slow CPU gives up pixels first,
+    # headroom brings back frame rate first, then pixels, then quality
+    def __init__(self, screen_share: ScreenShare) -> None:
+        self.screen_share = screen_share
+        self.crf = screen_share.crf
+        self.scale = screen_share.scale
+        self.frame_rate = screen_share.frame_rate
+
+        self.window_start = time.perf_counter()
+        self.bytes_sent = 0
+        self.send_time = 0.0
+        self.frames = 0
+        self.encode_time = screen_share.stage_times["encode"]
+        self.encode_count = screen_share.stage_counts["encode"]
+        ring = screen_share.frame_ring.stats()
+        self.captured = ring["captured"]
+        self.dropped = ring["dropped"]
+        self.good_intervals = 0
+        self.settling = False
+
+    def on_frame_sent(self, sent: int, send_time: float):
+        self.bytes_sent += sent
+        self.send_time += send_time
+        self.frames += 1
+
+        elapsed = time.perf_counter() - self.window_start
+        if elapsed >= Options.SCREEN_ADAPT_INTERVAL:
+            self.__evaluate(elapsed)
+
+    def __evaluate(self, elapsed: float):
+        screen_share = self.screen_share
+        encode_time = screen_share.stage_times["encode"] - self.encode_time
+        encode_count = screen_share.stage_counts["encode"] - self.encode_count
+        ring = screen_share.frame_ring.stats()
+        captured = ring["captured"] - self.captured
+        dropped = ring["dropped"] - self.dropped
+
+        send_busy = self.send_time / elapsed
+        throughput = self.bytes_sent / elapsed
+        encode_ms = encode_time * 1000 / encode_count if encode_count else 0.0
+        budget_ms = Options.SCREEN_ENCODE_BUDGET * 1000 / self.frame_rate
+        drop_ratio = dropped / captured if captured else 0.0
+        measured = f"{self.frames / elapsed:.1f} FPS, send busy {send_busy:.0%}, {throughput / 1024:.1f} KB/s, encode {encode_ms:.1f}/{budget_ms:.1f}ms, dropped {drop_ratio:.0%}, latency {ring['latency_avg'] * 1000:.1f}ms"
+
+        changed = None
+        if self.settling:
+            # A change restarts the encoder, the key frame it opens with would skew this interval
+            self.settling = False
+        elif send_busy > Options.SCREEN_SEND_BUSY_HIGH:
+            self.good_intervals = 0
+            changed = self.__step_down(("crf", "scale", "frame_rate"))
+            reason = "link can't keep up"
+        elif encode_ms > budget_ms or drop_ratio > Options.SCREEN_DROP_RATIO_HIGH:
+            self.good_intervals = 0
+            changed = self.__step_down(("scale", "frame_rate", "crf"))
+            reason = "encoder can't keep up"
+        elif send_busy < Options.SCREEN_SEND_BUSY_LOW and encode_ms < budget_ms / 2 and drop_ratio < Options.SCREEN_DROP_RATIO_HIGH / 3:
+            self.good_intervals += 1
+            if self.good_intervals >= Options.SCREEN_UPGRADE_INTERVALS:
+                self.good_intervals = 0
+                changed = self.__step_up(("frame_rate", "scale", "crf"))
+                reason = "headroom"
+        else:
+            self.good_intervals = 0
+
+        if changed is not None:
+            Terminal.debug(f"ScreenShare {reason} ({measured}): {changed}, now crf {self.crf}, scale {self.scale:.1f}, {self.frame_rate} FPS")
+            screen_share.reconfigure(self.crf, self.scale, self.frame_rate)
+            self.settling = True
+        else:
+            Terminal.verbose(f"ScreenShare quality kept ({measured})")
+
+        self.window_start = time.perf_counter()
+        self.bytes_sent = 0
+        self.send_time = 0.0
+        self.frames = 0
+        self.encode_time = screen_share.stage_times["encode"]
+        self.encode_count = screen_share.stage_counts["encode"]
+        self.captured = ring["captured"]
+        self.dropped = ring["dropped"]
+
+    def __step_down(self, order: tuple[str, ...]) -> str | None:
+        # Moves the first knob in order that isn't at its bound yet
+        for knob in order:
+            if knob == "crf" and self.crf < Options.SCREEN_CRF_BOUNDS[1]:
+                self.crf = min(Options.SCREEN_CRF_BOUNDS[1], self.crf + Options.SCREEN_CRF_STEP)
+                return "raised crf"
+            if knob == "scale" and self.scale > Options.SCREEN_SIZE_FACTOR_BOUNDS[0]:
+                self.scale = round(max(Options.SCREEN_SIZE_FACTOR_BOUNDS[0], self.scale - Options.SCREEN_SIZE_FACTOR_STEP), 2)
+                return "lowered scale"
+            if knob == "frame_rate" and self.frame_rate > Options.SCREEN_FRAME_RATE_BOUNDS[0]:
+                self.frame_rate = max(Options.SCREEN_FRAME_RATE_BOUNDS[0], self.frame_rate - Options.SCREEN_FRAME_RATE_STEP)
+                return "lowered frame rate"
+        return None
+
+    def __step_up(self, order: tuple[str, ...]) -> str | None:
+        for knob in order:
+            if knob == "crf" and self.crf > Options.SCREEN_CRF_BOUNDS[0]:
+                self.crf = max(Options.SCREEN_CRF_BOUNDS[0], self.crf - Options.SCREEN_CRF_STEP)
+                return "lowered crf"
+            if knob == "scale" and self.scale < Options.SCREEN_SIZE_FACTOR_BOUNDS[1]:
+                self.scale = round(min(Options.SCREEN_SIZE_FACTOR_BOUNDS[1], self.scale + Options.SCREEN_SIZE_FACTOR_STEP), 2)
+                return "raised scale"
+            if knob == "frame_rate" and self.frame_rate < Options.SCREEN_FRAME_RATE_BOUNDS[1]:
+                self.frame_rate = min(Options.SCREEN_FRAME_RATE_BOUNDS[1], self.frame_rate + Options.SCREEN_FRAME_RATE_STEP)
+                return "raised frame rate"
+        return None
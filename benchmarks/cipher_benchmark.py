@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import CipherSuite
+from encryption_manager import Encryption
+
+PAYLOAD_SIZES = [1024, 8 * 1024, 256 * 1024]
+TOTAL_BYTES = 32 * 1024 * 1024
+MAX_MESSAGES = 5000
+
+def run(suite: CipherSuite, size: int):
+    encryption = Encryption()
+    encryption.set_sym_key(os.urandom(32), suite)
+    payload = os.urandom(size)
+    count = max(1, min(TOTAL_BYTES // size, MAX_MESSAGES))
+
+    start = time.perf_counter()
+    messages = [b''.join(encryption.aes_net_encrypt_parts([payload])) for _ in range(count)]
+    encrypt_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in messages:
+        assert encryption.aes_net_decrypt(message) is not None
+    decrypt_elapsed = time.perf_counter() - start
+
+    mb = size * count / (1024 * 1024)
+    return mb / encrypt_elapsed, mb / decrypt_elapsed
+
+if __name__ == "__main__":
+    print(f"{'suite':>18} | {'size':>7} | {'encrypt MB/s':>12} | {'decrypt MB/s':>12}")
+    for suite in CipherSuite:
+        for size in PAYLOAD_SIZES:
+            encrypt_mbs, decrypt_mbs = run(suite, size)
+            print(f"{suite.name:>18} | {size:>7} | {encrypt_mbs:>12.1f} | {decrypt_mbs:>12.1f}")
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import pickle
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import CompressionCodec
+from compressor import MessageCompressor, available_codecs
+
+TOTAL_BYTES = 32 * 1024 * 1024
+
+def file_listing() -> bytes:
+    return pickle.dumps([f"C:\\Users\\user\\Documents\\project_{i // 100}\\file_{i}.txt" for i in range(5000)])
+
+def command_output() -> bytes:
+    lines = [f"{i:>6}  2024-01-{i % 28 + 1:02}  12:{i % 60:02}  {i * 37 % 100000:>9}  report_{i}.log" for i in range(4000)]
+    return "\r\n".join(lines).encode()
+
+def executable_like() -> bytes:
+    # Mostly repetitive structure with some noise, roughly what uncompressed binaries look like
+    return b"".join(bytes(64) + os.urandom(16) + b"\x48\x89\xe5\x48\x83\xec\x20" * 8 for _ in range(3000))
+
+def already_compressed() -> bytes:
+    return zlib.compress(os.urandom(256 * 1024), 9)
+
+def random_bytes() -> bytes:
+    return os.urandom(256 * 1024)
+
+PAYLOADS = {
+    "file listing": file_listing,
+    "command output": command_output,
+    "executable": executable_like,
+    "zip/png-like": already_compressed,
+    "random/h264": random_bytes,
+}
+
+def run(codec: CompressionCodec, payload: bytes):
+    compressor = MessageCompressor(codec)
+    count = max(1, TOTAL_BYTES // len(payload))
+
+    start = time.perf_counter()
+    messages = [b"".join(compressor.compress_parts([payload])) for _ in range(count)]
+    compress_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in messages:
+        assert compressor.decompress(message) == payload
+    decompress_elapsed = time.perf_counter() - start
+
+    mb = len(payload) * count / (1024 * 1024)
+    compressed = messages[0][:1] == MessageCompressor.COMPRESSED
+    return len(messages[0]) / len(payload), compressed, mb / compress_elapsed, mb / decompress_elapsed
+
+if __name__ == "__main__":
+    print(f"{'payload':>15} | {'codec':>5} | {'size':>8} | {'ratio':>6} | {'compressed':>10} | {'comp MB/s':>9} | {'decomp MB/s':>11}")
+    for name, make in PAYLOADS.items():
+        payload = make()
+        for codec in available_codecs():
+            ratio, compressed, comp, decomp = run(codec, payload)
+            print(f"{name:>15} | {codec.name:>5} | {len(payload):>8} | {ratio:>6.3f} | {str(compressed):>10} | {comp:>9.1f} | {decomp:>11.1f}")
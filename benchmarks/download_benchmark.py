@@ -0,0 +1,65 @@
+import os
+import sys
+import math
+import socket
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import CipherSuite, Events, Options
+from file_transfer import FileDownload
+from utils import Connection
+
+FILE_SIZES = [1024 * 1024, 16 * 1024 * 1024, 96 * 1024 * 1024]
+
+def legacy_download(conn: Connection, transaction_id: bytes, path: str, size: int):
+    chunks_num = math.ceil(size / Options.CHUNK_SIZE)
+    with open(path, 'rb') as f:
+        for i in range(chunks_num):
+            file_d = f.read(Options.CHUNK_SIZE)
+            if file_d:
+                conn.send_event(Events.FileChunkDownload_Response, [transaction_id, i+1, chunks_num, file_d])
+
+def new_download(conn: Connection, transaction_id: bytes, path: str, size: int):
+    FileDownload(conn, transaction_id, path, size).run()
+
+def receive(client: Connection, size: int):
+    recieved = 0
+    while recieved < size:
+        _, raw_parts = client.recieve_parts()
+        # raw_parts[1] is "tid\0index\0total\0data", the data is whatever follows the third separator
+        recieved += len(raw_parts[1].split(Options.SEPERATOR, 3)[3])
+
+def run(download, path: str, size: int) -> float:
+    a, b = socket.socketpair()
+    server, client = Connection(a, ("server", 0)), Connection(b, ("client", 0))
+    key = os.urandom(32)
+    server.encryption_manager.set_sym_key(key, CipherSuite.AES_GCM)
+    client.encryption_manager.set_sym_key(key, CipherSuite.AES_GCM)
+
+    t = threading.Thread(target=receive, args=(client, size))
+    t.start()
+    start = time.perf_counter()
+    download(server, b"TID", path, size)
+    t.join()
+    elapsed = time.perf_counter() - start
+
+    a.close()
+    b.close()
+    return size / elapsed / (1024 * 1024)
+
+if __name__ == "__main__":
+    Options.DEBUG_LEVEL = 0
+    print(f"{'file size':>10} | {'8 KB reads MB/s':>15} | {'engine MB/s':>11}")
+    for size in FILE_SIZES:
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(os.urandom(size))
+            path = f.name
+        try:
+            before = run(legacy_download, path, size)
+            after = run(new_download, path, size)
+            print(f"{size // (1024 * 1024):>7} MB | {before:>15.1f} | {after:>11.1f}")
+        finally:
+            os.unlink(path)
@@ -0,0 +1,66 @@
+import os
+import sys
+import socket
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+from constants import CipherSuite, Events, KeyExchange, Options
+from encryption_manager import Encryption, RSAKeyPool
+from utils import Connection
+
+HANDSHAKES = 32
+SUITES = bytes([suite.value for suite in Options.CIPHER_SUITES])
+
+def client_handshake(client: Connection):
+    sep_parts, raw_parts = client.recieve_parts(decrypt=False)
+    if sep_parts[0] == Events.EphemeralKeyTransfer_Action.value.encode():
+        private_k, public_k = client.encryption_manager.generate_ecdh_keys()
+        public_bytes = public_k.dump_bytes()
+        client.send_event(Events.EphemeralKeyTransfer_Action, [SUITES, public_bytes], encrypt=False)
+        secret = client.encryption_manager.ecdh_derive_secret(private_k, raw_parts[1], raw_parts[1] + public_bytes)
+    else:
+        secret = os.urandom(32)
+        encrypted = PKCS1_OAEP.new(RSA.import_key(raw_parts[1])).encrypt(secret)
+        client.send_event(Events.SecretTransferSuites_Action, [SUITES, encrypted], encrypt=False)
+
+    suite = CipherSuite(client.recieve_parts(decrypt=False)[0][1][0])
+    client.encryption_manager.set_sym_key(secret, suite)
+    assert client.recieve_parts()[0][0] == Events.OperationSuccess_Response.value.encode()
+
+def run(key_exchange: KeyExchange, pool_size: int) -> float:
+    Options.KEY_EXCHANGE = key_exchange
+    Encryption.key_pool = RSAKeyPool(pool_size)
+    if key_exchange == KeyExchange.RSA and pool_size > 0:
+        Encryption.key_pool.start()
+        while Encryption.key_pool.keys.qsize() < pool_size:
+            time.sleep(0.05)
+
+    start = time.perf_counter()
+    for _ in range(HANDSHAKES):
+        a, b = socket.socketpair()
+        server, client = Connection(a, ("server", 0)), Connection(b, ("client", 0))
+        t = threading.Thread(target=client_handshake, args=(client, ))
+        t.start()
+        server.initiate_key_switch()
+        t.join()
+        a.close()
+        b.close()
+
+    return HANDSHAKES / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    Options.DEBUG_LEVEL = 0
+    results = [
+        ("RSA, no pool", run(KeyExchange.RSA, 0)),
+        (f"RSA, warm pool of {HANDSHAKES}", run(KeyExchange.RSA, HANDSHAKES)),
+        ("ECDH " + Options.ECDH_CURVE, run(KeyExchange.ECDH, 0)),
+    ]
+
+    print(f"{'mode':>24} | {'handshakes/s':>12}")
+    for name, rate in results:
+        print(f"{name:>24} | {rate:>12.1f}")
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture_sources import SyntheticSource
+from image_diff import decode_image_diff, encode_image_diff
+
+RESOLUTIONS = [(1280, 720), (1920, 1080)]
+FRAMES = 30
+LEGACY_RESOLUTION = (320, 180) # The per pixel loop takes seconds on anything bigger
+
+def legacy_encode_image_diff(prev_img, img, diff=True):
+    if diff == False:
+        diff_bytes = bytearray()
+        for y in range(img.shape[0]):
+            for x in range(img.shape[1]):
+                color = img[y, x]
+                diff_bytes.extend(int(x).to_bytes(2, 'big'))
+                diff_bytes.extend(int(y).to_bytes(2, 'big'))
+                diff_bytes.extend(color)
+        return bytes(diff_bytes)
+
+    diff = cv2.absdiff(prev_img, img)
+    changed_pixels = np.argwhere(diff > 0)
+
+    diff_bytes = bytearray()
+    for x, y, _ in changed_pixels:
+        if 0 <= x < img.shape[1] and 0 <= y < img.shape[0]:
+            color = img[y, x]
+            diff_bytes.extend(int(x).to_bytes(2, 'big'))
+            diff_bytes.extend(int(y).to_bytes(2, 'big'))
+            diff_bytes.extend(color)
+
+    return bytes(diff_bytes)
+
+def frames(pattern: str, width: int, height: int, count: int) -> list[np.ndarray]:
+    source = SyntheticSource(width, height, pattern)
+    return [cv2.cvtColor(source.grab(), cv2.COLOR_BGRA2BGR) for _ in range(count)]
+
+def run(pattern: str, width: int, height: int):
+    # Also a round trip check, every decoded frame has to match the original exactly
+    images = frames(pattern, width, height, FRAMES + 1)
+    encode_elapsed = decode_elapsed = 0.0
+    total = 0
+    decoded = None
+    for i, img in enumerate(images):
+        prev = images[i - 1] if i else None
+
+        start = time.perf_counter()
+        data = encode_image_diff(prev, img)
+        encode_elapsed += time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = decode_image_diff(decoded, data)
+        decode_elapsed += time.perf_counter() - start
+
+        assert np.array_equal(decoded, img), f"{pattern} frame {i} didn't survive the round trip"
+        if i: total += len(data)
+    return encode_elapsed * 1000 / len(images), decode_elapsed * 1000 / len(images), total / FRAMES
+
+def run_legacy(pattern: str):
+    prev, img = frames(pattern, *LEGACY_RESOLUTION, 2)
+    start = time.perf_counter()
+    data = legacy_encode_image_diff(prev, img)
+    return (time.perf_counter() - start) * 1000, len(data)
+
+if __name__ == "__main__":
+    print(f"{'pattern':>9} | {'size':>9} | {'encode ms':>9} | {'decode ms':>9} | {'KB/frame':>9} | {'raw KB':>9}")
+    for width, height in RESOLUTIONS:
+        for pattern in SyntheticSource.PATTERNS:
+            encode_ms, decode_ms, size = run(pattern, width, height)
+            print(f"{pattern:>9} | {f'{width}x{height}':>9} | {encode_ms:>9.2f} | {decode_ms:>9.2f} | {size / 1024:>9.1f} | {width * height * 3 / 1024:>9.1f}")
+
+    width, height = LEGACY_RESOLUTION
+    print(f"\nPer pixel loop at {width}x{height}")
+    print(f"{'pattern':>9} | {'old ms':>9} | {'old KB':>9} | {'new ms':>9} | {'new KB':>9}")
+    for pattern in SyntheticSource.PATTERNS:
+        legacy_ms, legacy_size = run_legacy(pattern)
+        encode_ms, _, size = run(pattern, width, height)
+        print(f"{pattern:>9} | {legacy_ms:>9.1f} | {legacy_size / 1024:>9.1f} | {encode_ms:>9.2f} | {size / 1024:>9.1f}")
@@ -0,0 +1,71 @@
+import os
+import sys
+import socket
+import struct
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import Options
+from utils import FrameReader
+
+FRAME_SIZES = [64, 1024, Options.CHUNK_SIZE, 64 * 1024, 200 * 1024]
+TOTAL_BYTES = 64 * 1024 * 1024
+LEGACY_TOTAL_BYTES = 2 * 1024 * 1024
+
+def legacy_read_frame(s: socket.socket):
+    size_bytes = b""
+    for _ in range(Options.SIZE_OF_SIZE):
+        b = s.recv(1)
+        if b == b"": return None
+        size_bytes += b
+
+    size = struct.unpack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, size_bytes)[0]
+
+    data_bytes = b""
+    for _ in range(size):
+        b = s.recv(1)
+        if b == b"": return None
+        data_bytes += b
+
+    return data_bytes
+
+def loopback_pair():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, _ = server.accept()
+    server.close()
+    return client, conn
+
+def run(frame_size: int, count: int, legacy: bool) -> float:
+    sender, reciever = loopback_pair()
+    frame = struct.pack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, frame_size) + os.urandom(frame_size)
+
+    def send():
+        for _ in range(count):
+            sender.sendall(frame)
+
+    t = threading.Thread(target=send, daemon=True)
+    reader = FrameReader(reciever)
+
+    start = time.perf_counter()
+    t.start()
+    for _ in range(count):
+        data = legacy_read_frame(reciever) if legacy else reader.read_frame()
+        assert data is not None and len(data) == frame_size
+    elapsed = time.perf_counter() - start
+
+    t.join()
+    sender.close()
+    reciever.close()
+    return frame_size * count / elapsed / (1024 * 1024)
+
+if __name__ == "__main__":
+    print(f"{'frame size':>12} | {'recv(1) MB/s':>14} | {'recv_into MB/s':>14} | {'speedup':>8}")
+    for frame_size in FRAME_SIZES:
+        before = run(frame_size, max(1, LEGACY_TOTAL_BYTES // frame_size), legacy=True)
+        after = run(frame_size, max(1, TOTAL_BYTES // frame_size), legacy=False)
+        print(f"{frame_size:>12} | {before:>14.2f} | {after:>14.2f} | {after / before:>7.1f}x")
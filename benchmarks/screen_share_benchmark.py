@@ -0,0 +1,62 @@
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture_sources import CaptureSource, MssSource, RecordedSource, SyntheticSource
+from screen_share import STAGES, ScreenShare
+
+# Usage: screen_share_benchmark.py [recording.npy ...] [--mss]
+# Synthetic sources always run, recordings (see RecordedSource.record) and the live screen only when given
+RESOLUTIONS = [(1280, 720), (1920, 1080), (2560, 1440)]
+SCALES = [1.0, 0.9, 0.5]
+FRAMES = 120
+WARMUP_FRAMES = 10
+MAX_SECONDS = 5 # A source that stops changing never fills FRAMES
+
+def run(source: CaptureSource, scale: float):
+    # Capture isn't paced so the numbers show what the pipeline itself can do
+    with ScreenShare(source, scale=scale, paced=False) as screen_share:
+        for _ in range(WARMUP_FRAMES):
+            screen_share.get_frame()
+        bytes_before = screen_share.bytes_encoded
+        dropped_before = screen_share.frame_ring.stats()["dropped"]
+        skipped_before = screen_share.frames_skipped
+        for stage in STAGES:
+            screen_share.stage_times[stage] = 0.0
+            screen_share.stage_counts[stage] = 0
+
+        start = time.perf_counter()
+        frames = 0
+        while frames < FRAMES and time.perf_counter() - start < MAX_SECONDS:
+            if screen_share.get_frame() is not None:
+                frames += 1
+        elapsed = time.perf_counter() - start
+
+        stages = screen_share.stage_stats()
+        encoded = screen_share.bytes_encoded - bytes_before
+        dropped = screen_share.frame_ring.stats()["dropped"] - dropped_before
+        skipped = screen_share.frames_skipped - skipped_before
+    return frames / elapsed, stages, encoded / elapsed / 1024, dropped, skipped
+
+def sources(args: list[str]):
+    for width, height in RESOLUTIONS:
+        for pattern in SyntheticSource.PATTERNS:
+            yield f"{pattern} {width}x{height}", lambda pattern=pattern, width=width, height=height: SyntheticSource(width, height, pattern)
+    for path in args:
+        if path == "--mss":
+            yield "mss", MssSource
+        else:
+            yield os.path.basename(path), lambda path=path: RecordedSource(path)
+
+if __name__ == "__main__":
+    header = f"{'source':>22} | {'scale':>5} | {'fps':>7} | " + " | ".join(f"{stage + ' ms':>10}" for stage in STAGES) + f" | {'KB/s':>9} | {'dropped':>7} | {'skipped':>7}"
+    print(header)
+    for name, make_source in sources(sys.argv[1:]):
+        for scale in SCALES:
+            with contextlib.redirect_stdout(io.StringIO()): # Keeps the codec's log lines out of the table
+                fps, stages, kbs, dropped, skipped = run(make_source(), scale)
+            print(f"{name:>22} | {scale:>5} | {fps:>7.1f} | " + " | ".join(f"{stages[stage]:>10.2f}" for stage in STAGES) + f" | {kbs:>9.1f} | {dropped:>7} | {skipped:>7}")
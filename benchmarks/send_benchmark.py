@@ -0,0 +1,76 @@
+import os
+import sys
+import socket
+import struct
+import time
+import multiprocessing
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import Events, Options
+from utils import Connection, NetworkUtils, byte_length
+
+MESSAGE_SIZES = [64, 1024, Options.CHUNK_SIZE, 64 * 1024, 256 * 1024]
+TOTAL_BYTES = 64 * 1024 * 1024
+MAX_MESSAGES = 20000
+
+def legacy_send_parts(client: Connection, parts: list):
+    encoded_parts = [b if type(b) != str else b.encode() for b in parts]
+    encoded_parts = [b if type(b) != int else int.to_bytes(b, byte_length(b)) for b in encoded_parts]
+    bts = Options.SEPERATOR.join(encoded_parts)
+    bts = client.encryption_manager.aes_net_encrypt(bts)
+    length_b = struct.pack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, len(bts))
+    client.socket.sendall(length_b+bts)
+
+def vectored_send_parts(client: Connection, parts: list):
+    NetworkUtils.send_parts(client, parts)
+
+def drain(ports):
+    # Drains in another process so the reader doesn't compete with the sender for the GIL
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    ports.put(server.getsockname()[1])
+    s, _ = server.accept()
+    buffer = bytearray(1024 * 1024)
+    while s.recv_into(buffer):
+        pass
+
+def measure_allocations(send, client: Connection, parts: list) -> int:
+    send(client, parts)
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    send(client, parts)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - before
+
+def run(send, size: int):
+    ports = multiprocessing.Queue()
+    drainer = multiprocessing.Process(target=drain, args=(ports, ), daemon=True)
+    drainer.start()
+    a = socket.create_connection(("127.0.0.1", ports.get()))
+    client = Connection(a, None)
+    client.encryption_manager.set_sym_key(os.urandom(32))
+    parts = [Events.FileChunkDownload_Response.value, b"TID", 1, 1, os.urandom(size)]
+
+    allocated = measure_allocations(send, client, parts)
+
+    count = max(1, min(TOTAL_BYTES // size, MAX_MESSAGES))
+    start = time.perf_counter()
+    for _ in range(count):
+        send(client, parts)
+    elapsed = time.perf_counter() - start
+
+    a.close()
+    drainer.join()
+    return allocated, size * count / elapsed / (1024 * 1024)
+
+if __name__ == "__main__":
+    print(f"{'size':>8} | {'path':>8} | {'peak alloc B':>12} | {'copies':>6} | {'MB/s':>9}")
+    for size in MESSAGE_SIZES:
+        for name, send in (("join", legacy_send_parts), ("sendmsg", vectored_send_parts)):
+            allocated, mbs = run(send, size)
+            print(f"{size:>8} | {name:>8} | {allocated:>12} | {allocated / size:>6.1f} | {mbs:>9.1f}")
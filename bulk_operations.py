@@ -0,0 +1,114 @@
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from constants import Options
+
+# copy_file_range isn't supported everywhere (other filesystems, old kernels), these mean shutil should do the copy
+COPY_FALLBACK_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+def copy_file(src: str, dst: str):
+    # copy_file_range keeps the data in the kernel and lets copy-on-write filesystems share the blocks,
+    # shutil.copyfile falls back to sendfile (Linux), fcopyfile (macOS) or a buffered copy
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                size = os.fstat(fsrc.fileno()).st_size
+                copied = 0
+                while n := os.copy_file_range(fsrc.fileno(), fdst.fileno(), Options.COPY_CHUNK_SIZE):
+                    copied += n
+                # Some pseudo filesystems report 0 bytes for files that do have content
+                if copied or not size: return
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS: raise
+
+    shutil.copyfile(src, dst)
+
+class BulkOperations:
+    # Items run on item_pool, the files inside a directory being copied or removed on file_pool.
+    # Item jobs wait for file jobs but never the other way around, so the pools can't starve each other
+    item_pool = ThreadPoolExecutor(max_workers=Options.BULK_ITEM_WORKERS, thread_name_prefix="bulk")
+    file_pool = ThreadPoolExecutor(max_workers=Options.BULK_FILE_WORKERS, thread_name_prefix="bulk-file")
+
+    @staticmethod
+    def __wait_all(futures: list):
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def copy_tree(src: str, dst: str):
+        os.makedirs(dst, exist_ok=True)
+        futures = []
+        for root, dirs, files in os.walk(src):
+            target = os.path.join(dst, os.path.relpath(root, src))
+            for d in dirs:
+                # os.walk doesn't descend into links to directories, they're copied as links
+                p = os.path.join(root, d)
+                if os.path.islink(p):
+                    os.symlink(os.readlink(p), os.path.join(target, d), target_is_directory=True)
+                else:
+                    os.makedirs(os.path.join(target, d), exist_ok=True)
+            for f in files:
+                futures.append(BulkOperations.file_pool.submit(copy_file, os.path.join(root, f), os.path.join(target, f)))
+        BulkOperations.__wait_all(futures)
+
+    @staticmethod
+    def remove_tree(path: str):
+        # Files (and links to directories, which os.walk lists as directories) are unlinked in parallel,
+        # then the directories are removed deepest first
+        futures = []
+        dirs_to_remove = []
+        for root, dirs, files in os.walk(path, topdown=False):
+            for d in dirs:
+                p = os.path.join(root, d)
+                if os.path.islink(p):
+                    futures.append(BulkOperations.file_pool.submit(os.unlink, p))
+            for f in files:
+                futures.append(BulkOperations.file_pool.submit(os.unlink, os.path.join(root, f)))
+            dirs_to_remove.append(root)
+
+        BulkOperations.__wait_all(futures)
+        for d in dirs_to_remove:
+            os.rmdir(d)
+
+    @staticmethod
+    def copy(src: str, dst: str):
+        if os.path.isdir(src):
+            BulkOperations.copy_tree(src, dst)
+        else:
+            copy_file(src, dst)
+
+    @staticmethod
+    def move(src: str, dst: str):
+        # Like shutil.move (and MVRQ), moving onto an existing directory moves src into it
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(os.path.normpath(src)))
+            if os.path.lexists(dst):
+                raise FileExistsError(errno.EEXIST, "Destination already exists", dst)
+        try:
+            os.replace(src, dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            BulkOperations.copy(src, dst)
+            BulkOperations.remove(src)
+
+    @staticmethod
+    def remove(path: str):
+        if os.path.isdir(path) and not os.path.islink(path):
+            BulkOperations.remove_tree(path)
+        else:
+            os.unlink(path)
+
+    @staticmethod
+    def run_item(op: str, src: str, dst: str):
+        match op:
+            case "copy":
+                BulkOperations.copy(src, dst)
+            case "move":
+                BulkOperations.move(src, dst)
+            case "remove":
+                BulkOperations.remove(src)
+            case _:
+                raise ValueError(f"Unknown operation: {op}")
@@ -0,0 +1,228 @@
+import threading
+
+import numpy as np
+
+try:
+    import win32gui, win32ui
+except ImportError:
+    win32gui = win32ui = None
+
+def get_cursor(hcursor):
+    try:
+        # Create a device context and bitmap
+        hdc = win32ui.CreateDCFromHandle(win32gui.GetDC(0))
+        hbmp = win32ui.CreateBitmap()
+        hbmp.CreateCompatibleBitmap(hdc, 36, 36)
+        hdc = hdc.CreateCompatibleDC()
+        hdc.SelectObject(hbmp)
+        hdc.DrawIcon((0, 0), hcursor)
+
+        # Get bitmap info and bits
+        bmpinfo = hbmp.GetInfo()
+        bmpstr = hbmp.GetBitmapBits(True)
+
+        # Convert the raw bitmap string into a NumPy array
+        height, width = bmpinfo['bmHeight'], bmpinfo['bmWidth']
+        raw_array = np.frombuffer(bmpstr, dtype=np.uint8)
+        img_array = raw_array.reshape((height, width, 4))  # Assuming 32-bit with BGRA format
+
+        # Drop the alpha channel (if desired, you can retain it)
+        img_rgb = img_array[:, :, :3]
+
+        # Release resources
+        win32gui.DestroyIcon(hcursor)
+        win32gui.DeleteObject(hbmp.GetHandle())
+        hdc.DeleteDC()
+
+        # Return the RGB image
+        return img_rgb
+    except:
+        return None
+
+def add_cursor_to_frame(frame):
+    if win32gui is None:
+        return frame
+
+    # Get cursor information
+    flags, hcursor, (cx, cy) = win32gui.GetCursorInfo()
+    cursor = get_cursor(hcursor)
+
+    if cursor is None:
+        return frame
+
+    # Get cursor hotspot information
+    hotspot_x, hotspot_y = win32gui.GetIconInfo(hcursor)[1:3]
+
+    # Extract cursor dimensions
+    ch, cw = cursor.shape[:2]
+
+    # Adjust cursor position by subtracting hotspot offset
+    cx = cx - hotspot_x
+    cy = cy - hotspot_y
+
+    # Ensure cursor is within frame boundaries
+    fx = max(0, min(cx, frame.shape[1] - cw))
+    fy = max(0, min(cy, frame.shape[0] - ch))
+
+    # Create alpha mask based on cursor's intensity
+    mask = (cursor[:, :, :3].max(axis=-1) > 10).astype(np.float32)[:, :, np.newaxis]
+
+    # Blend cursor with the frame using the mask
+    roi = frame[fy:fy+ch, fx:fx+cw]
+    cursor_region = cursor[:, :, :3] * mask + roi * (1 - mask)
+    frame[fy:fy+ch, fx:fx+cw] = cursor_region.astype(np.uint8)
+
+    return frame
+
+class CaptureSource:
+    # Every source hands out BGRA frames of a fixed width x height, the way mss grabs them
+    width = 0
+    height = 0
+
+    def grab(self) -> np.ndarray:
+        raise NotImplementedError
+
+    def draw_cursor(self, frame: np.ndarray) -> np.ndarray:
+        return frame
+
+    def close(self):
+        pass
+
+class MssSource(CaptureSource):
+    def __init__(self, monitor_index: int = 1) -> None:
+        from mss import mss
+        self.mss = mss
+        # mss handles can't be shared between threads on Windows, every grabbing thread opens its own
+        self.thread_local = threading.local()
+        self.handles = []
+        self.handles_lock = threading.Lock()
+        self.monitor = self.__sct().monitors[monitor_index]
+        self.width = self.monitor["width"]
+        self.height = self.monitor["height"]
+
+    def __sct(self):
+        if not hasattr(self.thread_local, 'sct'):
+            self.thread_local.sct = self.mss()
+            with self.handles_lock:
+                self.handles.append(self.thread_local.sct)
+        return self.thread_local.sct
+
+    def grab(self) -> np.ndarray:
+        screenshot = self.__sct().grab(self.monitor)
+        return np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(screenshot.height, screenshot.width, 4)
+
+    def draw_cursor(self, frame: np.ndarray) -> np.ndarray:
+        return add_cursor_to_frame(frame)
+
+    def close(self):
+        with self.handles_lock:
+            for sct in self.handles:
+                sct.close()
+            self.handles.clear()
+
+class SyntheticSource(CaptureSource):
+    # Generated content for profiling without a display:
+    # gradient - every pixel changes every frame
+    # text - a page of glyph-like blocks scrolling up a few rows per frame
+    # desktop - a static desktop where only a small clock-sized area changes
+    # idle - the same desktop with nothing changing at all
+    PATTERNS = ("gradient", "text", "desktop", "idle")
+
+    def __init__(self, width: int, height: int, pattern: str = "gradient", seed: int = 0) -> None:
+        if pattern not in SyntheticSource.PATTERNS:
+            raise ValueError(f"Unknown pattern {pattern}")
+        self.width = width
+        self.height = height
+        self.pattern = pattern
+        self.frame_index = 0
+        self.rng = np.random.default_rng(seed)
+
+        # Everything is kept as BGRA up front so a grab is a single contiguous pass
+        if pattern == "gradient":
+            x = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :]
+            y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+            self.base = np.stack(np.broadcast_arrays((x + y) / 2, x, y, np.float32(255)), axis=-1).astype(np.uint8)
+        elif pattern == "text":
+            self.page = self.__text_page(height * 3)
+        else:
+            self.base = self.__desktop()
+
+    def __text_page(self, rows: int) -> np.ndarray:
+        # 8x14 cells, about half of them hold a dark "glyph" on a white background
+        cell_w, cell_h = 8, 14
+        page = np.full((rows, self.width, 4), 250, dtype=np.uint8)
+        page[:, :, 3] = 255
+        lines = rows // cell_h
+        columns = self.width // cell_w
+        glyphs = self.rng.random((lines, columns)) < 0.55
+        # Ragged line ends like real paragraphs
+        line_lengths = self.rng.integers(columns // 3, columns + 1, lines)
+        glyphs &= np.arange(columns)[np.newaxis, :] < line_lengths[:, np.newaxis]
+
+        shapes = self.rng.random((16, cell_h - 4, cell_w - 2)) < 0.4
+        shape_ids = self.rng.integers(0, len(shapes), (lines, columns))
+        for line in range(lines):
+            for column in np.flatnonzero(glyphs[line]):
+                top, left = line * cell_h + 2, column * cell_w + 1
+                page[top:top + cell_h - 4, left:left + cell_w - 2][shapes[shape_ids[line, column]]] = (30, 30, 30, 255)
+        return page
+
+    def __desktop(self) -> np.ndarray:
+        desktop = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        desktop[:] = (120, 80, 40, 255)
+        # A few flat windows with title bars and a taskbar
+        for _ in range(5):
+            w = int(self.rng.integers(self.width // 5, self.width // 2))
+            h = int(self.rng.integers(self.height // 5, self.height // 2))
+            x = int(self.rng.integers(0, self.width - w))
+            y = int(self.rng.integers(0, self.height - h))
+            desktop[y:y + h, x:x + w, :3] = 240
+            desktop[y:y + 24, x:x + w, :3] = self.rng.integers(60, 200, 3)
+        desktop[-40:, :, :3] = 30
+        return desktop
+
+    def grab(self) -> np.ndarray:
+        t = self.frame_index
+        self.frame_index += 1
+
+        if self.pattern == "gradient":
+            # Broadcasting over whole rows is far quicker than over the 4 channels
+            shift = np.tile(np.array([t * 3 % 256] * 3 + [0], dtype=np.uint8), self.width)
+            return (self.base.reshape(self.height, -1) + shift).reshape(self.base.shape)
+        if self.pattern == "text":
+            rows = len(self.page) - self.height
+            offset = (t * 3) % rows
+            return self.page[offset:offset + self.height].copy()
+
+        frame = self.base.copy()
+        if self.pattern == "desktop":
+            # Clock in the taskbar corner
+            frame[-30:-10, -80:-10, :3] = t * 37 % 256
+        return frame
+
+class RecordedSource(CaptureSource):
+    # Replays frames saved with RecordedSource.record, looping once it reaches the end.
+    # The recording is a .npy array of shape (frames, height, width, 4), memory mapped so long ones stay on disk
+    def __init__(self, path: str) -> None:
+        self.frames = np.load(path, mmap_mode="r")
+        if self.frames.ndim != 4 or self.frames.shape[3] != 4:
+            raise ValueError(f"{path} is not a recording of BGRA frames")
+        self.height, self.width = self.frames.shape[1:3]
+        self.frame_index = 0
+
+    @staticmethod
+    def record(source: CaptureSource, path: str, count: int):
+        frames = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(count, source.height, source.width, 4))
+        for i in range(count):
+            frames[i] = source.grab()
+        frames.flush()
+        del frames
+
+    def grab(self) -> np.ndarray:
+        frame = np.array(self.frames[self.frame_index])
+        self.frame_index = (self.frame_index + 1) % len(self.frames)
+        return frame
+
+    def close(self):
+        # Drops the memory map
+        self.frames = None
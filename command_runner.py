@@ -0,0 +1,113 @@
+import os
+import signal
+import subprocess
+import threading
+
+from constants import Events, Options
+from terminal import Terminal
+from utils import Connection
+
+class CommandProcess:
+    # Runs a shell command without holding an event worker: output is pumped by one thread per stream
+    # and a waiter thread sends the CMDE once the process ended
+    running: dict[tuple[Connection, bytes], 'CommandProcess'] = {}
+    running_lock = threading.Lock()
+
+    def __init__(self, conn: Connection, transaction_id: bytes, command: str, timeout: float) -> None:
+        self.conn = conn
+        self.transaction_id = transaction_id
+        self.command = command
+        self.timeout = timeout
+        self.status = None
+        self.process: subprocess.Popen | None = None
+
+    @staticmethod
+    def start(conn: Connection, transaction_id: bytes, command: str, timeout: float) -> bool:
+        # Returns False when the connection already runs too many commands (or one with this id)
+        key = (conn, transaction_id)
+        command_process = CommandProcess(conn, transaction_id, command, timeout)
+        with CommandProcess.running_lock:
+            if key in CommandProcess.running: return False
+            if sum(1 for k in CommandProcess.running if k[0] == conn) >= Options.MAX_COMMANDS_PER_CONNECTION: return False
+            CommandProcess.running[key] = command_process
+
+        try:
+            command_process.__spawn()
+        except Exception:
+            with CommandProcess.running_lock:
+                CommandProcess.running.pop(key, None)
+            raise
+        return True
+
+    @staticmethod
+    def cancel(conn: Connection, transaction_id: bytes) -> bool:
+        with CommandProcess.running_lock:
+            command_process = CommandProcess.running.get((conn, transaction_id))
+        if command_process is None: return False
+        command_process.kill("cancelled")
+        return True
+
+    @staticmethod
+    def cancel_all(conn: Connection):
+        with CommandProcess.running_lock:
+            processes = [p for key, p in CommandProcess.running.items() if key[0] == conn]
+        for command_process in processes:
+            command_process.kill("cancelled")
+
+    def __spawn(self):
+        # A new process group/session lets kill() take the shell's children down with it
+        if os.name == "nt":
+            extra = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            extra = {"start_new_session": True}
+
+        self.process = subprocess.Popen(self.command, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, **extra)
+        readers = [
+            threading.Thread(target=self.__pump, args=(self.process.stdout, b"out"), daemon=True),
+            threading.Thread(target=self.__pump, args=(self.process.stderr, b"err"), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=self.__wait, args=(readers, ), daemon=True).start()
+
+    def __pump(self, pipe, stream: bytes):
+        # Sending blocks while the client is slow, the pipe then fills up and the process waits,
+        # so a command never has more than one chunk per stream in memory
+        fd = pipe.fileno()
+        try:
+            while chunk := os.read(fd, Options.COMMAND_CHUNK_SIZE):
+                self.conn.send_event(Events.CommandRun_Response, [self.transaction_id, stream, chunk])
+        except OSError:
+            pass
+        finally:
+            pipe.close()
+
+    def __wait(self, readers: list[threading.Thread]):
+        try:
+            code = self.process.wait(self.timeout or None)
+        except subprocess.TimeoutExpired:
+            self.kill("timeout")
+            code = self.process.wait()
+
+        # Children that outlive the shell may keep the pipes open, don't wait for them forever
+        for reader in readers:
+            reader.join(Options.COMMAND_DRAIN_TIMEOUT)
+
+        with CommandProcess.running_lock:
+            CommandProcess.running.pop((self.conn, self.transaction_id), None)
+
+        status = self.status or str(code)
+        self.conn.send_event(Events.CommandEnd_Response, [self.transaction_id, status])
+        self.conn.send_success(f"[{Events.CommandRun_Request.name}] Ran command: {self.command} ({status}) | TID: {self.transaction_id}")
+
+    def kill(self, status: str):
+        if self.process is None or self.process.poll() is not None: return
+        self.status = self.status or status
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(self.process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError as e:
+            Terminal.warning(f"Couldn't kill command {self.command}: {e}")
+            self.process.kill()
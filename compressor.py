@@ -0,0 +1,97 @@
+import threading
+import zlib
+
+import numpy as np
+
+from constants import CompressionCodec, Options
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESSION_ERRORS = (zlib.error, ValueError) + ((zstandard.ZstdError, ) if zstandard is not None else ())
+
+def available_codecs() -> list[CompressionCodec]:
+    return [codec for codec in Options.COMPRESSION_CODECS if codec != CompressionCodec.ZSTD or zstandard is not None]
+
+def estimate_entropy(sample) -> float:
+    # Shannon entropy in bits per byte, already compressed data (PNG, ZIP, H.264) sits close to 8
+    if not len(sample): return 0.0
+    counts = np.bincount(np.frombuffer(sample, dtype=np.uint8), minlength=256)
+    p = counts[counts > 0] / len(sample)
+    return float(-(p * np.log2(p)).sum())
+
+class MessageCompressor:
+    # Every encrypted message starts with a flag byte telling whether the rest is compressed,
+    # so incompressible messages are sent as is instead of growing
+    RAW = b"\0"
+    COMPRESSED = b"\1"
+
+    def __init__(self, codec: CompressionCodec, level: int = Options.COMPRESSION_LEVEL) -> None:
+        self.codec = codec
+        self.level = level
+        self.local = threading.local()
+
+    @staticmethod
+    def choose(offered: bytes) -> 'MessageCompressor | None':
+        # Codec ids share the offer list with the cipher suite ids
+        if not Options.COMPRESSION: return None
+        for codec in available_codecs():
+            if codec.value in offered:
+                return MessageCompressor(codec)
+        return None
+
+    def __zstd(self):
+        # zstandard's (de)compressors can't be shared between threads
+        if not hasattr(self.local, "compressor"):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+            self.local.decompressor = zstandard.ZstdDecompressor()
+        return self.local.compressor, self.local.decompressor
+
+    @staticmethod
+    def worth_compressing(parts: list) -> bool:
+        size = sum(len(part) for part in parts)
+        if size < Options.COMPRESSION_MIN_SIZE: return False
+
+        # Sample the start and the middle of the largest part, that's where the payload is
+        largest = memoryview(max(parts, key=len)).cast("B")
+        half = Options.COMPRESSION_SAMPLE_SIZE // 2
+        middle = len(largest) // 2
+        sample = bytes(largest[:half]) + bytes(largest[max(half, middle - half // 2):][:half])
+        return estimate_entropy(sample) < Options.COMPRESSION_ENTROPY_THRESHOLD
+
+    def compress_parts(self, parts: list) -> list:
+        if not MessageCompressor.worth_compressing(parts):
+            return [MessageCompressor.RAW, *parts]
+
+        if self.codec == CompressionCodec.ZSTD:
+            compressor, _ = self.__zstd()
+            chunker = compressor.compressobj()
+            compressed = b"".join([*(chunker.compress(part) for part in parts), chunker.flush()])
+        else:
+            chunker = zlib.compressobj(self.level)
+            compressed = b"".join([*(chunker.compress(part) for part in parts), chunker.flush()])
+
+        size = sum(len(part) for part in parts)
+        if len(compressed) >= size:
+            return [MessageCompressor.RAW, *parts]
+        return [MessageCompressor.COMPRESSED, compressed]
+
+    def decompress(self, data) -> bytes | None:
+        if data is None or not len(data): return None
+        flag, payload = data[:1], memoryview(data)[1:]
+        if flag == MessageCompressor.RAW: return bytes(payload)
+        if flag != MessageCompressor.COMPRESSED: return None
+
+        # Both stop once the limit is hit instead of inflating whatever the peer sent
+        try:
+            if self.codec == CompressionCodec.ZSTD:
+                _, decompressor = self.__zstd()
+                return decompressor.decompress(payload, max_output_size=Options.COMPRESSION_MAX_MESSAGE_SIZE)
+
+            inflater = zlib.decompressobj()
+            out = inflater.decompress(payload, Options.COMPRESSION_MAX_MESSAGE_SIZE)
+            return out if inflater.eof and not inflater.unconsumed_tail else None
+        except DECOMPRESSION_ERRORS:
+            return None
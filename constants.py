@@ -1,15 +1,104 @@
 from enum import Enum
 
+class CipherSuite(Enum):
+    # Ids are sent as single bytes, so 0 (the separator) is never used
+    AES_EAX = 1
+    AES_GCM = 2
+    CHACHA20_POLY1305 = 3
+
+class CompressionCodec(Enum):
+    # Offered next to the cipher suite ids, so they must not collide with them
+    ZLIB = 16
+    ZSTD = 17
+
+class KeyExchange(Enum):
+    RSA = "RSA"
+    ECDH = "ECDH"
+
+class ArchiveEntry(Enum):
+    File = 1
+    Directory = 2
+    End = 3
+
+class EntryType(Enum):
+    File = 1
+    Directory = 2
+    Symlink = 3
+    Other = 4
+
+class DeltaOp(Enum):
+    Copy = 1
+    Literal = 2
+    End = 3
+
+class DiffMask(Enum):
+    Runs = 1
+    Bitmap = 2
+
 class Options:
     MAX_CONNECTED = 20
+    ASYNC_MAX_CONNECTED = 1000
+    ASYNC_EXECUTOR_WORKERS = 32
+    EVENT_WORKERS = 32
+    MAX_EVENTS_PER_CONNECTION = 8
     PORT = 34981
     CHUNK_SIZE = 4096*2
+    MAX_CHUNK_SIZE = 1024*1024
+    CHUNK_TARGET_SEND_TIME = 0.05 # Seconds
+    READ_AHEAD_BUFFERS = 4
+    MMAP_THRESHOLD = 64*1024*1024
+    PROGRESS_LOG_INTERVAL = 1.0 # Seconds
+    ARCHIVE_READ_WORKERS = 8
+    ARCHIVE_INFLIGHT_FILES = 64
+    ARCHIVE_SMALL_FILE_SIZE = 1024*1024 # Bigger files are streamed instead of read whole on the pool
+    ARCHIVE_FRAME_SIZE = 256*1024
+    UPLOAD_MAX_OPEN_FILES = 64
+    DELTA_BLOCK_SIZE = 16*1024
+    DELTA_SEGMENT_SIZE = 1024*1024 # Positions checksummed at once while searching for matching blocks
+    DELTA_MAX_LITERAL = 1024*1024
+    DELTA_FRAME_SIZE = 256*1024
+    DELTA_SIGNATURE_CACHE_SIZE = 64
+    LISTING_BATCH_SIZE = 1000 # Entries per DLST message
+    LISTING_PAGE_SIZE = 10000 # Entries per request when the client doesn't ask for a page size, 0 lists everything
+    LISTING_CURSOR_CACHE_SIZE = 256
+    LISTING_CURSOR_LIFETIME = 5 * 60 # Seconds
+    LISTING_CACHE_MAX_ENTRIES = 1024
+    LISTING_CACHE_MAX_BYTES = 64*1024*1024
+    SEARCH_WORKERS = 16
+    BULK_ITEM_WORKERS = 8
+    BULK_FILE_WORKERS = 16
+    COPY_CHUNK_SIZE = 64*1024*1024 # Bytes per copy_file_range call
+    MAX_COMMANDS_PER_CONNECTION = 16
+    COMMAND_CHUNK_SIZE = 64*1024 # Largest CMDO chunk, also all the output a command ever has buffered per stream
+    COMMAND_TIMEOUT = 0 # Seconds, 0 lets commands run until they exit or are cancelled
+    COMMAND_DRAIN_TIMEOUT = 5 # Seconds to wait for output after the process exited
+    SHELL = None # None uses $SHELL (or /bin/sh), %COMSPEC% on Windows
+    MAX_SHELLS_PER_CONNECTION = 4
+    SHELL_IDLE_TIMEOUT = 15 * 60 # Seconds without input or output before a shell is closed
+    SHELL_COLUMNS = 120
+    SHELL_ROWS = 40
+    SEARCH_MAX_RESULTS = 10000
+    SEARCH_BATCH_SIZE = 200 # Matches per SRCH message
+    SEARCH_BATCH_INTERVAL = 0.25 # Seconds, a partial batch is sent once it waited this long
+    LISTING_CACHE_INOTIFY = True # Only on Linux, elsewhere cached listings are checked against the directory's mtime
+    RECV_BUFFER_SIZE = 65536
     DEBUG_LEVEL = 2 # 1 = Normal debug, 2 = Verbose debug
 
     SCREENSHOTS_FOLDER = "screenshots"
+    SCREENSHOTS_FOLDER_MAX_BYTES = 256*1024*1024 # Oldest screenshots are deleted past this
+    SCREENSHOT_FORMAT = "png"
+    SCREENSHOT_QUALITY = 80 # JPEG / WebP quality, 0-100
+    SCREENSHOT_PNG_COMPRESSION = 3 # 0-9, PNG is lossless so this only trades speed for size
 
     SIZE_OF_SIZE_ENCODING_PROTOCOL = "I"
     SIZE_OF_SIZE = 4
+    ARCHIVE_ENTRY_HEADER = "<BHQ" # Entry kind, path length, content size
+    DELTA_SIGNATURE_HEADER = "<IQ" # Block size, file size
+    DELTA_BLOCK_SIGNATURE = "<I16s" # Weak rolling checksum, strong hash
+    DELTA_COPY = "<BQQ" # Op, offset in the old file, length
+    DELTA_LITERAL = "<BI" # Op, length of the data that follows
+    LISTING_ENTRY = "<BQdH" # Entry type, size, mtime, name length
+    IMAGE_DIFF_HEADER = "<HHBB" # Width, height, block size, DiffMask
     SEPERATOR = b"\0"
 
     MOUSE_POSITION_ACCURACY = 1000
@@ -18,18 +107,69 @@ class Options:
     KEYBOARD_UPDATE_PORT = 34984
 
     SCREEN_UPDATE_FRAME_RATE = 30
-    SCREEN_CHANGE_DETECTION_THRESHOLD = 5
+    SCREEN_FRAME_RING_SIZE = 3 # Preallocated frames between capture and encoding, the oldest is dropped when full
+    SCREEN_CHANGE_DETECTION_THRESHOLD = 5 # Gray level difference a tile needs before it counts as changed
+    SCREEN_TILE_SIZE = 64 # Change detection tiles, in captured pixels
+    SCREEN_DETECTION_SCALE = 4 # Change detection runs on a frame this many times smaller
     REGION_SIZE_BYTES = 3
-    MAX_REGION_AREA = 60000
+    MAX_REGION_AREA = 60000 # Largest dirty rectangle, in encoded pixels
+    IMAGE_DIFF_BLOCK_SIZE = 16
     SCREEN_SIZE_FACTOR = 0.9
+    SCREEN_CRF = 30
+
+    # Adaptive quality, every interval the stream is stepped down when sending or encoding can't keep up
+    # and stepped back up after a few intervals with headroom, always within these bounds
+    SCREEN_ADAPTIVE_QUALITY = True
+    SCREEN_ADAPT_INTERVAL = 1.0 # Seconds
+    SCREEN_CRF_BOUNDS = (20, 40)
+    SCREEN_CRF_STEP = 3
+    SCREEN_SIZE_FACTOR_BOUNDS = (0.4, 1.0)
+    SCREEN_SIZE_FACTOR_STEP = 0.1
+    SCREEN_FRAME_RATE_BOUNDS = (8, 30)
+    SCREEN_FRAME_RATE_STEP = 4
+    SCREEN_SEND_BUSY_HIGH = 0.6 # Share of the interval spent blocked sending that counts as a thin link
+    SCREEN_SEND_BUSY_LOW = 0.2
+    SCREEN_ENCODE_BUDGET = 0.7 # Share of a frame interval encoding may take
+    SCREEN_DROP_RATIO_HIGH = 0.3 # Share of captured frames dropped before the encoder got to them
+    SCREEN_UPGRADE_INTERVALS = 3
     
+    KEY_EXCHANGE = KeyExchange.RSA
     RSA_KEY_SIZE = 1024
+    RSA_KEY_POOL_SIZE = 8 # 0 generates every key on the handshake itself
+    ECDH_CURVE = "P-256"
+    ECDH_SECRET_SIZE = 32
+
+    SESSION_TICKETS = True
+    SESSION_TICKET_SIZE = 32
+    SESSION_TICKET_LIFETIME = 60 * 60 # Seconds
+    SESSION_TICKET_CACHE_SIZE = 4096
+    SESSION_RANDOM_SIZE = 32
     NONCE_SIZE = 16
+    AEAD_NONCE_SIZE = 12
+    NONCE_COUNTER_SIZE = 8
     TAG_SIZE = 16
+    COMPRESSION = True
+    COMPRESSION_CODECS = [CompressionCodec.ZSTD, CompressionCodec.ZLIB] # In order of preference, zstd only if installed
+    COMPRESSION_LEVEL = 3
+    COMPRESSION_MIN_SIZE = 512
+    COMPRESSION_SAMPLE_SIZE = 4096
+    COMPRESSION_ENTROPY_THRESHOLD = 7.5 # Bits per byte, samples above it are treated as already compressed
+    COMPRESSION_MAX_MESSAGE_SIZE = 256*1024*1024
+    MAX_FRAME_SIZE = 256*1024*1024 + 1024 # Largest frame a peer may announce, leaves room for the encryption overhead
+    CIPHER_SUITES = [CipherSuite.AES_GCM, CipherSuite.CHACHA20_POLY1305, CipherSuite.AES_EAX] # In order of preference
 
 class Events(Enum):
     Screenshot_Request = "SSRQ"
     FileContent_Request = "FLRQ"
+    FileChunks_Request = "FCRQ"
+    DirectoryArchive_Request = "DARQ"
+    DeltaSignature_Request = "DSRQ"
+    DeltaDownload_Request = "DDRQ"
+    DirectoryListing_Request = "DLRQ"
+    ListingCacheStats_Request = "LCRQ"
+    Search_Request = "SRRQ"
+    BulkOperation_Request = "BORQ"
+    ShellOpen_Request = "SHOP"
     FileList_Request = "LSRQ"
     CopyFile_Request = "CPRQ"
     MoveFile_Request = "MVRQ"
@@ -40,15 +180,34 @@ class Events(Enum):
     ScreenControlInput_Action = "SCIN"
     ScreenControlDisconnect_Action = "DNSC"
     FileChunkUpload_Action = "UPCK"
+    CommandCancel_Action = "CMDC"
+    ShellInput_Action = "SHIN"
+    ShellResize_Action = "SHRS"
+    ShellClose_Action = "SHCL"
+    SearchCancel_Action = "SRCN"
+    DeltaUpload_Action = "DUPL"
     ScreenFrame_Action = "SCFR"
 
     ScreenshotDone_Response = "SDON"
+    ScreenshotImage_Response = "SSIM"
     FileChunkDownload_Response = "DNCK"
+    DirectoryArchive_Response = "DACK"
+    DeltaSignature_Response = "DSIG"
+    DeltaDownload_Response = "DDLT"
+    DirectoryListing_Response = "DLST"
+    DirectoryListingEnd_Response = "DLND"
+    ListingCacheStats_Response = "LCST"
+    Search_Response = "SRCH"
+    SearchEnd_Response = "SRND"
+    BulkOperationProgress_Response = "BOPR"
     FileList_Response = "FOLL"
     OperationSuccess_Response = "SUCC"
     OperationFailed_Response = "ERRR"
     AcceptScreenControl_Response = "ACSC"
     CommandRun_Response = "CMDO"
+    CommandEnd_Response = "CMDE"
+    ShellOutput_Response = "SHOT"
+    ShellEnd_Response = "SHND"
 
     ScreenWatch_Request = "SWRQ"
     ScreenWatchDisconnect_Action = "DNSW"
@@ -56,16 +215,18 @@ class Events(Enum):
 
     PublicKeyTransfer_Action = "PUKT"
     SecretTransfer_Action = "SECT"
+    SecretTransferSuites_Action = "SECS"
+    CipherSuiteSelect_Action = "CSEL"
+    EphemeralKeyTransfer_Action = "EPKT"
+    ResumeSession_Action = "RESM"
+    SessionTicket_Response = "STKT"
 
     ConnectionClosed = "CLOS"
     UnknownEvent = "UNKNOWN_EVENT"
 
     @classmethod
     def from_val(cls, value: str) -> 'Events':
-        for event in cls:
-            if value == event.value:
-                return event
-        return cls.UnknownEvent
+        return cls._value2member_map_.get(value, cls.UnknownEvent)
 
 class Error(Enum):
     UnknownError     = 0
@@ -73,6 +234,11 @@ class Error(Enum):
     BadPath          = 2
     FailureToSendKey = 3
     CouldntVerifyKey = 4
+    InvalidSessionTicket = 5
+    BadRange = 6
+    BadDelta = 7
+    BadCursor = 8
+    TooManyCommands = 9
 
 class DataType(Enum):
     Raw = "RAW",
@@ -0,0 +1,279 @@
+import hashlib
+import os
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Iterator
+
+import numpy as np
+
+from constants import DeltaOp, Options
+from utils import Connection
+
+# rsync style delta transfer. The side holding the old version sends a Signature (a weak rolling checksum and a
+# strong hash per block), the side holding the new version answers with copy instructions for blocks the old
+# version already has and literal data for everything else
+
+def strong_hash(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def block_checksums(blocks: np.ndarray) -> np.ndarray:
+    # blocks is (count, block size), same checksum as rolling_checksums at block boundaries
+    x = blocks.astype(np.int64)
+    a = x.sum(axis=1)
+    b = x @ np.arange(x.shape[1], 0, -1, dtype=np.int64)
+    return ((a & 0xffff) | ((b & 0xffff) << 16)).astype(np.uint32)
+
+def rolling_checksums(data: np.ndarray, block_size: int) -> np.ndarray:
+    # Checksum of the block starting at every position, from prefix sums instead of rolling byte by byte.
+    # Only the low 16 bits of both sums are kept, so everything can wrap around in uint32
+    x = data.astype(np.uint32)
+    sums = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(x, out=sums[1:])
+    positions = np.arange(len(x), dtype=np.uint32)
+    x *= positions
+    weighted = np.zeros(len(x) + 1, dtype=np.uint32)
+    np.cumsum(x, out=weighted[1:])
+
+    a = sums[block_size:] - sums[:-block_size]
+    b = positions[block_size-1:] + np.uint32(1)
+    b *= a
+    b -= weighted[block_size:]
+    b += weighted[:-block_size]
+    return (a & 0xffff) | (b << 16)
+
+class Signature:
+    def __init__(self, block_size: int, size: int, weak: np.ndarray, strong: list[bytes]) -> None:
+        self.block_size = block_size
+        self.size = size
+        self.weak = weak
+        self.strong = strong
+
+    def pack(self) -> bytes:
+        records = b"".join(struct.pack(Options.DELTA_BLOCK_SIGNATURE, int(w), s) for w, s in zip(self.weak, self.strong))
+        return struct.pack(Options.DELTA_SIGNATURE_HEADER, self.block_size, self.size) + records
+
+    @staticmethod
+    def unpack(data: bytes) -> 'Signature':
+        block_size, size = struct.unpack_from(Options.DELTA_SIGNATURE_HEADER, data)
+        offset = struct.calcsize(Options.DELTA_SIGNATURE_HEADER)
+        records = list(struct.iter_unpack(Options.DELTA_BLOCK_SIGNATURE, memoryview(data)[offset:]))
+        if block_size == 0 or len(records) != -(-size // block_size):
+            raise ValueError("Signature doesn't match its header")
+
+        return Signature(block_size, size, np.array([w for w, _ in records], dtype=np.uint32), [s for _, s in records])
+
+    @staticmethod
+    def of_file(path: str, block_size: int = Options.DELTA_BLOCK_SIZE) -> 'Signature':
+        size = os.path.getsize(path)
+        segment = max(1, Options.DELTA_SEGMENT_SIZE // block_size) * block_size
+        weak: list[np.ndarray] = []
+        strong: list[bytes] = []
+
+        with open(path, 'rb') as f:
+            while data := f.read(segment):
+                full = len(data) - len(data) % block_size
+                blocks = np.frombuffer(data, dtype=np.uint8, count=full).reshape(-1, block_size)
+                weak.append(block_checksums(blocks))
+                if full < len(data):
+                    weak.append(block_checksums(np.frombuffer(data, dtype=np.uint8, offset=full).reshape(1, -1)))
+
+                view = memoryview(data)
+                strong.extend(strong_hash(view[i:i+block_size]) for i in range(0, len(data), block_size))
+
+        return Signature(block_size, size, np.concatenate(weak) if weak else np.zeros(0, dtype=np.uint32), strong)
+
+class SignatureCache:
+    # Signatures of unchanged files are reused, a file counts as changed once its mtime or size differ
+    def __init__(self, max_size: int = Options.DELTA_SIGNATURE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.signatures: OrderedDict[tuple[str, int, int, int], bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str, block_size: int = Options.DELTA_BLOCK_SIZE) -> bytes:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, block_size)
+        with self.lock:
+            packed = self.signatures.get(key)
+            if packed is not None:
+                self.signatures.move_to_end(key)
+                return packed
+
+        packed = Signature.of_file(path, block_size).pack()
+        with self.lock:
+            self.signatures[key] = packed
+            while len(self.signatures) > self.max_size:
+                self.signatures.popitem(last=False)
+        return packed
+
+def encode_delta(path: str, signature: Signature) -> Iterator[bytes]:
+    # Yields encoded ops that rebuild the file at path out of the file the signature was made of
+    block_size = signature.block_size
+    size = os.path.getsize(path)
+    full_blocks = signature.size // block_size
+    blocks: dict[int, dict[bytes, int]] = {}
+    for index in range(full_blocks):
+        blocks.setdefault(int(signature.weak[index]), {}).setdefault(signature.strong[index], index)
+    # Positions are filtered through a table indexed by the checksum's low bits before looking at the dict
+    known = np.zeros(1 << 24, dtype=bool)
+    known[np.array(list(blocks), dtype=np.uint32) & 0xffffff] = True
+
+    with open(path, 'rb') as f, open(path, 'rb') as literal_f:
+        def literal(start: int, end: int) -> Iterator[bytes]:
+            literal_f.seek(start)
+            while start < end:
+                data = literal_f.read(min(end - start, Options.DELTA_MAX_LITERAL))
+                start += len(data)
+                yield struct.pack(Options.DELTA_LITERAL, DeltaOp.Literal.value, len(data)) + data
+
+        # pos is where the next op starts, copy holds a run of matched blocks that may still grow
+        pos = 0
+        copy: list[int] | None = None
+        last_position = size - block_size
+        for start in range(0, last_position + 1 if full_blocks else 0, Options.DELTA_SEGMENT_SIZE):
+            count = min(Options.DELTA_SEGMENT_SIZE, last_position + 1 - start)
+            f.seek(start)
+            data = f.read(count + block_size - 1)
+            array = np.frombuffer(data, dtype=np.uint8)
+            weak = rolling_checksums(array, block_size)
+
+            for local in np.flatnonzero(known[weak & 0xffffff]):
+                position = start + int(local)
+                if position < pos: continue
+
+                candidates = blocks.get(int(weak[local]))
+                if candidates is None: continue
+                index = candidates.get(strong_hash(data[local:local+block_size]))
+                if index is None: continue
+
+                if copy is not None and position == pos and copy[0] + copy[1] == index * block_size:
+                    copy[1] += block_size
+                else:
+                    if copy is not None:
+                        yield struct.pack(Options.DELTA_COPY, DeltaOp.Copy.value, *copy)
+                        copy = None
+                    yield from literal(pos, position)
+                    copy = [index * block_size, block_size]
+                pos = position + block_size
+
+        # The old file's last block can be shorter than the others and only ever matches at the very end
+        tail = signature.size - full_blocks * block_size
+        tail_matches = False
+        if tail and size - pos == tail:
+            f.seek(pos)
+            tail_matches = strong_hash(f.read(tail)) == signature.strong[-1]
+
+        if tail_matches and copy is not None and copy[0] + copy[1] == full_blocks * block_size:
+            copy[1] += tail
+        else:
+            if copy is not None:
+                yield struct.pack(Options.DELTA_COPY, DeltaOp.Copy.value, *copy)
+            copy = [full_blocks * block_size, tail] if tail_matches else None
+            if copy is None:
+                yield from literal(pos, size)
+
+        if copy is not None:
+            yield struct.pack(Options.DELTA_COPY, DeltaOp.Copy.value, *copy)
+
+    yield struct.pack("<B", DeltaOp.End.value)
+
+def delta_frames(path: str, signature: Signature) -> Iterator[bytearray]:
+    # Groups ops into frames of about Options.DELTA_FRAME_SIZE, ops are never split between frames
+    frame = bytearray()
+    for op in encode_delta(path, signature):
+        frame += op
+        if len(frame) >= Options.DELTA_FRAME_SIZE:
+            yield frame
+            frame = bytearray()
+    if frame: yield frame
+
+class DeltaPatch:
+    def __init__(self, path: str) -> None:
+        # The new version is built next to the old one, which stays readable for copies until the end
+        self.path = path
+        self.temp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        self.basis = open(path, 'rb') if os.path.exists(path) else None
+        self.out = open(self.temp_path, 'wb')
+
+    def apply(self, ops: bytes) -> bool:
+        # Applies one frame of ops, returns True once the End op was applied
+        view = memoryview(ops)
+        offset = 0
+        copy_size = struct.calcsize(Options.DELTA_COPY)
+        literal_size = struct.calcsize(Options.DELTA_LITERAL)
+        while offset < len(view):
+            op = DeltaOp(view[offset])
+            if op == DeltaOp.End:
+                self.finish()
+                return True
+
+            if op == DeltaOp.Copy:
+                _, start, length = struct.unpack_from(Options.DELTA_COPY, view, offset)
+                offset += copy_size
+                self.__copy(start, length)
+            else:
+                _, length = struct.unpack_from(Options.DELTA_LITERAL, view, offset)
+                offset += literal_size
+                if offset + length > len(view): raise ValueError("Literal runs past the end of the frame")
+                self.out.write(view[offset:offset+length])
+                offset += length
+        return False
+
+    def __copy(self, start: int, length: int):
+        if self.basis is None: raise ValueError("Copy without an old version of the file")
+        self.basis.seek(start)
+        while length:
+            data = self.basis.read(min(length, Options.DELTA_MAX_LITERAL))
+            if not data: raise ValueError("Copy runs past the end of the old file")
+            length -= len(data)
+            self.out.write(data)
+
+    def finish(self):
+        self.close()
+        os.replace(self.temp_path, self.path)
+
+    def close(self):
+        if self.basis is not None: self.basis.close()
+        self.out.close()
+
+    def discard(self):
+        self.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+class DeltaPatches:
+    def __init__(self) -> None:
+        self.patches: dict[tuple[Connection, bytes], DeltaPatch] = {}
+        self.lock = threading.Lock()
+
+    def apply(self, key: tuple[Connection, bytes], path: str, ops: bytes) -> bool:
+        # Frames of one upload share a transaction id and are therefore applied in order
+        with self.lock:
+            patch = self.patches.get(key)
+            if patch is None:
+                patch = self.patches[key] = DeltaPatch(path)
+
+        try:
+            done = patch.apply(ops)
+        except (ValueError, OSError, struct.error):
+            self.discard(key)
+            raise
+
+        if done:
+            with self.lock:
+                self.patches.pop(key, None)
+        return done
+
+    def discard(self, key: tuple[Connection, bytes]):
+        with self.lock:
+            patch = self.patches.pop(key, None)
+        if patch is not None: patch.discard()
+
+    def drop(self, conn: Connection):
+        with self.lock:
+            keys = [key for key in self.patches if key[0] == conn]
+        for key in keys:
+            self.discard(key)
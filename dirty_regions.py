@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+
+from constants import Options
+
+class DirtyRegionDetector:
+    # Compares a downscaled grayscale copy of every frame against the last one it reported, tile by tile.
+    # Tiles only take the new content once they are reported dirty, so slow fades still add up past the threshold
+    def __init__(self, tile_size: int = Options.SCREEN_TILE_SIZE, detection_scale: int = Options.SCREEN_DETECTION_SCALE, threshold: int = Options.SCREEN_CHANGE_DETECTION_THRESHOLD) -> None:
+        self.detection_scale = detection_scale
+        self.small_tile = max(1, tile_size // detection_scale)
+        self.tile_size = self.small_tile * detection_scale
+        self.threshold = threshold
+        self.previous = None
+        self.frame_shape = None
+
+    def update(self, frame: np.ndarray) -> np.ndarray | None:
+        # Gives the (rows, columns) mask of changed tiles, None when nothing changed
+        height, width = frame.shape[:2]
+        small_size = (max(1, width // self.detection_scale), max(1, height // self.detection_scale))
+        # Gray first, area averaging a single channel is the expensive part
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), small_size, interpolation=cv2.INTER_AREA)
+
+        rows = -(-small.shape[0] // self.small_tile)
+        columns = -(-small.shape[1] // self.small_tile)
+        if self.previous is None or self.frame_shape != frame.shape:
+            self.previous = small
+            self.frame_shape = frame.shape
+            return np.ones((rows, columns), dtype=bool)
+
+        diff = cv2.absdiff(small, self.previous)
+        # Pad to whole tiles so the reduction is a single reshape
+        padded = np.zeros((rows * self.small_tile, columns * self.small_tile), dtype=np.uint8)
+        padded[:diff.shape[0], :diff.shape[1]] = diff
+        mask = padded.reshape(rows, self.small_tile, columns, self.small_tile).max(axis=(1, 3)) > self.threshold
+        if not mask.any():
+            return None
+
+        pixels = np.repeat(np.repeat(mask, self.small_tile, axis=0), self.small_tile, axis=1)[:small.shape[0], :small.shape[1]]
+        np.copyto(self.previous, small, where=pixels)
+        return mask
+
+    def regions(self, mask: np.ndarray, width: int, height: int, max_area: int = Options.MAX_REGION_AREA) -> list[tuple[int, int, int, int]]:
+        # Dirty tiles as (x, y, width, height) rectangles in a width x height frame (the frame is scaled to it).
+        # Runs of tiles on a row are stacked with identical runs on the rows below while they stay under max_area
+        scale_x = width / (self.frame_shape[1] if self.frame_shape else width)
+        scale_y = height / (self.frame_shape[0] if self.frame_shape else height)
+        tile_w = self.tile_size * scale_x
+        tile_h = self.tile_size * scale_y
+        max_tiles = max(1, int(max_area // max(1.0, tile_w * tile_h)))
+
+        open_runs: dict[tuple[int, int], int] = {}
+        finished = []
+        for row in range(mask.shape[0]):
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], mask[row].view(np.int8), [0]))))
+            runs = []
+            for start, end in zip(edges[::2], edges[1::2]):
+                # A run wider than the area cap is split up on its own
+                step = min(end - start, max_tiles)
+                runs += [(int(s), int(min(s + step, end))) for s in range(start, end, step)]
+
+            next_runs = {}
+            for run in runs:
+                top = open_runs.pop(run, None)
+                if top is not None and (row - top + 1) * (run[1] - run[0]) <= max_tiles:
+                    next_runs[run] = top
+                else:
+                    if top is not None: finished.append((run, top, row))
+                    next_runs[run] = row
+            finished += [(run, top, row) for run, top in open_runs.items()]
+            open_runs = next_runs
+        finished += [(run, top, mask.shape[0]) for run, top in open_runs.items()]
+
+        regions = []
+        for (start, end), top, bottom in finished:
+            x, y = round(start * tile_w), round(top * tile_h)
+            regions.append((x, y, min(width, round(end * tile_w)) - x, min(height, round(bottom * tile_h)) - y))
+        return regions
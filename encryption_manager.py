@@ -1,8 +1,16 @@
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import AES, ChaCha20_Poly1305, PKCS1_OAEP
 from Crypto.Random import get_random_bytes
-from Crypto.PublicKey import RSA
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Hash import SHA256
 
-from constants import Options
+from constants import CipherSuite, CompressionCodec, Options
+from collections import OrderedDict
+import itertools
+import threading
+import queue
+import time
 import base64
 
 class Key:
@@ -19,23 +27,144 @@ class Key:
     def get_key(self):
         return self.key
 
+class RSAKeyPool:
+    def __init__(self, size: int = Options.RSA_KEY_POOL_SIZE) -> None:
+        self.size = size
+        self.keys: queue.Queue[tuple[Key, Key]] = queue.Queue(maxsize=max(size, 1))
+        self.worker = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def generate():
+        k = RSA.generate(Options.RSA_KEY_SIZE)
+        return Key(k), Key(k.publickey())
+
+    def __refill(self):
+        # put() blocks while the pool is full, so this only wakes up once a key was taken
+        while True:
+            self.keys.put(RSAKeyPool.generate())
+
+    def start(self):
+        if self.size <= 0: return
+        with self.lock:
+            if self.worker is not None: return
+            self.worker = threading.Thread(target=self.__refill, daemon=True)
+            self.worker.start()
+
+    def get(self) -> tuple[Key, Key]:
+        self.start()
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return RSAKeyPool.generate()
+
+
+class SessionTicketStore:
+    def __init__(self, max_size: int = Options.SESSION_TICKET_CACHE_SIZE, lifetime: int = Options.SESSION_TICKET_LIFETIME) -> None:
+        self.max_size = max_size
+        self.lifetime = lifetime
+        self.tickets: OrderedDict[bytes, tuple[bytes, CipherSuite, CompressionCodec | None, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def issue(self, sym_key: bytes, suite: CipherSuite, codec: CompressionCodec | None = None) -> bytes:
+        ticket = get_random_bytes(Options.SESSION_TICKET_SIZE)
+        resumption_secret = Encryption.derive_key(sym_key, ticket, b"resumption")
+        now = time.monotonic()
+
+        with self.lock:
+            # Every ticket lives for the same time, so the oldest ones are always the first to expire
+            while self.tickets and next(iter(self.tickets.values()))[3] <= now:
+                self.tickets.popitem(last=False)
+            while len(self.tickets) >= self.max_size:
+                self.tickets.popitem(last=False)
+            self.tickets[ticket] = (resumption_secret, suite, codec, now + self.lifetime)
+
+        return ticket
+
+    def redeem(self, ticket: bytes) -> tuple[bytes, CipherSuite, CompressionCodec | None] | None:
+        # Tickets are single use, a resumed session gets a fresh one
+        with self.lock:
+            session = self.tickets.pop(ticket, None)
+
+        if session is None: return None
+        resumption_secret, suite, codec, expires_at = session
+        if expires_at <= time.monotonic(): return None
+        return resumption_secret, suite, codec
 
 class Encryption:
+    key_pool = RSAKeyPool()
+    ticket_store = SessionTicketStore()
 
     def __init__(self) -> None:
         self.sym_key = None
+        self.suite = CipherSuite.AES_EAX
+        self.nonce_prefix = b""
+        self.nonce_counter = itertools.count()
+        self.local = threading.local()
 
-    def __aes_encrypt(self, data: bytes):
-        nonce = get_random_bytes(Options.NONCE_SIZE)
-        cipher = AES.new(self.sym_key, AES.MODE_EAX, nonce=nonce, mac_len=Options.TAG_SIZE)
-        ciphertext, tag = cipher.encrypt_and_digest(data)
-        return [nonce, tag, ciphertext]
+    @staticmethod
+    def choose_suite(offered: bytes, key_size: int) -> CipherSuite:
+        for suite in Options.CIPHER_SUITES:
+            if suite.value not in offered: continue
+            if suite == CipherSuite.CHACHA20_POLY1305 and key_size != 32: continue
+            return suite
+        return CipherSuite.AES_EAX
+
+    @staticmethod
+    def derive_key(secret: bytes, salt: bytes, context: bytes) -> bytes:
+        return HKDF(secret, Options.ECDH_SECRET_SIZE, salt, SHA256, context=context)
+
+    def nonce_size(self) -> int:
+        return Options.NONCE_SIZE if self.suite == CipherSuite.AES_EAX else Options.AEAD_NONCE_SIZE
+
+    def __reset_nonces(self):
+        # Nonces are a per-key prefix plus a counter. The top bit marks them as sent by the server,
+        # so they can't collide with the client's nonces under the same key
+        prefix = bytearray(get_random_bytes(self.nonce_size() - Options.NONCE_COUNTER_SIZE))
+        prefix[0] |= 0x80
+        self.nonce_prefix = bytes(prefix)
+        self.nonce_counter = itertools.count()
+
+    def __next_nonce(self) -> bytes:
+        return self.nonce_prefix + next(self.nonce_counter).to_bytes(Options.NONCE_COUNTER_SIZE, 'big')
+
+    def __new_cipher(self, nonce: bytes):
+        match self.suite:
+            case CipherSuite.AES_GCM:
+                return AES.new(self.sym_key, AES.MODE_GCM, nonce=nonce, mac_len=Options.TAG_SIZE)
+            case CipherSuite.CHACHA20_POLY1305:
+                return ChaCha20_Poly1305.new(key=self.sym_key, nonce=nonce)
+            case _:
+                return AES.new(self.sym_key, AES.MODE_EAX, nonce=nonce, mac_len=Options.TAG_SIZE)
+
+    def __output_buffer(self, size: int) -> memoryview:
+        # One buffer per thread since screen control threads share the same manager
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(max(size, Options.CHUNK_SIZE))
+            self.local.buffer = buffer
+        return memoryview(buffer)[:size]
+
+    def aes_net_encrypt_parts(self, parts: list, reuse = True) -> list:
+        # With reuse=True the ciphertext lives in this thread's buffer until its next encryption
+        nonce = self.__next_nonce()
+        cipher = self.__new_cipher(nonce)
+
+        size = sum(len(part) for part in parts)
+        out = self.__output_buffer(size) if reuse else memoryview(bytearray(size))
+        offset = 0
+        for part in parts:
+            if not part: continue
+            cipher.encrypt(part, output=out[offset:offset+len(part)])
+            offset += len(part)
+
+        return [nonce, cipher.digest(), out]
     
     def aes_net_encrypt(self, data: bytes):
-        return b''.join(self.__aes_encrypt(data))
+        return b''.join(self.aes_net_encrypt_parts([data], reuse=False))
     
     def __aes_decrypt(self, nonce: bytes, tag: bytes, ciphertext: bytes):
-        cipher = AES.new(self.sym_key, AES.MODE_EAX, nonce=nonce, mac_len=Options.TAG_SIZE)
+        cipher = self.__new_cipher(nonce)
         try:
             data = cipher.decrypt_and_verify(ciphertext, tag)
             return data
@@ -43,19 +172,29 @@ class Encryption:
             return None
     
     def aes_net_decrypt(self, full: bytes):
-        if full is None or len(full) < Options.NONCE_SIZE + Options.TAG_SIZE:
+        nonce_size = self.nonce_size()
+        if full is None or len(full) < nonce_size + Options.TAG_SIZE:
             return None
-        nonce = full[:Options.NONCE_SIZE]
-        tag = full[Options.NONCE_SIZE:Options.NONCE_SIZE+Options.TAG_SIZE]
-        ciphertext = full[Options.NONCE_SIZE+Options.TAG_SIZE:]
+        nonce = full[:nonce_size]
+        tag = full[nonce_size:nonce_size+Options.TAG_SIZE]
+        ciphertext = full[nonce_size+Options.TAG_SIZE:]
         return self.__aes_decrypt(nonce, tag, ciphertext)
 
     def generate_rsa_keys(self):
-        k = RSA.generate(Options.RSA_KEY_SIZE)
-        return Key(k), Key(k.publickey())
+        return Encryption.key_pool.get()
+
+    def generate_ecdh_keys(self):
+        k = ECC.generate(curve=Options.ECDH_CURVE)
+        return Key(k), Key(k.public_key())
+
+    def ecdh_derive_secret(self, private_key: Key, peer_bytes: bytes, salt: bytes):
+        kdf = lambda shared: HKDF(shared, Options.ECDH_SECRET_SIZE, salt, SHA256)
+        return key_agreement(eph_priv=private_key.get_key(), eph_pub=ECC.import_key(peer_bytes), kdf=kdf)
     
-    def set_sym_key(self, key: bytes):
+    def set_sym_key(self, key: bytes, suite: CipherSuite = CipherSuite.AES_EAX):
         self.sym_key = key
+        self.suite = suite
+        self.__reset_nonces()
     
     def rsa_encrypt(self, key: Key, data: bytes):
         cipher = PKCS1_OAEP.new(key.get_key())
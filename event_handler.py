@@ -1,10 +1,7 @@
-import math
-import mss
-import random
-import string
 import pathlib
 from enum import Enum
 import os
+import re
 from utils import Connection, Events, NetworkUtils, Event
 import socket
 import pickle
@@ -12,6 +9,16 @@ import shutil
 from constants import Error, Options
 import pyautogui
 from screen_control import ScreenControl
+from file_transfer import DirectoryArchive, FileDownload, UploadSessions, parse_chunk_ranges
+from delta_sync import DeltaPatches, Signature, SignatureCache, delta_frames
+from file_listing import ListingCursors, send_listing_page
+from listing_cache import ListingCache
+from remote_search import Search, SearchFilter
+from bulk_operations import BulkOperations
+from command_runner import CommandProcess
+from shell_sessions import ShellSession
+import screenshots
+from concurrent.futures import as_completed
 import win32api
 import struct
 from terminal import Terminal
@@ -21,77 +28,280 @@ pyautogui.PAUSE = 0
 def send_event(conn: Connection, action: Events, data: list):
     conn.send([action.value, *data])
 
-def generate_random_file_name(ext):
-    length = 6
-    name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
-    return name + "." + ext
-
-def nukedir(dir):
-    if dir[-1] == os.sep: dir = dir[:-1]
-    files = os.listdir(dir)
-    for file in files:
-        if file == '.' or file == '..': continue
-        path = dir + os.sep + file
-        if os.path.isdir(path):
-            nukedir(path)
-        else:
-            os.unlink(path)
-    os.rmdir(dir)
+def resolve_requested_file(conn: Connection, event: Events, transaction_id: bytes, path_b: bytes) -> str | None:
+    path_str = path_b.decode(errors="replace")
+
+    try:
+        path = pathlib.Path(path_b.decode())
+        abs_path = str(path.resolve())
+    except Exception:
+        conn.send_failure(Error.BadPath, f"[{event.name}] Bad path: {path_str}", [event.value, transaction_id])
+        return None
+
+    if not path.exists():
+        conn.send_failure(Error.FileNotFound, f"[{event.name}] File not found: {abs_path}", [event.value, transaction_id])
+        return None
+
+    return abs_path
 
 class ScreenshotRequestEvent(Event):
 
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0] if data else None
+
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
         Terminal.debug("Received screenshot request event")
 
-        if not os.path.exists("screenshots/"):
-            os.mkdir(Options.SCREENSHOTS_FOLDER)
-
-        with mss.mss(with_cursor=True) as sct:
-            fn = generate_random_file_name("png")
-            path = os.path.join(Options.SCREENSHOTS_FOLDER, fn)
-            sct.shot(output=path)
-            abs_path = str(pathlib.Path(path).resolve())
-
+        # Without any data the screenshot is saved as a PNG and only its path is sent back (SDON)
+        if not data:
+            abs_path = screenshots.save(screenshots.encode(screenshots.capture(), "png", Options.SCREENSHOT_QUALITY), "png")
             conn.send_event(Events.ScreenshotDone_Response, [abs_path])
             conn.send_success(f"[{Events.Screenshot_Request.name}] Screenshot saved to {abs_path}")
+            return
+
+        # [tid, (format: png / jpeg / webp), (quality), (scale), (region "x,y,width,height"), (save: 1)],
+        # answered with SSIM [tid, format, width, height, saved path or empty, image]. A region partly off the monitor is cropped to it
+        transaction_id = data[0]
+        field = lambda i: data[i].decode() if len(data) > i and data[i] else None
+        try:
+            image_format = (field(1) or Options.SCREENSHOT_FORMAT).lower().replace("jpg", "jpeg")
+            quality = int(field(2) or Options.SCREENSHOT_QUALITY)
+            scale = float(field(3) or 1.0)
+            region = tuple(int(v) for v in field(4).split(",")) if field(4) else None
+            if image_format not in screenshots.EXTENSIONS or not 0 <= quality <= 100 or not 0 < scale <= 4: raise ValueError()
+            if region is not None and (len(region) != 4 or min(region[2:]) <= 0): raise ValueError()
+        except ValueError:
+            conn.send_failure(Error.BadRange, f"[{Events.Screenshot_Request.name}] Bad screenshot options", [Events.Screenshot_Request.value, transaction_id])
+            return
+
+        try:
+            frame = screenshots.capture(region, scale)
+            image = screenshots.encode(frame, image_format, quality)
+        except ValueError as e:
+            conn.send_failure(Error.BadRange, f"[{Events.Screenshot_Request.name}] {e}", [Events.Screenshot_Request.value, transaction_id])
+            return
+        abs_path = screenshots.save(image, image_format) if field(5) == "1" else ""
+
+        conn.send_event(Events.ScreenshotImage_Response, [transaction_id, image_format, str(frame.shape[1]), str(frame.shape[0]), abs_path, image])
+        conn.send_success(f"[{Events.Screenshot_Request.name}] Sent {frame.shape[1]}x{frame.shape[0]} {image_format} screenshot ({len(image)} bytes) | TID: {transaction_id}")
 
 class FileRequestEvent(Event):
 
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
         Terminal.debug("Received file request event")
 
+        # [tid, path, (offset), (length)], offset and length are ASCII decimal byte counts.
+        # offset has to be a multiple of CHUNK_SIZE: DNCK chunks keep their index counted from the start of the file
+        # (chunk n covers the CHUNK_SIZE units up to byte n * CHUNK_SIZE), so every chunk starts on a unit boundary
         transaction_id = data[0]
-        path_b = data[1]
-        path_str = path_b.decode()
-        path = None
-        abs_path = None
-        
-        try:
-            path = pathlib.Path(path_str)
-            abs_path = str(path.resolve())
-        except Exception:
-            conn.send_failure(Error.BadPath, f"[{Events.FileContent_Request.name}] Bad path: {path_str}", [Events.FileContent_Request.value, transaction_id])
-            return
-        
-        if not path.exists():
-            conn.send_failure(Error.FileNotFound, f"[{Events.FileContent_Request.name}] File not found: {abs_path}", [Events.FileContent_Request.value, transaction_id])
+        abs_path = resolve_requested_file(conn, Events.FileContent_Request, transaction_id, data[1])
+        if abs_path is None: return
+
+        fsize_bytes = os.path.getsize(abs_path)
+        try:
+            offset = int(data[2]) if len(data) > 2 and data[2] else 0
+            length = int(data[3]) if len(data) > 3 and data[3] else fsize_bytes - offset
+            if offset < 0 or length < 0 or offset > fsize_bytes or offset % Options.CHUNK_SIZE: raise ValueError()
+        except ValueError:
+            conn.send_failure(Error.BadRange, f"[{Events.FileContent_Request.name}] Bad range for {abs_path}", [Events.FileContent_Request.value, transaction_id])
             return
-        
+
+        if fsize_bytes == 0: return
+        FileDownload(conn, transaction_id, abs_path, fsize_bytes, [(offset, offset + length)]).run()
+
+        conn.send_success(f"[{Events.FileContent_Request.name}] File sent: {abs_path} | TID: {transaction_id}")
+
+class FileChunksRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received file chunks request event")
+
+        # [tid, path, chunk numbers like "1-5,9"], numbered the same way as DNCK chunks
+        transaction_id = data[0]
+        abs_path = resolve_requested_file(conn, Events.FileChunks_Request, transaction_id, data[1])
+        if abs_path is None: return
+
         fsize_bytes = os.path.getsize(abs_path)
-        chunks_num = math.ceil(fsize_bytes / Options.CHUNK_SIZE)
-        if chunks_num == 0: return
-        with open(abs_path, 'rb') as f:
-            for i in range(chunks_num):
-                file_d = f.read(Options.CHUNK_SIZE)
-                if file_d:
-                    conn.send_event(Events.FileChunkDownload_Response, [transaction_id, i+1, chunks_num, file_d])
-                Terminal.debug(f"Sent chunk {i+1}/{chunks_num} of {abs_path} | TID: {transaction_id}")
-        
-        conn.send_success(f"[{Events.FileContent_Request.name}] File sent: {abs_path} | TID: {transaction_id}")        
+        try:
+            ranges = parse_chunk_ranges(data[2].decode(), fsize_bytes)
+        except (ValueError, IndexError):
+            conn.send_failure(Error.BadRange, f"[{Events.FileChunks_Request.name}] Bad chunk list for {abs_path}", [Events.FileChunks_Request.value, transaction_id])
+            return
+
+        FileDownload(conn, transaction_id, abs_path, fsize_bytes, ranges).run()
+        conn.send_success(f"[{Events.FileChunks_Request.name}] Sent {len(ranges)} chunk ranges of {abs_path} | TID: {transaction_id}")        
+
+class DirectoryArchiveRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received directory archive request event")
+
+        transaction_id = data[0]
+        abs_path = resolve_requested_file(conn, Events.DirectoryArchive_Request, transaction_id, data[1])
+        if abs_path is None: return
+
+        if not os.path.isdir(abs_path):
+            conn.send_failure(Error.BadPath, f"[{Events.DirectoryArchive_Request.name}] Not a directory: {abs_path}", [Events.DirectoryArchive_Request.value, transaction_id])
+            return
+
+        entries = DirectoryArchive(conn, transaction_id, abs_path).run()
+        conn.send_success(f"[{Events.DirectoryArchive_Request.name}] Sent {entries} entries of {abs_path} | TID: {transaction_id}")
+
+class DeltaSignatureRequestEvent(Event):
+    signatures = SignatureCache()
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received delta signature request event")
+
+        # [tid, path, (block size)], the client answers with a DUPL delta against this signature
+        transaction_id = data[0]
+        abs_path = resolve_requested_file(conn, Events.DeltaSignature_Request, transaction_id, data[1])
+        if abs_path is None: return
+
+        try:
+            block_size = int(data[2]) if len(data) > 2 and data[2] else Options.DELTA_BLOCK_SIZE
+            if block_size <= 0: raise ValueError()
+        except ValueError:
+            conn.send_failure(Error.BadDelta, f"[{Events.DeltaSignature_Request.name}] Bad block size for {abs_path}", [Events.DeltaSignature_Request.value, transaction_id])
+            return
+
+        signature = DeltaSignatureRequestEvent.signatures.get(abs_path, block_size)
+        conn.send_event(Events.DeltaSignature_Response, [transaction_id, signature])
+        conn.send_success(f"[{Events.DeltaSignature_Request.name}] Sent signature of {abs_path} | TID: {transaction_id}")
+
+class DeltaDownloadRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0].split(Options.SEPERATOR, 1)[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received delta download request event")
+
+        # tid \0 path \0 signature of the client's copy
+        parts = data[0].split(Options.SEPERATOR, 2)
+        transaction_id = parts[0]
+        if len(parts) != 3:
+            conn.send_failure(Error.BadDelta, f"[{Events.DeltaDownload_Request.name}] Malformed request", [Events.DeltaDownload_Request.value, transaction_id])
+            return
+        _, path_b, signature_b = parts
+        abs_path = resolve_requested_file(conn, Events.DeltaDownload_Request, transaction_id, path_b)
+        if abs_path is None: return
+
+        try:
+            signature = Signature.unpack(signature_b)
+        except (ValueError, struct.error):
+            conn.send_failure(Error.BadDelta, f"[{Events.DeltaDownload_Request.name}] Bad signature for {abs_path}", [Events.DeltaDownload_Request.value, transaction_id])
+            return
+
+        sent = 0
+        for frame in delta_frames(abs_path, signature):
+            conn.send_event(Events.DeltaDownload_Response, [transaction_id, frame])
+            sent += len(frame)
+        conn.send_success(f"[{Events.DeltaDownload_Request.name}] Sent delta of {abs_path} ({sent} bytes) | TID: {transaction_id}")
+
+class DeltaUploadEvent(Event):
+    patches = DeltaPatches()
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0].split(Options.SEPERATOR, 1)[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        # tid \0 path \0 ops, a delta against the signature from DSRQ, possibly spread over several frames
+        parts = data[0].split(Options.SEPERATOR, 2)
+        transaction_id = parts[0]
+        out_file = parts[1].decode(errors="replace") if len(parts) > 1 else ""
+
+        try:
+            if len(parts) != 3: raise ValueError("Malformed delta")
+            _, path_b, ops = parts
+            done = DeltaUploadEvent.patches.apply((conn, transaction_id), path_b.decode(), ops)
+        except (ValueError, OSError, struct.error) as e:
+            conn.send_failure(Error.BadDelta, f"[{Events.DeltaUpload_Action.name}] Couldn't apply delta to {out_file}: {e}", [Events.DeltaUpload_Action.value, transaction_id])
+            return
+
+        if done:
+            conn.send_success(f"[{Events.DeltaUpload_Action.name}] Patched file: {out_file} | TID: {transaction_id}")
+
+class DirectoryListingRequestEvent(Event):
+    cursors = ListingCursors()
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received directory listing request event")
+
+        # [tid, path, (cursor), (page size)], the path is ignored when continuing from a cursor.
+        # Entries come in DLST batches, a DLND [tid, next cursor (empty once done), entries sent] ends the page
+        transaction_id = data[0]
+        cursor = data[2] if len(data) > 2 else b""
+        try:
+            page_size = int(data[3]) if len(data) > 3 and data[3] else Options.LISTING_PAGE_SIZE
+            if page_size < 0: raise ValueError()
+        except ValueError:
+            conn.send_failure(Error.BadRange, f"[{Events.DirectoryListing_Request.name}] Bad page size", [Events.DirectoryListing_Request.value, transaction_id])
+            return
+
+        if cursor:
+            found = DirectoryListingRequestEvent.cursors.take(conn, cursor)
+            if found is None:
+                conn.send_failure(Error.BadCursor, f"[{Events.DirectoryListing_Request.name}] Unknown or expired cursor", [Events.DirectoryListing_Request.value, transaction_id])
+                return
+            entries, abs_path = found
+        else:
+            abs_path = resolve_requested_file(conn, Events.DirectoryListing_Request, transaction_id, data[1])
+            if abs_path is None: return
+            try:
+                entries = os.scandir(abs_path)
+            except OSError:
+                conn.send_failure(Error.BadPath, f"[{Events.DirectoryListing_Request.name}] Can't list {abs_path}", [Events.DirectoryListing_Request.value, transaction_id])
+                return
+
+        try:
+            sent, exhausted = send_listing_page(conn, transaction_id, entries, page_size)
+        except Exception:
+            entries.close()
+            raise
+
+        next_cursor = b""
+        if exhausted:
+            entries.close()
+        else:
+            next_cursor = DirectoryListingRequestEvent.cursors.put(conn, entries, abs_path)
+
+        conn.send_event(Events.DirectoryListingEnd_Response, [transaction_id, next_cursor, str(sent)])
+        conn.send_success(f"[{Events.DirectoryListing_Request.name}] Sent {sent} entries of {abs_path} | TID: {transaction_id}")
 
 class FileListRequestEvent(Event):
+    cache = ListingCache()
 
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
@@ -99,13 +309,72 @@ class FileListRequestEvent(Event):
 
         try:
             relative = data[0].decode()
-            files = [str(f) for f in pathlib.Path(relative).iterdir()]
+            base = pathlib.Path(relative)
+            abs_path = str(base.resolve())
+
+            names, version = FileListRequestEvent.cache.get(abs_path)
+            cached = names is not None
+            if not cached:
+                mtime_ns = os.stat(abs_path).st_mtime_ns
+                names = tuple(os.listdir(abs_path))
+                FileListRequestEvent.cache.put(abs_path, names, version, mtime_ns)
+
+            files = [str(base / name) for name in names]
             serialized = pickle.dumps(files)
             conn.send_event(Events.FileList_Response, [serialized])
-            conn.send_success(f"[{Events.FileList_Request.name}] Sent file list of {relative} ({len(files)} items)")
-        except FileNotFoundError:
+            conn.send_success(f"[{Events.FileList_Request.name}] Sent file list of {relative} ({len(files)} items{', cached' if cached else ''})")
+        except (FileNotFoundError, NotADirectoryError):
             conn.send_failure(Error.BadPath, f"[{Events.FileList_Request.name}] Bad path: {relative}")
 
+class SearchRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received search request event")
+
+        # [tid, root, "key=value" filters...], see SearchFilter for the keys plus "limit".
+        # Matches come in SRCH batches of listing records named relative to the root, a SRND [tid, matches, status] ends the search
+        transaction_id = data[0]
+        abs_path = resolve_requested_file(conn, Events.Search_Request, transaction_id, data[1])
+        if abs_path is None: return
+
+        try:
+            options = dict(part.decode().split("=", 1) for part in data[2:] if part)
+            limit = min(int(options.pop("limit", Options.SEARCH_MAX_RESULTS)), Options.SEARCH_MAX_RESULTS)
+            search_filter = SearchFilter(options)
+            if limit <= 0: raise ValueError()
+        except (ValueError, KeyError, re.error):
+            conn.send_failure(Error.BadRange, f"[{Events.Search_Request.name}] Bad search filters", [Events.Search_Request.value, transaction_id])
+            return
+
+        found, status = Search(conn, transaction_id, abs_path, search_filter, limit).run()
+        conn.send_event(Events.SearchEnd_Response, [transaction_id, str(found), status])
+        conn.send_success(f"[{Events.Search_Request.name}] Search in {abs_path} {status}, {found} matches | TID: {transaction_id}")
+
+class SearchCancelEvent(Event):
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        # Runs outside the search's transaction, otherwise it would only be handled once the search ended
+        transaction_id = data[0]
+        if Search.cancel_running(conn, transaction_id):
+            Terminal.debug(f"Cancelling search | TID: {transaction_id}")
+
+class ListingCacheStatsRequestEvent(Event):
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received listing cache stats request event")
+
+        # [hits, misses, invalidations, evictions, entries, bytes, inotify watches] as ASCII decimals
+        stats = FileListRequestEvent.cache.stats()
+        conn.send_event(Events.ListingCacheStats_Response, [str(value) for value in stats.values()])
+        conn.send_success(f"[{Events.ListingCacheStats_Request.name}] Listing cache: " + ", ".join(f"{name} {value}" for name, value in stats.items()))
+
 class FileCopyRequestEvent(Event):
 
     @staticmethod
@@ -135,36 +404,233 @@ class FileMoveRequestEvent(Event):
         except FileNotFoundError:
             conn.send_failure(Error.BadPath, f"[{Events.MoveFile_Request.name}] Bad path: {pathA} / {pathB}")            
 
+class BulkOperationRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received bulk operation request event")
+
+        # [tid, op, src, dst, op, src, dst...] with op being copy, move or remove (dst left empty).
+        # Items are independent and run in parallel, each one is reported with a BOPR [tid, index, "ok" / "failed", error]
+        transaction_id, items = data[0], data[1:]
+        if len(items) % 3:
+            conn.send_failure(Error.BadRange, f"[{Events.BulkOperation_Request.name}] Items must be (op, src, dst) triples", [Events.BulkOperation_Request.value, transaction_id])
+            return
+
+        # Everything is decoded before the first item starts, a bad item fails the whole batch instead of half of it
+        try:
+            decoded = [part.decode() for part in items]
+        except UnicodeDecodeError:
+            conn.send_failure(Error.BadPath, f"[{Events.BulkOperation_Request.name}] Paths must be UTF-8", [Events.BulkOperation_Request.value, transaction_id])
+            return
+
+        futures = {}
+        for index in range(len(items) // 3):
+            op, src, dst = decoded[index*3:index*3+3]
+            futures[BulkOperations.item_pool.submit(BulkOperations.run_item, op, src, dst)] = index
+
+        failed = 0
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is not None: failed += 1
+            status = ["ok", ""] if error is None else ["failed", str(error)]
+            conn.send_event(Events.BulkOperationProgress_Response, [transaction_id, str(futures[future]), *status])
+
+        conn.send_success(f"[{Events.BulkOperation_Request.name}] Ran {len(futures)} operations, {failed} failed | TID: {transaction_id}")
+
 class FileChunkUploadEvent(Event):
+    sessions = UploadSessions()
     name_to_chunk_count: dict[str, int] = {}
 
     @staticmethod
-    def handle(data: list[bytes], conn: Connection):
+    def is_legacy(parts: list[bytes]) -> bool:
+        # The old path \0 total chunks \0 chunk frame has no ASCII index and size fields,
+        # a negative size still counts as the new layout so it gets rejected instead of appended somewhere
+        return len(parts) != 5 or not (parts[2].isdigit() and parts[3].removeprefix(b"-").isdigit())
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        parts = data[0].split(Options.SEPERATOR, 4)
+        return None if FileChunkUploadEvent.is_legacy(parts) else parts[0]
+
+    @staticmethod
+    def handle_legacy(data: list[bytes], conn: Connection):
+        # Chunks are appended in the order they arrive, the upload is done after total chunks of them
         parts = data[0].split(Options.SEPERATOR, 2)
-        out_file: str = parts[0].decode()
+        if len(parts) != 3:
+            conn.send_failure(Error.BadRange, f"[{Events.FileChunkUpload_Action.name}] Malformed chunk")
+            return
+        out_file = parts[0].decode(errors="replace")
         total_chunks = int.from_bytes(parts[1])
         chunk: bytes = parts[2]
 
         Terminal.debug(f"Received chunk {FileChunkUploadEvent.name_to_chunk_count.get(out_file, 0) + 1}/{total_chunks} of {out_file}")
 
-        with open(out_file, 'ab') as f:
-            f.write(chunk)
+        try:
+            with open(parts[0].decode(), 'ab') as f:
+                f.write(chunk)
+        except (OSError, ValueError) as e:
+            FileChunkUploadEvent.name_to_chunk_count.pop(out_file, None)
+            conn.send_failure(Error.BadPath, f"[{Events.FileChunkUpload_Action.name}] Couldn't write {out_file}: {e}")
+            return
 
         FileChunkUploadEvent.name_to_chunk_count[out_file] = FileChunkUploadEvent.name_to_chunk_count.get(out_file, 0) + 1
         if FileChunkUploadEvent.name_to_chunk_count[out_file] == total_chunks:
             conn.send_success(f"[{Events.FileChunkUpload_Action.name}] Downloaded file: {out_file} | {total_chunks} chunks")
             del FileChunkUploadEvent.name_to_chunk_count[out_file]
 
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        # tid \0 path \0 chunk index \0 file size \0 chunk, index and size are ASCII decimal.
+        # Chunks may arrive in any order and span several CHUNK_SIZE units, the index is the last unit
+        # the chunk contains the same way DNCK numbers them. Chunks that don't end the file must be whole CHUNK_SIZE units
+        # Frames in the old path \0 total chunks \0 chunk layout are still appended like before
+        parts = data[0].split(Options.SEPERATOR, 4)
+        if FileChunkUploadEvent.is_legacy(parts):
+            FileChunkUploadEvent.handle_legacy(data, conn)
+            return
+        transaction_id = parts[0]
+        out_file = parts[1].decode(errors="replace")
+
+        try:
+            _, _, index_b, size_b, chunk = parts
+            index, size = int(index_b), int(size_b)
+            session = FileChunkUploadEvent.sessions.get((conn, transaction_id), out_file, size)
+            Terminal.debug(f"Received chunk {index}/{session.total_chunks} of {out_file}")
+            done = FileChunkUploadEvent.sessions.write((conn, transaction_id), session, index, chunk)
+        except ValueError:
+            conn.send_failure(Error.BadRange, f"[{Events.FileChunkUpload_Action.name}] Bad chunk for {out_file}", [Events.FileChunkUpload_Action.value, transaction_id])
+            return
+        except OSError as e:
+            conn.send_failure(Error.BadPath, f"[{Events.FileChunkUpload_Action.name}] Couldn't write {out_file}: {e}", [Events.FileChunkUpload_Action.value, transaction_id])
+            return
+
+        if done:
+            conn.send_success(f"[{Events.FileChunkUpload_Action.name}] Downloaded file: {out_file} | {session.total_chunks} chunks")
+
 class CommandRunRequestEvent(Event):
 
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0] if len(data) > 1 else None
+
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
         Terminal.debug("Received command run request event")
 
-        command = data[0].decode()
-        out = os.popen(command).read()
-        conn.send_event(Events.CommandRun_Response, [out])
-        conn.send_success(f"[{Events.CommandRun_Request.name}] Ran command: {command}")
+        # [tid, command, (timeout seconds)], output comes as CMDO [tid, "out" / "err", chunk] while the command runs
+        # and a CMDE [tid, exit code / "timeout" / "cancelled"] ends it. This returns right away, the command keeps running.
+        # The old [command] form still runs to completion and answers with a single CMDO [stdout]
+        if not data:
+            conn.send_failure(Error.BadRange, f"[{Events.CommandRun_Request.name}] No command given")
+            return
+        if len(data) < 2:
+            command = data[0].decode()
+            out = os.popen(command).read()
+            conn.send_event(Events.CommandRun_Response, [out])
+            conn.send_success(f"[{Events.CommandRun_Request.name}] Ran command: {command}")
+            return
+
+        transaction_id = data[0]
+        command = data[1].decode()
+        try:
+            timeout = float(data[2]) if len(data) > 2 and data[2] else Options.COMMAND_TIMEOUT
+        except ValueError:
+            conn.send_failure(Error.BadRange, f"[{Events.CommandRun_Request.name}] Bad timeout", [Events.CommandRun_Request.value, transaction_id])
+            return
+
+        try:
+            started = CommandProcess.start(conn, transaction_id, command, timeout)
+        except OSError as e:
+            conn.send_failure(Error.UnknownError, f"[{Events.CommandRun_Request.name}] Couldn't start command {command}: {e}", [Events.CommandRun_Request.value, transaction_id])
+            return
+
+        if not started:
+            conn.send_failure(Error.TooManyCommands, f"[{Events.CommandRun_Request.name}] Too many commands running, couldn't start: {command}", [Events.CommandRun_Request.value, transaction_id])
+
+class CommandCancelEvent(Event):
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        transaction_id = data[0]
+        if CommandProcess.cancel(conn, transaction_id):
+            Terminal.debug(f"Cancelling command | TID: {transaction_id}")
+
+class ShellOpenRequestEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        Terminal.debug("Received shell open request event")
+
+        # [sid, (columns), (rows)], output comes as SHOT [sid, chunk] and a SHND [sid, exit code / "idle" / "closed"] ends the shell
+        session_id = data[0]
+        try:
+            columns = int(data[1]) if len(data) > 1 and data[1] else Options.SHELL_COLUMNS
+            rows = int(data[2]) if len(data) > 2 and data[2] else Options.SHELL_ROWS
+            started = ShellSession.open(conn, session_id, columns, rows)
+        except (ValueError, OSError, struct.error) as e:
+            conn.send_failure(Error.UnknownError, f"[{Events.ShellOpen_Request.name}] Couldn't open shell: {e}", [Events.ShellOpen_Request.value, session_id])
+            return
+
+        if not started:
+            conn.send_failure(Error.TooManyCommands, f"[{Events.ShellOpen_Request.name}] Too many shells open", [Events.ShellOpen_Request.value, session_id])
+            return
+        conn.send_success(f"[{Events.ShellOpen_Request.name}] Opened {ShellSession.shell()} | SID: {session_id}")
+
+class ShellInputEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0].split(Options.SEPERATOR, 1)[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        # sid \0 input, sent to the shell as is (keystrokes, pasted text or whole lines)
+        session_id, _, text = data[0].partition(Options.SEPERATOR)
+        session = ShellSession.get(conn, session_id)
+        if session is None:
+            conn.send_failure(Error.BadCursor, f"[{Events.ShellInput_Action.name}] Unknown shell | SID: {session_id}", [Events.ShellInput_Action.value, session_id])
+            return
+        if not session.write(text):
+            conn.send_failure(Error.BadCursor, f"[{Events.ShellInput_Action.name}] Shell isn't running | SID: {session_id}", [Events.ShellInput_Action.value, session_id])
+
+class ShellResizeEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        # [sid, columns, rows]
+        try:
+            columns, rows = int(data[1]), int(data[2])
+            if not (0 < columns < 65536 and 0 < rows < 65536): raise ValueError()
+        except (ValueError, IndexError):
+            conn.send_failure(Error.BadRange, f"[{Events.ShellResize_Action.name}] Bad terminal size", [Events.ShellResize_Action.value, data[0]])
+            return
+
+        session = ShellSession.get(conn, data[0])
+        if session is not None: session.resize(columns, rows)
+
+class ShellCloseEvent(Event):
+
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        return data[0]
+
+    @staticmethod
+    def handle(data: list[bytes], conn: Connection):
+        session = ShellSession.get(conn, data[0])
+        if session is not None: session.close("closed")
 
 class FileRemoveEventRequest(Event):
 
@@ -172,10 +638,7 @@ class FileRemoveEventRequest(Event):
     def handle(data: list[bytes], conn: Connection):
         try:
             path = str(pathlib.Path(data[0].decode()).absolute().resolve())
-            if os.path.isfile(path):
-                os.unlink(path)
-            else:
-                nukedir(path)
+            BulkOperations.remove(path)
 
             conn.send_success(f"[{Events.RemoveFile_Request.name}] Removed {path}")
         except FileNotFoundError:
@@ -236,4 +699,10 @@ class ConnectionClosedEvent(Event):
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
         NetworkUtils.remove_event_listener(conn)
+        FileChunkUploadEvent.sessions.drop(conn)
+        DeltaUploadEvent.patches.drop(conn)
+        DirectoryListingRequestEvent.cursors.drop(conn)
+        Search.cancel_all(conn)
+        CommandProcess.cancel_all(conn)
+        ShellSession.close_all(conn)
         Terminal.warning("Client disconnected from server: " + conn.ip)
\ No newline at end of file
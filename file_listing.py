@@ -0,0 +1,105 @@
+import os
+import stat
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Iterator
+
+from constants import EntryType, Events, Options
+from terminal import Terminal
+from utils import Connection
+
+def entry_type(entry: os.DirEntry) -> EntryType:
+    try:
+        if entry.is_symlink(): return EntryType.Symlink
+        if entry.is_dir(follow_symlinks=False): return EntryType.Directory
+        if entry.is_file(follow_symlinks=False): return EntryType.File
+    except OSError:
+        pass
+    return EntryType.Other
+
+def pack_entry(entry: os.DirEntry, name: str | None = None) -> bytes:
+    # On Windows scandir already has the stat result, elsewhere this is one lstat per entry
+    kind = entry_type(entry)
+    try:
+        st = entry.stat(follow_symlinks=False)
+        size, mtime = (st.st_size if stat.S_ISREG(st.st_mode) else 0), st.st_mtime
+    except OSError:
+        size, mtime = 0, 0.0
+
+    name_b = (entry.name if name is None else name).encode(errors="surrogateescape")
+    return struct.pack(Options.LISTING_ENTRY, kind.value, size, mtime, len(name_b)) + name_b
+
+def send_listing_page(conn: Connection, transaction_id: bytes, entries: Iterator[os.DirEntry], page_size: int) -> tuple[int, bool]:
+    # Sends up to page_size entries (all of them for 0) in batches as they are read,
+    # returns how many were sent and whether the directory was exhausted
+    batch = bytearray()
+    batched = 0
+    sent = 0
+    exhausted = True
+
+    for entry in entries:
+        batch += pack_entry(entry)
+        batched += 1
+        sent += 1
+
+        if batched >= Options.LISTING_BATCH_SIZE:
+            conn.send_event(Events.DirectoryListing_Response, [transaction_id, batch])
+            batch = bytearray()
+            batched = 0
+
+        if page_size and sent >= page_size:
+            exhausted = False
+            break
+
+    if batch:
+        conn.send_event(Events.DirectoryListing_Response, [transaction_id, batch])
+    return sent, exhausted
+
+class ListingCursors:
+    # Keeps the scandir iterators of unfinished listings so the next page continues where the last one stopped.
+    # Cursors are single use, every page hands out a new one
+    def __init__(self, max_size: int = Options.LISTING_CURSOR_CACHE_SIZE, lifetime: int = Options.LISTING_CURSOR_LIFETIME) -> None:
+        self.max_size = max_size
+        self.lifetime = lifetime
+        self.cursors: OrderedDict[tuple[Connection, bytes], tuple[Iterator[os.DirEntry], str, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, conn: Connection, entries: Iterator[os.DirEntry], path: str) -> bytes:
+        cursor = uuid.uuid4().hex.encode()
+        now = time.monotonic()
+        expired = []
+
+        with self.lock:
+            # Every cursor lives for the same time, so the oldest ones are always the first to expire
+            while self.cursors and next(iter(self.cursors.values()))[2] <= now:
+                expired.append(self.cursors.popitem(last=False)[1][0])
+            while len(self.cursors) >= self.max_size:
+                expired.append(self.cursors.popitem(last=False)[1][0])
+            self.cursors[(conn, cursor)] = (entries, path, now + self.lifetime)
+
+        for it in expired:
+            it.close()
+        return cursor
+
+    def take(self, conn: Connection, cursor: bytes) -> tuple[Iterator[os.DirEntry], str] | None:
+        with self.lock:
+            found = self.cursors.pop((conn, cursor), None)
+
+        if found is None: return None
+        entries, path, expires_at = found
+        if expires_at <= time.monotonic():
+            entries.close()
+            return None
+        return entries, path
+
+    def drop(self, conn: Connection):
+        with self.lock:
+            keys = [key for key in self.cursors if key[0] == conn]
+            dropped = [self.cursors.pop(key)[0] for key in keys]
+
+        for it in dropped:
+            it.close()
+        if dropped: Terminal.verbose(f"Closed {len(dropped)} unfinished listings")
@@ -0,0 +1,412 @@
+import math
+import mmap
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from constants import ArchiveEntry, Events, Options
+from terminal import Terminal
+from utils import Connection
+
+def parse_chunk_ranges(spec: str, size: int) -> list[tuple[int, int]]:
+    # "1-5,9" -> byte ranges of those CHUNK_SIZE units, sorted and merged where they touch
+    units = []
+    for token in spec.split(","):
+        first, _, last = token.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first: raise ValueError(f"Bad chunk range: {token}")
+        units.append((first, last))
+
+    merged: list[list[int]] = []
+    for first, last in sorted(units):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+
+    ranges = [((first - 1) * Options.CHUNK_SIZE, min(last * Options.CHUNK_SIZE, size)) for first, last in merged]
+    return [(start, end) for start, end in ranges if start < end]
+
+class ChunkSizer:
+    # Grows the chunk size while chunks go out quickly and shrinks it once sending slows down.
+    # Sizes stay multiples of Options.CHUNK_SIZE so chunk numbers keep their meaning
+    def __init__(self) -> None:
+        self.size = Options.CHUNK_SIZE
+
+    def update(self, elapsed: float):
+        if elapsed < Options.CHUNK_TARGET_SEND_TIME / 2 and self.size < Options.MAX_CHUNK_SIZE:
+            self.size *= 2
+        elif elapsed > Options.CHUNK_TARGET_SEND_TIME * 2 and self.size > Options.CHUNK_SIZE:
+            self.size //= 2
+
+class TransferProgress:
+    def __init__(self, name: str, total: int) -> None:
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_log = self.start
+
+    def update(self, n: int):
+        self.done += n
+        now = time.perf_counter()
+        if now - self.last_log < Options.PROGRESS_LOG_INTERVAL: return
+
+        self.last_log = now
+        rate = self.done / (now - self.start) / (1024 * 1024)
+        total = f"/{self.total / (1024 * 1024):.1f}" if self.total else ""
+        Terminal.debug(f"{self.name}: {self.done / (1024 * 1024):.1f}{total} MB ({rate:.1f} MB/s)")
+
+class FileDownload:
+    def __init__(self, conn: Connection, transaction_id: bytes, path: str, size: int, ranges: list[tuple[int, int]] | None = None) -> None:
+        # Ranges are (start, end) byte offsets with starts on CHUNK_SIZE boundaries,
+        # chunks are always numbered from the start of the file
+        self.conn = conn
+        self.transaction_id = transaction_id
+        self.path = path
+        self.size = size
+        self.ranges = [(start, min(end, size)) for start, end in (ranges or [(0, size)]) if start < min(end, size)]
+        self.total_chunks = math.ceil(size / Options.CHUNK_SIZE)
+        self.sizer = ChunkSizer()
+        self.progress = TransferProgress(f"Download {path} | TID: {transaction_id}", sum(end - start for start, end in self.ranges))
+
+    def run(self):
+        if self.size >= Options.MMAP_THRESHOLD:
+            self.__send_mapped()
+        else:
+            self.__send_buffered()
+
+    def __send_chunk(self, data: memoryview, end: int):
+        # A chunk spanning several CHUNK_SIZE units is numbered by the last unit it contains
+        index = math.ceil(end / Options.CHUNK_SIZE)
+        start = time.perf_counter()
+        self.conn.send_event(Events.FileChunkDownload_Response, [self.transaction_id, index, self.total_chunks, data])
+        self.sizer.update(time.perf_counter() - start)
+        self.progress.update(len(data))
+
+    def __read_ahead(self, f, free: queue.Queue, filled: queue.Queue):
+        try:
+            for start, end in self.ranges:
+                f.seek(start)
+                offset = start
+                while offset < end:
+                    buffer = free.get()
+                    if buffer is None: return
+
+                    n = f.readinto(memoryview(buffer)[:min(self.sizer.size, end - offset)])
+                    if not n: return
+                    offset += n
+                    filled.put((buffer, n, offset))
+        except OSError as e:
+            Terminal.error(f"Error occured while reading {self.path}: {e}")
+        finally:
+            filled.put(None)
+
+    def __send_buffered(self):
+        # The reader thread fills spare buffers while this thread encrypts and sends the previous ones
+        free = queue.Queue()
+        filled = queue.Queue()
+        for _ in range(Options.READ_AHEAD_BUFFERS):
+            free.put(bytearray(Options.MAX_CHUNK_SIZE))
+
+        with open(self.path, 'rb', buffering=0) as f:
+            reader = threading.Thread(target=self.__read_ahead, args=(f, free, filled), daemon=True)
+            reader.start()
+            try:
+                while (item := filled.get()) is not None:
+                    buffer, n, end = item
+                    self.__send_chunk(memoryview(buffer)[:n], end)
+                    free.put(buffer)
+            finally:
+                free.put(None)
+                reader.join()
+
+    def __send_mapped(self):
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+            view = memoryview(mapped)
+            try:
+                for start, end in self.ranges:
+                    offset = start
+                    end = min(end, len(view))
+                    while offset < end:
+                        chunk = view[offset:min(offset + self.sizer.size, end)]
+                        offset += len(chunk)
+                        self.__send_chunk(chunk, offset)
+                        chunk.release()
+            finally:
+                view.release()
+
+class DirectoryArchive:
+    # Streams a directory tree as one archive. Every entry is a header, its relative path and (for files) its contents,
+    # packed together into frames of about Options.ARCHIVE_FRAME_SIZE. An End entry closes the stream
+    def __init__(self, conn: Connection, transaction_id: bytes, root: str) -> None:
+        self.conn = conn
+        self.transaction_id = transaction_id
+        self.root = root
+        self.buffer = bytearray()
+        self.entries = 0
+        self.progress = TransferProgress(f"Archive {root} | TID: {transaction_id}", 0)
+
+    def run(self) -> int:
+        # Small files are read on the pool while the entries before them are being sent
+        pending: deque[tuple[ArchiveEntry, str, str, int, Future | None]] = deque()
+        with ThreadPoolExecutor(max_workers=Options.ARCHIVE_READ_WORKERS, thread_name_prefix="archive") as pool:
+            for kind, path, rel, size in self.__walk():
+                future = None
+                if kind == ArchiveEntry.File and size <= Options.ARCHIVE_SMALL_FILE_SIZE:
+                    future = pool.submit(self.__read_small, path)
+                pending.append((kind, path, rel, size, future))
+
+                if len(pending) >= Options.ARCHIVE_INFLIGHT_FILES:
+                    self.__write_entry(*pending.popleft())
+
+            while pending:
+                self.__write_entry(*pending.popleft())
+
+        self.__write_header(ArchiveEntry.End, b"", 0)
+        self.__flush()
+        return self.entries
+
+    def __walk(self):
+        stack = [self.root]
+        while stack:
+            current = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    entries = list(it)
+            except OSError as e:
+                Terminal.warning(f"Skipping {current}: {e}")
+                continue
+
+            for entry in entries:
+                rel = os.path.relpath(entry.path, self.root)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield ArchiveEntry.Directory, entry.path, rel, 0
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield ArchiveEntry.File, entry.path, rel, entry.stat(follow_symlinks=False).st_size
+                except OSError as e:
+                    Terminal.warning(f"Skipping {entry.path}: {e}")
+
+    @staticmethod
+    def __read_small(path: str) -> bytes | None:
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError as e:
+            Terminal.warning(f"Skipping {path}: {e}")
+            return None
+
+    def __write_entry(self, kind: ArchiveEntry, path: str, rel: str, size: int, future: Future | None):
+        rel_b = rel.replace(os.sep, "/").encode()
+        if kind == ArchiveEntry.Directory:
+            self.__write_header(kind, rel_b, 0)
+        elif future is not None:
+            data = future.result()
+            if data is None: return
+            self.__write_header(kind, rel_b, len(data))
+            self.__write(data)
+        else:
+            self.__write_large(path, rel_b, size)
+
+        self.entries += 1
+
+    def __write_large(self, path: str, rel_b: bytes, size: int):
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            Terminal.warning(f"Skipping {path}: {e}")
+            return
+
+        # The header already promised size bytes, so a file that shrank meanwhile is padded with zeros
+        with f:
+            self.__write_header(ArchiveEntry.File, rel_b, size)
+            remaining = size
+            while remaining:
+                data = f.read(min(remaining, Options.ARCHIVE_FRAME_SIZE))
+                if not data:
+                    Terminal.warning(f"{path} shrank while being archived")
+                    data = bytes(min(remaining, Options.ARCHIVE_FRAME_SIZE))
+                remaining -= len(data)
+                self.__write(data)
+
+    def __write_header(self, kind: ArchiveEntry, rel_b: bytes, size: int):
+        self.buffer += struct.pack(Options.ARCHIVE_ENTRY_HEADER, kind.value, len(rel_b), size)
+        self.buffer += rel_b
+
+    def __write(self, data: bytes):
+        self.buffer += data
+        if len(self.buffer) >= Options.ARCHIVE_FRAME_SIZE:
+            self.__flush()
+
+    def __flush(self):
+        if not self.buffer: return
+        self.conn.send_event(Events.DirectoryArchive_Response, [self.transaction_id, self.buffer])
+        self.progress.update(len(self.buffer))
+        self.buffer.clear()
+
+class UploadSession:
+    def __init__(self, path: str, size: int) -> None:
+        # Chunks are written into a temporary file next to the target, which replaces it once every chunk arrived
+        self.path = path
+        self.temp_path = f"{path}.{uuid.uuid4().hex[:8]}.part"
+        self.size = size
+        self.total_chunks = max(1, math.ceil(size / Options.CHUNK_SIZE))
+        self.received = bytearray(math.ceil(self.total_chunks / 8))
+        self.remaining = self.total_chunks
+        self.lock = threading.Lock()
+
+    def mark(self, first: int, count: int) -> bool:
+        # Marks chunks [first, first+count) as written and returns whether the upload is complete.
+        # Chunks that were already received (resent by the client) are not counted twice
+        with self.lock:
+            for index in range(first, first + count):
+                byte, bit = divmod(index, 8)
+                if self.received[byte] & (1 << bit): continue
+                self.received[byte] |= 1 << bit
+                self.remaining -= 1
+            return self.remaining == 0
+
+class UploadSessions:
+    # Uploads are keyed by connection and transaction id. Open handles are kept in an LRU so
+    # many concurrent uploads don't run out of file descriptors, handles still being written to are never closed
+    def __init__(self, max_open: int = Options.UPLOAD_MAX_OPEN_FILES) -> None:
+        self.max_open = max_open
+        self.sessions: dict[tuple[Connection, bytes], UploadSession] = {}
+        self.handles: OrderedDict[tuple[Connection, bytes], list[int]] = OrderedDict() # key -> [fd, users]
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple[Connection, bytes], path: str, size: int) -> UploadSession:
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None and (session.path != path or session.size != size):
+                raise ValueError(f"Upload {key[1]} is already writing {session.path} ({session.size} bytes)")
+            if session is None:
+                # The size comes from the client, check it before anything gets allocated for it
+                if size < 0:
+                    raise ValueError(f"Bad upload size {size}")
+                free = shutil.disk_usage(os.path.dirname(os.path.abspath(path))).free
+                if size > free:
+                    raise ValueError(f"Upload of {size} bytes doesn't fit in {free} free bytes")
+
+                session = UploadSession(path, size)
+                fd = os.open(session.temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+                try:
+                    UploadSessions.__preallocate(fd, size)
+                except OSError:
+                    os.close(fd)
+                    os.unlink(session.temp_path)
+                    raise
+                os.close(fd)
+                self.sessions[key] = session
+            return session
+
+    @staticmethod
+    def __preallocate(fd: int, size: int):
+        if size == 0: return
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass
+        os.ftruncate(fd, size)
+
+    def __acquire(self, key: tuple[Connection, bytes], session: UploadSession) -> int:
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is None:
+                handle = self.handles[key] = [os.open(session.temp_path, os.O_WRONLY | getattr(os, "O_BINARY", 0)), 0]
+                self.__evict()
+            self.handles.move_to_end(key)
+            handle[1] += 1
+            return handle[0]
+
+    def __release(self, key: tuple[Connection, bytes]):
+        with self.lock:
+            handle = self.handles.get(key)
+            if handle is None: return
+            handle[1] -= 1
+            # The upload was dropped while this chunk was being written
+            if handle[1] == 0 and key not in self.sessions:
+                self.__close(key)
+
+    def __evict(self):
+        # Called with the lock held
+        for key in list(self.handles):
+            if len(self.handles) <= self.max_open: return
+            fd, users = self.handles[key]
+            if users: continue
+            os.close(fd)
+            del self.handles[key]
+
+    def __close(self, key: tuple[Connection, bytes]):
+        # Called with the lock held
+        handle = self.handles.pop(key, None)
+        if handle is not None: os.close(handle[0])
+
+    @staticmethod
+    def __write_at(fd: int, session: UploadSession, offset: int, data: bytes):
+        if hasattr(os, "pwrite"):
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd, view, offset)
+                view = view[n:]
+                offset += n
+            return
+
+        # No pwrite on Windows, seeking and writing have to happen together
+        with session.lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+
+    def write(self, key: tuple[Connection, bytes], session: UploadSession, index: int, data: bytes) -> bool:
+        # Returns whether the upload is complete. Like DNCK chunks, a chunk spanning several CHUNK_SIZE units
+        # is numbered by the last (1-based) unit it contains
+        units = max(1, math.ceil(len(data) / Options.CHUNK_SIZE))
+        offset = (index - units) * Options.CHUNK_SIZE
+        if index < units or offset + len(data) > session.size or (not data and session.size):
+            raise ValueError(f"Chunk {index} ({len(data)} bytes) is out of range")
+        # Only the chunk that ends the file may be short, anything else would mark a unit it didn't fill
+        if len(data) % Options.CHUNK_SIZE and offset + len(data) != session.size:
+            raise ValueError(f"Chunk {index} ({len(data)} bytes) isn't a whole number of chunks")
+
+        fd = self.__acquire(key, session)
+        try:
+            UploadSessions.__write_at(fd, session, offset, data)
+        finally:
+            self.__release(key)
+
+        if not session.mark(index - units, units): return False
+
+        with self.lock:
+            if self.sessions.pop(key, None) is None: return False
+            self.__close(key)
+        os.replace(session.temp_path, session.path)
+        return True
+
+    def drop(self, conn: Connection):
+        # Throws away the unfinished uploads of a disconnected client
+        with self.lock:
+            keys = [key for key in self.sessions if key[0] == conn]
+            for key in keys:
+                session = self.sessions.pop(key)
+                if not self.handles.get(key, [0, 0])[1]:
+                    self.__close(key)
+                try:
+                    os.unlink(session.temp_path)
+                except OSError:
+                    pass
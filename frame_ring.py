@@ -0,0 +1,100 @@
+import threading
+import time
+
+import numpy as np
+
+class FrameRing:
+    # Fixed set of preallocated frame buffers shared by the capture thread and the encoder.
+    # The writer fills a free slot and publishes it, the reader always takes the newest
+    # published frame and anything older it skipped over counts as dropped.
+    # The slot the reader holds stays untouched until its next get
+    def __init__(self, capacity: int, merge_meta=None) -> None:
+        # One slot being written, one being encoded and at least one published
+        self.capacity = max(3, capacity)
+        self.slots: list[np.ndarray] = []
+        self.captured_at = [0.0] * self.capacity
+        self.sequence = [0] * self.capacity
+        # Whatever the writer attaches to a frame, merge_meta(older, newer) folds in the meta of a frame that gets dropped
+        self.meta = [None] * self.capacity
+        self.merge_meta = merge_meta
+        self.delivered_meta = None
+        self.writing = None
+        self.reading = None
+        self.latest = None
+        self.published = 0
+        self.consumed = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.captured = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.latency_last = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def acquire(self, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        with self.condition:
+            if not self.slots or self.slots[0].shape != shape or self.slots[0].dtype != dtype:
+                # First frame, or the capture size changed
+                self.slots = [np.empty(shape, dtype) for _ in range(self.capacity)]
+                if self.published > self.consumed:
+                    self.dropped += 1
+                    self.consumed = self.published
+                self.latest = None
+
+            self.writing = next(i for i in range(self.capacity) if i != self.reading and i != self.latest)
+            return self.slots[self.writing]
+
+    def publish(self, captured_at: float | None = None, meta=None):
+        with self.condition:
+            if self.writing is None: return
+            if self.latest is not None and self.sequence[self.latest] > self.consumed:
+                self.dropped += 1
+                if self.merge_meta is not None and self.meta[self.latest] is not None and meta is not None:
+                    meta = self.merge_meta(self.meta[self.latest], meta)
+
+            self.published += 1
+            self.sequence[self.writing] = self.published
+            self.captured_at[self.writing] = time.perf_counter() if captured_at is None else captured_at
+            self.meta[self.writing] = meta
+            self.latest = self.writing
+            self.writing = None
+            self.captured += 1
+            self.condition.notify()
+
+    def get(self, timeout: float | None = None) -> np.ndarray | None:
+        with self.condition:
+            # Gives back the previously held slot
+            self.reading = None
+            if not self.condition.wait_for(lambda: self.closed or self.published > self.consumed, timeout):
+                return None
+            if self.closed: return None
+
+            self.reading = self.latest
+            self.delivered_meta = self.meta[self.reading]
+            self.latest = None
+            self.consumed = self.published
+
+            latency = time.perf_counter() - self.captured_at[self.reading]
+            self.delivered += 1
+            self.latency_last = latency
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            return self.slots[self.reading]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                "captured": self.captured,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "latency_last": self.latency_last,
+                "latency_avg": self.latency_total / self.delivered if self.delivered else 0.0,
+                "latency_max": self.latency_max,
+            }
@@ -0,0 +1,86 @@
+import struct
+
+import cv2
+import numpy as np
+
+from constants import DiffMask, Options
+
+# A frame diff is:
+#   header          width, height, block size, DiffMask
+#   block mask      np.packbits of the changed blocks, row major
+#   pixel mask      which pixels of the changed blocks changed, as DiffMask.Runs or DiffMask.Bitmap
+#   pixels          the BGR bytes of every changed pixel
+# Pixels of the changed blocks are walked block by block, row major inside every block.
+# Without a previous frame the diff is against a black frame
+
+def pad_to_blocks(img: np.ndarray, block: int) -> np.ndarray:
+    height, width = img.shape[:2]
+    bottom, right = -height % block, -width % block
+    if not bottom and not right: return img
+    return cv2.copyMakeBorder(img, 0, bottom, 0, right, cv2.BORDER_CONSTANT, value=0)
+
+def block_view(img: np.ndarray, block: int) -> np.ndarray:
+    # (rows, columns, block, block, ...) view of a padded image, no copy
+    rows, columns = img.shape[0] // block, img.shape[1] // block
+    return img.reshape(rows, block, columns, block, *img.shape[2:]).swapaxes(1, 2)
+
+def encode_image_diff(prev_img: np.ndarray | None, img: np.ndarray, block: int = Options.IMAGE_DIFF_BLOCK_SIZE) -> bytes:
+    height, width = img.shape[:2]
+    img = pad_to_blocks(img, block)
+    prev_img = pad_to_blocks(prev_img, block) if prev_img is not None else np.zeros_like(img)
+    rows, columns = img.shape[0] // block, img.shape[1] // block
+
+    # 255 on every changed channel, the gray conversion leaves any pixel with a changed channel non zero
+    pixel_changed = cv2.cvtColor(cv2.compare(img, prev_img, cv2.CMP_NE), cv2.COLOR_BGR2GRAY)
+    # Max over a block's rows, then over its columns. Far quicker than reducing both axes at once
+    block_changed = pixel_changed.reshape(rows, block, -1).max(axis=1).reshape(rows, columns, block).max(axis=2) > 0
+
+    pixel_mask = block_view(pixel_changed, block)[block_changed].ravel() > 0
+    pixels = block_view(img, block)[block_changed].reshape(-1, 3)[pixel_mask]
+
+    # Alternating unchanged / changed run lengths, unless a plain bitmap is smaller (noisy content)
+    edges = np.flatnonzero(np.diff(pixel_mask, prepend=False, append=False))
+    runs = np.diff(edges, prepend=0)
+    if len(runs) * 4 < len(pixel_mask) // 8:
+        mode = DiffMask.Runs
+        mask_bytes = struct.pack("<I", len(runs)) + runs.astype("<u4").tobytes()
+    else:
+        mode = DiffMask.Bitmap
+        mask_bytes = np.packbits(pixel_mask).tobytes()
+
+    header = struct.pack(Options.IMAGE_DIFF_HEADER, width, height, block, mode.value)
+    return b"".join([header, np.packbits(block_changed).tobytes(), mask_bytes, pixels.tobytes()])
+
+def decode_image_diff(prev_img: np.ndarray | None, data: bytes) -> np.ndarray:
+    width, height, block, mode = struct.unpack_from(Options.IMAGE_DIFF_HEADER, data)
+    offset = struct.calcsize(Options.IMAGE_DIFF_HEADER)
+
+    if prev_img is not None and prev_img.shape[:2] != (height, width):
+        raise ValueError("Diff doesn't match the previous frame size")
+    rows, columns = -(-height // block), -(-width // block)
+    img = np.zeros((rows * block, columns * block, 3), dtype=np.uint8)
+    if prev_img is not None:
+        img[:height, :width] = prev_img
+
+    mask_size = -(-rows * columns // 8)
+    block_changed = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=mask_size, offset=offset), count=rows * columns).reshape(rows, columns).astype(bool)
+    offset += mask_size
+
+    pixel_count = int(block_changed.sum()) * block * block
+    if DiffMask(mode) == DiffMask.Runs:
+        run_count, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        runs = np.frombuffer(data, dtype="<u4", count=run_count, offset=offset)
+        offset += run_count * 4
+        pixel_mask = np.zeros(pixel_count, dtype=bool)
+        pixel_mask[:int(runs.sum())] = np.repeat(np.arange(run_count) % 2 == 1, runs)
+    else:
+        mask_size = -(-pixel_count // 8)
+        pixel_mask = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=mask_size, offset=offset), count=pixel_count).astype(bool)
+        offset += mask_size
+
+    blocks = block_view(img, block)
+    changed = blocks[block_changed].reshape(-1, 3)
+    changed[pixel_mask] = np.frombuffer(data, dtype=np.uint8, offset=offset).reshape(-1, 3)
+    blocks[block_changed] = changed.reshape(-1, block, block, 3)
+    return img[:height, :width] if img.shape[:2] != (height, width) else img
@@ -0,0 +1,198 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from constants import Options
+from terminal import Terminal
+
+class InotifyWatcher:
+    # Minimal ctypes binding, calls on_change with the watched directory whenever its entries change
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    WATCH_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    EVENT_HEADER = "iIII" # Watch descriptor, mask, cookie, name length
+
+    def __init__(self, on_change: Callable[[str | None], None]) -> None:
+        self.on_change = on_change
+        self.fd = -1
+        self.paths: dict[int, str] = {}
+        self.descriptors: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+        if not sys.platform.startswith("linux"): return
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            self.fd = -1
+        if self.fd < 0: return
+
+        threading.Thread(target=self.__read_events, daemon=True).start()
+
+    @property
+    def available(self) -> bool:
+        return self.fd >= 0
+
+    def watch(self, path: str) -> bool:
+        if not self.available: return False
+        with self.lock:
+            if path in self.descriptors: return True
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), InotifyWatcher.WATCH_MASK)
+            if wd < 0: return False
+            self.descriptors[path] = wd
+            self.paths[wd] = path
+            return True
+
+    def unwatch(self, path: str):
+        if not self.available: return
+        with self.lock:
+            wd = self.descriptors.pop(path, None)
+            if wd is None: return
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def __read_events(self):
+        header_size = struct.calcsize(InotifyWatcher.EVENT_HEADER)
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                Terminal.error(f"Stopped watching directories: {e}")
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = struct.unpack_from(InotifyWatcher.EVENT_HEADER, data, offset)
+                offset += header_size + name_length
+
+                # An overflowed queue lost events, so nothing cached can be trusted anymore
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    self.on_change(None)
+                    continue
+
+                with self.lock:
+                    path = self.paths.get(wd)
+                    if mask & InotifyWatcher.IN_IGNORED and path is not None:
+                        del self.paths[wd]
+                        self.descriptors.pop(path, None)
+
+                if path is not None: self.on_change(path)
+
+class ListingCache:
+    # LRU of directory listings bounded by entry count and size. With inotify, entries are dropped as soon as their
+    # directory changes, otherwise every hit checks the directory's mtime (which changes whenever entries are added,
+    # removed or renamed). Only cached directories are watched
+    def __init__(self, max_entries: int = Options.LISTING_CACHE_MAX_ENTRIES, max_bytes: int = Options.LISTING_CACHE_MAX_BYTES) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, tuple[tuple[str, ...], int, int, bool]] = OrderedDict() # path -> (names, mtime_ns, bytes, watched)
+        # Invalidation counter, the counter value each path was last invalidated at, and the value below which
+        # every listing is treated as stale (versions of uncached paths are forgotten to keep the dict bounded)
+        self.counter = 0
+        self.versions: dict[str, int] = {}
+        self.floor = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.watcher = InotifyWatcher(self.invalidate) if Options.LISTING_CACHE_INOTIFY else None
+
+    def get(self, path: str) -> tuple[tuple[str, ...] | None, int]:
+        # Returns the cached names (None on a miss) and a version to pass to put, so a listing that raced with a
+        # change isn't cached. On a miss, take the mtime for put before listing the directory
+        with self.lock:
+            entry = self.entries.get(path)
+        mtime_ns = os.stat(path).st_mtime_ns if entry is not None and not entry[3] else None
+
+        with self.lock:
+            version = self.counter
+            entry = self.entries.get(path)
+            if entry is not None and (entry[3] or entry[1] == mtime_ns):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[0], version
+
+            if entry is not None:
+                self.__remove(path)
+                self.invalidations += 1
+            self.misses += 1
+            return None, version
+
+    def put(self, path: str, names: tuple[str, ...], version: int, mtime_ns: int):
+        size = sys.getsizeof(names) + sum(sys.getsizeof(name) for name in names)
+        if size > self.max_bytes: return
+
+        # The watch goes on before the mtime check, so a change made after the listing was taken
+        # either moved the mtime or shows up as an inotify event that bumps the version
+        watched = self.watcher is not None and self.watcher.watch(path)
+        try:
+            unchanged = os.stat(path).st_mtime_ns == mtime_ns
+        except OSError:
+            unchanged = False
+
+        with self.lock:
+            if not unchanged or version < self.floor or self.versions.get(path, 0) > version:
+                if watched and path not in self.entries: self.watcher.unwatch(path)
+                return
+
+            if path in self.entries: self.__remove(path, unwatch=False)
+            self.entries[path] = (names, mtime_ns, size, watched)
+            self.bytes += size
+
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def __remove(self, path: str, unwatch: bool = True):
+        # Called with the lock held
+        _, _, size, watched = self.entries.pop(path)
+        self.bytes -= size
+        if watched and unwatch: self.watcher.unwatch(path)
+
+    def invalidate(self, path: str | None):
+        # None drops everything
+        with self.lock:
+            self.counter += 1
+            if path is None:
+                paths = list(self.entries)
+                self.versions.clear()
+                self.floor = self.counter
+            else:
+                paths = [path]
+                self.versions[path] = self.counter
+
+            for p in paths:
+                if p in self.entries:
+                    self.__remove(p)
+                    self.invalidations += 1
+
+            if len(self.versions) > self.max_entries:
+                # Listings of forgotten paths that are still running fall under the floor and won't be cached
+                self.versions = {p: v for p, v in self.versions.items() if p in self.entries}
+                self.floor = self.counter
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "watches": len(self.watcher.descriptors) if self.watcher is not None else 0,
+            }
@@ -0,0 +1,156 @@
+import fnmatch
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import EntryType, Events, Options
+from file_listing import entry_type, pack_entry
+from utils import Connection
+
+class SearchFilter:
+    # Built from "key=value" parts: glob, regex, type (file/dir), min_size, max_size, after, before (unix seconds)
+    def __init__(self, options: dict[str, str]) -> None:
+        flags = re.IGNORECASE if os.name == "nt" else 0
+        self.glob = re.compile(fnmatch.translate(options["glob"]), flags) if "glob" in options else None
+        self.regex = re.compile(options["regex"], flags) if "regex" in options else None
+
+        types = {"file": EntryType.File, "dir": EntryType.Directory}
+        self.type = types[options["type"]] if "type" in options else None
+        self.min_size = int(options["min_size"]) if "min_size" in options else None
+        self.max_size = int(options["max_size"]) if "max_size" in options else None
+        self.after = float(options["after"]) if "after" in options else None
+        self.before = float(options["before"]) if "before" in options else None
+
+    def matches(self, entry: os.DirEntry) -> bool:
+        # Cheapest checks first, stat only when a size or time filter needs it
+        if self.glob is not None and not self.glob.match(entry.name): return False
+        if self.regex is not None and not self.regex.search(entry.name): return False
+
+        kind = entry_type(entry)
+        if self.type is not None and kind != self.type: return False
+
+        if self.min_size is None and self.max_size is None and self.after is None and self.before is None: return True
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            return False
+
+        if (self.min_size is not None or self.max_size is not None) and kind != EntryType.File: return False
+        if self.min_size is not None and st.st_size < self.min_size: return False
+        if self.max_size is not None and st.st_size > self.max_size: return False
+        if self.after is not None and st.st_mtime < self.after: return False
+        if self.before is not None and st.st_mtime > self.before: return False
+        return True
+
+class Search:
+    # Directories are scanned on a shared pool, every scan queues its subdirectories as new jobs.
+    # The handler thread batches the matches the scans report and sends them as they come
+    pool = ThreadPoolExecutor(max_workers=Options.SEARCH_WORKERS, thread_name_prefix="search")
+    running: dict[tuple[Connection, bytes], 'Search'] = {}
+    running_lock = threading.Lock()
+
+    def __init__(self, conn: Connection, transaction_id: bytes, root: str, search_filter: SearchFilter, limit: int) -> None:
+        self.conn = conn
+        self.transaction_id = transaction_id
+        self.root = root
+        self.filter = search_filter
+        self.limit = limit
+        self.cancelled = threading.Event()
+        self.results: queue.Queue[bytes | None] = queue.Queue()
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cancel_running(conn: Connection, transaction_id: bytes) -> bool:
+        with Search.running_lock:
+            search = Search.running.get((conn, transaction_id))
+        if search is None: return False
+        search.cancelled.set()
+        return True
+
+    @staticmethod
+    def cancel_all(conn: Connection):
+        with Search.running_lock:
+            searches = [search for key, search in Search.running.items() if key[0] == conn]
+        for search in searches:
+            search.cancelled.set()
+
+    def run(self) -> tuple[int, str]:
+        # Returns how many matches were sent and why the search stopped (done, limit or cancelled)
+        key = (self.conn, self.transaction_id)
+        with Search.running_lock:
+            Search.running[key] = self
+        try:
+            return self.__collect()
+        finally:
+            self.cancelled.set()
+            with Search.running_lock:
+                Search.running.pop(key, None)
+
+    def __collect(self) -> tuple[int, str]:
+        self.__submit(self.root)
+        batch = bytearray()
+        batched = 0
+        found = 0
+        status = "done"
+        last_send = time.monotonic()
+
+        while True:
+            try:
+                record = self.results.get(timeout=Options.SEARCH_BATCH_INTERVAL)
+            except queue.Empty:
+                record = b""
+
+            if record is None: break
+            if self.cancelled.is_set():
+                status = "cancelled"
+                break
+
+            if record:
+                batch += record
+                batched += 1
+                found += 1
+
+            full = batched >= Options.SEARCH_BATCH_SIZE or found >= self.limit
+            waited = batched and time.monotonic() - last_send >= Options.SEARCH_BATCH_INTERVAL
+            if full or waited:
+                self.conn.send_event(Events.Search_Response, [self.transaction_id, batch])
+                batch = bytearray()
+                batched = 0
+                last_send = time.monotonic()
+
+            if found >= self.limit:
+                status = "limit"
+                break
+
+        if batch:
+            self.conn.send_event(Events.Search_Response, [self.transaction_id, batch])
+        return found, status
+
+    def __submit(self, path: str):
+        with self.lock:
+            self.pending += 1
+        Search.pool.submit(self.__scan, path)
+
+    def __scan(self, path: str):
+        try:
+            if self.cancelled.is_set(): return
+            with os.scandir(path) as it:
+                for entry in it:
+                    if self.cancelled.is_set(): return
+                    try:
+                        if entry.is_dir(follow_symlinks=False): self.__submit(entry.path)
+                        if self.filter.matches(entry):
+                            self.results.put(pack_entry(entry, os.path.relpath(entry.path, self.root)))
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending -= 1
+                finished = self.pending == 0
+            if finished: self.results.put(None)
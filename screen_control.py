@@ -1,11 +1,10 @@
 import socket
 from constants import Options, Events
 from screen_share import ScreenShare
+from adaptive_quality import AdaptiveQuality
 from utils import Connection, NetworkUtils
 import pyautogui
 import threading
-import numpy as np
-import cv2
 import time
 from ctypes import *
 from terminal import Terminal
@@ -19,31 +18,6 @@ def get_fields(data: bytes, lengths: list[int]):
         data = data[l:]
     return fields
 
-def encode_image_diff(prev_img, img, diff=True):
-
-    if diff == False:
-        diff_bytes = bytearray()
-        for y in range(img.shape[0]):
-            for x in range(img.shape[1]):
-                color = img[y, x]
-                diff_bytes.extend(int(x).to_bytes(2, 'big'))
-                diff_bytes.extend(int(y).to_bytes(2, 'big'))
-                diff_bytes.extend(color)
-        return bytes(diff_bytes)
-
-    diff = cv2.absdiff(prev_img, img)
-    changed_pixels = np.argwhere(diff > 0)
-
-    diff_bytes = bytearray()
-    for x, y, _ in changed_pixels:
-        if 0 <= x < img.shape[1] and 0 <= y < img.shape[0]:
-            color = img[y, x]
-            diff_bytes.extend(int(x).to_bytes(2, 'big'))
-            diff_bytes.extend(int(y).to_bytes(2, 'big'))
-            diff_bytes.extend(color)
-
-    return bytes(diff_bytes)
-
 class ScreenControl:
 
     Terminal.info("Initializing screen control sockets...")
@@ -74,6 +48,8 @@ class ScreenControl:
         ScreenControl.accepting_sc = True
 
         ScreenControl.mouse_update_conn.encryption_manager = main_conn.encryption_manager
+        # Side channels speak the same framing as the main connection, flag byte included once a codec is negotiated
+        ScreenControl.mouse_update_conn.compressor = main_conn.compressor
 
         mouse_thread = threading.Thread(target=ScreenControl.mouse_listener)
         screen_thread = threading.Thread(target=ScreenControl.screen_share)
@@ -135,6 +111,7 @@ class ScreenControl:
             pyautogui.moveTo(mouse_x, mouse_y, _pause=False)
 
         ScreenControl.mouse_update_conn.encryption_manager = None
+        ScreenControl.mouse_update_conn.compressor = None
 
 
     @staticmethod
@@ -142,6 +119,7 @@ class ScreenControl:
         soc, addr = ScreenControl.keyboard_update_socket.accept()
         client = Connection(soc, addr)
         client.encryption_manager = ScreenControl.main_conn.encryption_manager
+        client.compressor = ScreenControl.main_conn.compressor
         hold_map: dict[str, bool] = {}
 
         while ScreenControl.accepting_sc:
@@ -172,9 +150,11 @@ class ScreenControl:
         soc, addr = ScreenControl.screen_update_socket.accept()
         client = Connection(soc, addr)
         client.encryption_manager = ScreenControl.main_conn.encryption_manager
+        client.compressor = ScreenControl.main_conn.compressor
 
         ss = ScreenShare()
         with ss as screen_share:
+            quality = AdaptiveQuality(screen_share) if Options.SCREEN_ADAPTIVE_QUALITY else None
             frame_count = 0
             fps_timer = time.time()
             data_sent_per_sec = 0
@@ -185,14 +165,20 @@ class ScreenControl:
                     Terminal.verbose(f"Got empty packets, skippig...")
                     continue
                     
+                send_start = time.perf_counter()
+                frame_bytes = 0
                 for packet in packets:
                     NetworkUtils.send_parts(client, [Events.ScreenFrame_Action.value, packet])
-                    data_sent_per_sec += len(packet)
+                    frame_bytes += len(packet)
+                data_sent_per_sec += frame_bytes
+                if quality is not None:
+                    quality.on_frame_sent(frame_bytes, time.perf_counter() - send_start)
 
                 frame_count += 1
                 if time.time() - fps_timer >= 1.0:
                     kb_sent = data_sent_per_sec / 1024
-                    Terminal.verbose(f"ScreenShare FPS: {frame_count} | KB/s: {kb_sent:.2f}")
+                    ring = screen_share.frame_ring.stats()
+                    Terminal.verbose(f"ScreenShare FPS: {frame_count} | KB/s: {kb_sent:.2f} | Dropped: {ring['dropped']} | Unchanged: {screen_share.frames_skipped} | Latency: {ring['latency_avg']*1000:.1f}ms")
                     frame_count = 0
                     data_sent_per_sec = 0
                     fps_timer = time.time()
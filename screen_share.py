@@ -1,121 +1,104 @@
-import win32gui, win32ui, win32api
 import numpy as np
-from mss import mss
 import cv2
 from constants import Options
+from capture_sources import CaptureSource, MssSource
+from dirty_regions import DirtyRegionDetector
+from frame_ring import FrameRing
 import av
 from fractions import Fraction
 from terminal import Terminal
 import os
 import threading
-import queue
+import time
 
-def get_cursor(hcursor):
-    try:
-        # Create a device context and bitmap
-        hdc = win32ui.CreateDCFromHandle(win32gui.GetDC(0))
-        hbmp = win32ui.CreateBitmap()
-        hbmp.CreateCompatibleBitmap(hdc, 36, 36)
-        hdc = hdc.CreateCompatibleDC()
-        hdc.SelectObject(hbmp)
-        hdc.DrawIcon((0, 0), hcursor)
-
-        # Get bitmap info and bits
-        bmpinfo = hbmp.GetInfo()
-        bmpstr = hbmp.GetBitmapBits(True)
-
-        # Convert the raw bitmap string into a NumPy array
-        height, width = bmpinfo['bmHeight'], bmpinfo['bmWidth']
-        raw_array = np.frombuffer(bmpstr, dtype=np.uint8)
-        img_array = raw_array.reshape((height, width, 4))  # Assuming 32-bit with BGRA format
-
-        # Drop the alpha channel (if desired, you can retain it)
-        img_rgb = img_array[:, :, :3]
-
-        # Release resources
-        win32gui.DestroyIcon(hcursor)
-        win32gui.DeleteObject(hbmp.GetHandle())
-        hdc.DeleteDC()
-
-        # Return the RGB image
-        return img_rgb
-    except:
-        return None
-
-def add_cursor_to_frame(frame):
-    # Get cursor information
-    flags, hcursor, (cx, cy) = win32gui.GetCursorInfo()
-    cursor = get_cursor(hcursor)
-
-    if cursor is None:
-        return frame
-
-    # Get cursor hotspot information
-    hotspot_x, hotspot_y = win32gui.GetIconInfo(hcursor)[1:3]
-
-    # Extract cursor dimensions
-    ch, cw = cursor.shape[:2]
-
-    # Adjust cursor position by subtracting hotspot offset
-    cx = cx - hotspot_x
-    cy = cy - hotspot_y
-
-    # Ensure cursor is within frame boundaries
-    fx = max(0, min(cx, frame.shape[1] - cw))
-    fy = max(0, min(cy, frame.shape[0] - ch))
-
-    # Create alpha mask based on cursor's intensity
-    mask = (cursor[:, :, :3].max(axis=-1) > 10).astype(np.float32)[:, :, np.newaxis]
-
-    # Blend cursor with the frame using the mask
-    roi = frame[fy:fy+ch, fx:fx+cw]
-    cursor_region = cursor[:, :, :3] * mask + roi * (1 - mask)
-    frame[fy:fy+ch, fx:fx+cw] = cursor_region.astype(np.uint8)
-
-    return frame
+STAGES = ("grab", "convert", "detect", "resize", "encode")
 
 class ScreenShare:
-    def __init__(self) -> None:
+    def __init__(self, source: CaptureSource | None = None, scale: float = Options.SCREEN_SIZE_FACTOR, frame_rate: int = Options.SCREEN_UPDATE_FRAME_RATE, paced: bool = True) -> None:
         Terminal.info("Initializing screen share codec...")
 
-        self.sct = None
-        self.monitor = None
+        self.source = source if source is not None else MssSource()
+        self.paced = paced
+        self.codec = None
+        self.pending_settings = None
+        self.settings_lock = threading.Lock()
+        self.__apply_settings(Options.SCREEN_CRF, scale, frame_rate)
 
+        self.frame_count = 0
+        self.bytes_encoded = 0
+        self.stage_times = {stage: 0.0 for stage in STAGES}
+        self.stage_counts = {stage: 0 for stage in STAGES}
+        
+        # Frames go through the ring with their changed tile mask, a dropped frame's tiles carry over to the next
+        self.frame_ring = FrameRing(Options.SCREEN_FRAME_RING_SIZE, merge_meta=np.logical_or)
+        self.detector = DirtyRegionDetector()
+        self.dirty_regions: list[tuple[int, int, int, int]] = []
+        self.frames_skipped = 0
+        self.frame_scratch = None
+        self.frame_thread = None
+        self.start_recording = False
+
+    def __create_codec(self):
         self.codec = av.CodecContext.create("h264", "w")
-        self.codec.width = win32api.GetSystemMetrics(0)
-        self.codec.height = win32api.GetSystemMetrics(1)
+        self.codec.width = self.width
+        self.codec.height = self.height
         self.codec.pix_fmt = 'yuv420p'
-        self.codec.time_base = Fraction(1, int(Options.SCREEN_UPDATE_FRAME_RATE))
-        self.codec.framerate = Options.SCREEN_UPDATE_FRAME_RATE
+        self.codec.time_base = Fraction(1, int(self.frame_rate))
+        self.codec.framerate = self.frame_rate
         self.codec.options = {
             'preset': 'ultrafast',
-            'crf': '30',
+            'crf': str(self.crf),
             'tune': 'zerolatency',
-            'threads': str(os.cpu_count()//2),
-            'thread_type': 'frame',
+            'threads': str(max(1, os.cpu_count()//2)),
+            # Slice threading keeps x264 from holding frames back. With frame threading the last changes before
+            # the screen goes idle would sit in the encoder, since unchanged frames are never encoded
+            'thread_type': 'slice',
             'rc-lookahead': '0',
             'fast_pskip': '1',
             'zerolatency': '1',
         }
-        
 
-        self.frame_count = 0
-        
-        self.frame_buffer = queue.Queue()
-        self.frame_thread = None
-        self.start_recording = False
-        self.thread_local = threading.local()
+    def __drain_codec(self) -> list[bytes]:
+        # Sends the end of stream to the encoder and collects whatever it was still holding back
+        try:
+            return [bytes(packet) for packet in self.codec.encode(None)]
+        except Exception:
+            return []
+
+    def __apply_settings(self, crf: int, scale: float, frame_rate: int) -> list[bytes]:
+        # Returns the packets the previous encoder still had, they go out before the new encoder's key frame
+        self.crf = crf
+        self.scale = scale
+        self.frame_rate = frame_rate
+        # yuv420p needs even dimensions
+        self.width = max(2, int(self.source.width * scale) // 2 * 2)
+        self.height = max(2, int(self.source.height * scale) // 2 * 2)
+        # Read by the capture thread in one go
+        self.size = (self.width, self.height)
+
+        reopen = self.codec is not None and self.codec.is_open
+        drained = self.__drain_codec() if reopen else []
+        # PyAV has no explicit close, dropping the last reference frees the old encoder
+        self.codec = None
+        self.__create_codec()
+        if reopen:
+            # A fresh encoder starts with a key frame, so the client picks up the new settings right away
+            self.codec.open()
+            self.frame_count = 0
+        return drained
+
+    def reconfigure(self, crf: int, scale: float, frame_rate: int):
+        # Applied by the encoding thread before the next frame it encodes
+        with self.settings_lock:
+            self.pending_settings = (crf, scale, frame_rate)
 
     def __enter__(self):
         Terminal.debug("Entering screen share context...")
-        self.sct = mss()
-        self.monitor = self.sct.monitors[1]
         while not self.codec.is_open:
             self.codec.open()
         Terminal.info("Codec is ready.")
         
         self.start_recording = True
-        self.thread_local.sct = self.sct
         self.frame_thread = threading.Thread(target=self.__start_recording)
         self.frame_thread.start()
 
@@ -123,17 +106,21 @@ class ScreenShare:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         Terminal.debug("Exiting screen share context...")
-        if self.sct:
-            self.sct.close()
-        try:
-            for packet in self.codec.encode(None): # flush the codec
-                pass
-        except Exception:
-            pass
-        
         self.start_recording = False
-        self.frame_buffer.empty()
+        self.frame_ring.close()
         self.frame_thread.join()
+        self.source.close()
+        self.__drain_codec()
+
+    def __time_stage(self, stage: str, started: float) -> float:
+        now = time.perf_counter()
+        self.stage_times[stage] += now - started
+        self.stage_counts[stage] += 1
+        return now
+
+    def stage_stats(self) -> dict[str, float]:
+        # Average milliseconds per frame of every pipeline stage
+        return {stage: self.stage_times[stage] * 1000 / self.stage_counts[stage] if self.stage_counts[stage] else 0.0 for stage in STAGES}
 
     def __compress_and_encode_frame(self, frame):
         encoded_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
@@ -144,34 +131,64 @@ class ScreenShare:
         return packets
 
     def __start_recording(self):
+        next_capture = time.perf_counter()
         while self.start_recording:
-            if not hasattr(self.thread_local, 'sct'):
-                self.thread_local.sct = mss()
-            screenshot = self.thread_local.sct.grab(self.monitor)
-            frame = np.array(screenshot)
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
-            frame = add_cursor_to_frame(frame)
-
-            new_width = int(frame.shape[1] * Options.SCREEN_SIZE_FACTOR)
-            new_height = int(frame.shape[0] * Options.SCREEN_SIZE_FACTOR)
-            frame = cv2.resize(frame, (new_width, new_height))
-            self.frame_buffer.put(frame)
-            
+            if self.paced:
+                interval = 1 / self.frame_rate
+                delay = next_capture - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -interval:
+                    # Fell more than a frame behind, don't try to catch up with a burst
+                    next_capture = time.perf_counter()
+                next_capture += interval
+
+            started = time.perf_counter()
+            raw = self.source.grab()
+            captured_at = started = self.__time_stage("grab", started)
+
+            # Full size conversion goes into a reused buffer, the scaled frame straight into the ring
+            if self.frame_scratch is None or self.frame_scratch.shape[:2] != raw.shape[:2]:
+                self.frame_scratch = np.empty((raw.shape[0], raw.shape[1], 3), dtype=np.uint8)
+            frame = cv2.cvtColor(raw, cv2.COLOR_BGRA2BGR, dst=self.frame_scratch)
+            frame = self.source.draw_cursor(frame)
+            started = self.__time_stage("convert", started)
+
+            dirty = self.detector.update(frame)
+            started = self.__time_stage("detect", started)
+            if dirty is None:
+                # Nothing changed, no need to scale or encode it
+                self.frames_skipped += 1
+                continue
+
+            width, height = self.size
+            slot = self.frame_ring.acquire((height, width, 3))
+            cv2.resize(frame, (width, height), dst=slot)
+            self.__time_stage("resize", started)
+            self.frame_ring.publish(captured_at, dirty)
+
 
     def get_frame(self):
         try:
-            if self.sct is None or self.monitor is None:
+            if not self.start_recording:
                 return None
 
-            frame = self.frame_buffer.get()
+            frame = self.frame_ring.get(timeout=1)
             if frame is None: return None
 
+            with self.settings_lock:
+                settings, self.pending_settings = self.pending_settings, None
+            to_send = self.__apply_settings(*settings) if settings is not None else []
+
+            started = time.perf_counter()
+            self.dirty_regions = self.detector.regions(self.frame_ring.delivered_meta, self.width, self.height)
             av_packets = self.__compress_and_encode_frame(frame)
 
-            to_send = []
             for packet in av_packets:
                 packet_bytes = bytes(packet)
                 to_send.append(packet_bytes)
+                self.bytes_encoded += len(packet_bytes)
+            self.__time_stage("encode", started)
 
             return to_send
         except Exception:
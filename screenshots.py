@@ -0,0 +1,71 @@
+import os
+import pathlib
+import random
+import string
+
+import cv2
+import mss
+import numpy as np
+
+from constants import Options
+from terminal import Terminal
+
+ENCODE_PARAMS = {
+    "png": lambda quality: [cv2.IMWRITE_PNG_COMPRESSION, Options.SCREENSHOT_PNG_COMPRESSION],
+    "jpeg": lambda quality: [cv2.IMWRITE_JPEG_QUALITY, quality],
+    "webp": lambda quality: [cv2.IMWRITE_WEBP_QUALITY, max(1, quality)],
+}
+EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+def generate_random_file_name(ext):
+    length = 6
+    name = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+    return name + "." + ext
+
+def capture(region: tuple[int, int, int, int] | None = None, scale: float = 1.0) -> np.ndarray:
+    # region is (x, y, width, height) relative to the primary monitor, clamped to its bounds.
+    # Raises ValueError when no part of the region is on the monitor
+    with mss.mss(with_cursor=True) as sct:
+        monitor = sct.monitors[1]
+        if region is not None:
+            x, y, width, height = region
+            left, top = max(0, x), max(0, y)
+            right, bottom = min(monitor["width"], x + width), min(monitor["height"], y + height)
+            if right <= left or bottom <= top:
+                raise ValueError(f"Region {region} is outside the {monitor['width']}x{monitor['height']} monitor")
+            monitor = {"left": monitor["left"] + left, "top": monitor["top"] + top, "width": right - left, "height": bottom - top}
+        frame = cv2.cvtColor(np.asarray(sct.grab(monitor)), cv2.COLOR_BGRA2BGR)
+
+    if scale != 1.0:
+        size = (max(1, round(frame.shape[1] * scale)), max(1, round(frame.shape[0] * scale)))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    return frame
+
+def encode(frame: np.ndarray, image_format: str, quality: int) -> bytes:
+    ok, encoded = cv2.imencode("." + EXTENSIONS[image_format], frame, ENCODE_PARAMS[image_format](quality))
+    if not ok: raise ValueError(f"Couldn't encode screenshot as {image_format}")
+    return encoded.tobytes()
+
+def save(data: bytes, image_format: str) -> str:
+    os.makedirs(Options.SCREENSHOTS_FOLDER, exist_ok=True)
+    path = os.path.join(Options.SCREENSHOTS_FOLDER, generate_random_file_name(EXTENSIONS[image_format]))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    prune(keep=path)
+    return str(pathlib.Path(path).resolve())
+
+def prune(keep: str | None = None):
+    # Deletes the oldest screenshots until the folder fits in Options.SCREENSHOTS_FOLDER_MAX_BYTES
+    with os.scandir(Options.SCREENSHOTS_FOLDER) as it:
+        files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in it if entry.is_file()]
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= Options.SCREENSHOTS_FOLDER_MAX_BYTES: break
+        if keep is not None and os.path.samefile(path, keep): continue
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError as e:
+            Terminal.warning(f"Couldn't delete old screenshot {path}: {e}")
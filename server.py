@@ -1,11 +1,48 @@
 __author__ = "K9 & Alon"
 import event_handler
-from utils import Connection, DataType, NetworkUtils, Event
+from utils import AsyncConnection, Connection, DataType, NetworkUtils, Event
 import socket
+import asyncio
 import threading
-from constants import Options, Events
+from concurrent.futures import ThreadPoolExecutor
+from constants import KeyExchange, Options, Events
+from encryption_manager import Encryption
 from terminal import Terminal
 import time
+import sys
+
+def add_event_listeners():
+    Terminal.info("Adding event listeners...")
+    NetworkUtils.add_listener(Events.Screenshot_Request, event_handler.ScreenshotRequestEvent)
+    NetworkUtils.add_listener(Events.FileContent_Request, event_handler.FileRequestEvent)
+    NetworkUtils.add_listener(Events.FileChunks_Request, event_handler.FileChunksRequestEvent)
+    NetworkUtils.add_listener(Events.DirectoryArchive_Request, event_handler.DirectoryArchiveRequestEvent)
+    NetworkUtils.add_listener(Events.DeltaSignature_Request, event_handler.DeltaSignatureRequestEvent)
+    NetworkUtils.add_listener(Events.DeltaDownload_Request, event_handler.DeltaDownloadRequestEvent, DataType.Raw)
+    NetworkUtils.add_listener(Events.DeltaUpload_Action, event_handler.DeltaUploadEvent, DataType.Raw)
+    NetworkUtils.add_listener(Events.UnknownEvent, event_handler.UnknownEvent)
+    NetworkUtils.add_listener(Events.ConnectionClosed, event_handler.ConnectionClosedEvent)
+    NetworkUtils.add_listener(Events.FileList_Request, event_handler.FileListRequestEvent)
+    NetworkUtils.add_listener(Events.DirectoryListing_Request, event_handler.DirectoryListingRequestEvent)
+    NetworkUtils.add_listener(Events.ListingCacheStats_Request, event_handler.ListingCacheStatsRequestEvent)
+    NetworkUtils.add_listener(Events.Search_Request, event_handler.SearchRequestEvent)
+    NetworkUtils.add_listener(Events.SearchCancel_Action, event_handler.SearchCancelEvent)
+    NetworkUtils.add_listener(Events.BulkOperation_Request, event_handler.BulkOperationRequestEvent)
+    NetworkUtils.add_listener(Events.CopyFile_Request, event_handler.FileCopyRequestEvent)
+    NetworkUtils.add_listener(Events.MoveFile_Request, event_handler.FileMoveRequestEvent)
+    NetworkUtils.add_listener(Events.FileChunkUpload_Action, event_handler.FileChunkUploadEvent, DataType.Raw)
+    NetworkUtils.add_listener(Events.CommandRun_Request, event_handler.CommandRunRequestEvent)
+    NetworkUtils.add_listener(Events.CommandCancel_Action, event_handler.CommandCancelEvent)
+    NetworkUtils.add_listener(Events.ShellOpen_Request, event_handler.ShellOpenRequestEvent)
+    NetworkUtils.add_listener(Events.ShellInput_Action, event_handler.ShellInputEvent, DataType.Raw)
+    NetworkUtils.add_listener(Events.ShellResize_Action, event_handler.ShellResizeEvent)
+    NetworkUtils.add_listener(Events.ShellClose_Action, event_handler.ShellCloseEvent)
+    NetworkUtils.add_listener(Events.RemoveFile_Request, event_handler.FileRemoveEventRequest)
+    NetworkUtils.add_listener(Events.ScreenControl_Request, event_handler.ScreenControlRequestEvent)
+    NetworkUtils.add_listener(Events.ScreenWatch_Request, event_handler.ScreenWatchRequestEvent)
+    NetworkUtils.add_listener(Events.ScreenControlDisconnect_Action, event_handler.ScreenControlDisconnectEvent)
+    NetworkUtils.add_listener(Events.ScreenWatchDisconnect_Action, event_handler.ScreenControlDisconnectEvent)
+    Terminal.info(f"{len(NetworkUtils.actions)} event listeners added!")
 
 class ControlledPC:
     def __init__(self) -> None:
@@ -20,22 +57,10 @@ class ControlledPC:
 
         self.open = True
 
-        Terminal.info("Adding event listeners...")
-        NetworkUtils.add_listener(Events.Screenshot_Request, event_handler.ScreenshotRequestEvent)
-        NetworkUtils.add_listener(Events.FileContent_Request, event_handler.FileRequestEvent)
-        NetworkUtils.add_listener(Events.UnknownEvent, event_handler.UnknownEvent)
-        NetworkUtils.add_listener(Events.ConnectionClosed, event_handler.ConnectionClosedEvent)
-        NetworkUtils.add_listener(Events.FileList_Request, event_handler.FileListRequestEvent)
-        NetworkUtils.add_listener(Events.CopyFile_Request, event_handler.FileCopyRequestEvent)
-        NetworkUtils.add_listener(Events.MoveFile_Request, event_handler.FileMoveRequestEvent)
-        NetworkUtils.add_listener(Events.FileChunkUpload_Action, event_handler.FileChunkUploadEvent, DataType.Raw)
-        NetworkUtils.add_listener(Events.CommandRun_Request, event_handler.CommandRunRequestEvent)
-        NetworkUtils.add_listener(Events.RemoveFile_Request, event_handler.FileRemoveEventRequest)
-        NetworkUtils.add_listener(Events.ScreenControl_Request, event_handler.ScreenControlRequestEvent)
-        NetworkUtils.add_listener(Events.ScreenWatch_Request, event_handler.ScreenWatchRequestEvent)
-        NetworkUtils.add_listener(Events.ScreenControlDisconnect_Action, event_handler.ScreenControlDisconnectEvent)
-        NetworkUtils.add_listener(Events.ScreenWatchDisconnect_Action, event_handler.ScreenControlDisconnectEvent)
-        Terminal.info("14 event listeners added!")
+        if Options.KEY_EXCHANGE == KeyExchange.RSA:
+            Encryption.key_pool.start()
+
+        add_event_listeners()
 
     def handle_exit(self):
         Terminal.info("Closing server socket...")
@@ -73,13 +98,79 @@ class ControlledPC:
             self.clients.append(client)
             threading.Thread(target=self.handle_client, args=(client, ), daemon=True).start()
 
+class AsyncControlledPC:
+    def __init__(self) -> None:
+
+        self.clients: list[AsyncConnection] = []
+        self.server: asyncio.Server | None = None
+        self.executor = ThreadPoolExecutor(max_workers=Options.ASYNC_EXECUTOR_WORKERS, thread_name_prefix="event")
+
+        if Options.KEY_EXCHANGE == KeyExchange.RSA:
+            Encryption.key_pool.start()
+
+        add_event_listeners()
+
+    def handle_exit(self):
+        Terminal.info("Closing server socket...")
+        if self.server is not None:
+            self.server.close()
+
+        Terminal.info("Disconnecting clients...")
+        for client in self.clients:
+            client.disconnect()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+        Terminal.success("Server closed successfully!")
+        exit(0)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = AsyncConnection(reader, writer)
+        if len(self.clients) >= Options.ASYNC_MAX_CONNECTED:
+            Terminal.warning(f"Client ({client.ip}:{client.port}) tried to connect but the server is full!")
+            writer.close()
+            return
+
+        Terminal.info(f"Client connected: {client.ip}:{client.port}")
+        self.clients.append(client)
+        loop = asyncio.get_running_loop()
+
+        try:
+            # Key generation is CPU bound, the handshake's own reads and writes still go through the loop
+            await loop.run_in_executor(self.executor, client.initiate_key_switch)
+
+            slots = asyncio.Semaphore(Options.MAX_EVENTS_PER_CONNECTION)
+            release = lambda: loop.call_soon_threadsafe(slots.release)
+
+            NetworkUtils.event_thread_status[client] = True
+            while NetworkUtils.event_thread_status[client]:
+                parts = await client.recieve_parts_async()
+                await slots.acquire()
+                NetworkUtils.dispatch_event(client, parts, done=release)
+                if parts is None: break
+        finally:
+            NetworkUtils.event_thread_status.pop(client, None)
+            self.clients.remove(client)
+            writer.close()
+
+    async def serve(self):
+        Terminal.info("Initializing async server socket...")
+        self.server = await asyncio.start_server(self.handle_client, "0.0.0.0", Options.PORT, backlog=Options.ASYNC_MAX_CONNECTED)
+        Terminal.info(f"Server started on port {Options.PORT}")
+        Terminal.info("\nWaiting for clients to connect...")
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_accept_clients(self):
+        asyncio.run(self.serve())
+
 
 if __name__ == "__main__":
     Terminal.clear()
     Terminal.logo()
     Terminal.info("Starting server...")
     time.sleep(1)
-    cpc = ControlledPC()
+    cpc = AsyncControlledPC() if "--async" in sys.argv else ControlledPC()
     Terminal.success("Server started successfully!")
     try:
         cpc.start_accept_clients()
@@ -0,0 +1,181 @@
+import os
+import signal
+import struct
+import subprocess
+import threading
+import time
+
+from constants import Events, Options
+from terminal import Terminal
+from utils import Connection
+
+if os.name != "nt":
+    import fcntl
+    import pty
+    import termios
+
+class ShellSession:
+    # A shell that stays alive between commands so cwd, env and shell variables carry over.
+    # On POSIX it runs on a PTY, on Windows (no PTY) it falls back to pipes
+    sessions: dict[tuple[Connection, bytes], 'ShellSession'] = {}
+    sessions_lock = threading.Lock()
+    reaper: threading.Thread | None = None
+
+    def __init__(self, conn: Connection, session_id: bytes) -> None:
+        self.conn = conn
+        self.session_id = session_id
+        self.process: subprocess.Popen | None = None
+        self.master_fd = -1
+        # Guards process and master_fd, input can arrive before the shell is spawned and after its PTY is closed
+        self.lock = threading.Lock()
+        self.last_activity = time.monotonic()
+        self.status = None
+
+    @staticmethod
+    def shell() -> str:
+        if Options.SHELL: return Options.SHELL
+        if os.name == "nt": return os.environ.get("COMSPEC", "cmd.exe")
+        return os.environ.get("SHELL", "/bin/sh")
+
+    @staticmethod
+    def open(conn: Connection, session_id: bytes, columns: int, rows: int) -> bool:
+        # Returns False when the connection already has too many shells (or one with this id)
+        key = (conn, session_id)
+        session = ShellSession(conn, session_id)
+        with ShellSession.sessions_lock:
+            if key in ShellSession.sessions: return False
+            if sum(1 for k in ShellSession.sessions if k[0] == conn) >= Options.MAX_SHELLS_PER_CONNECTION: return False
+            ShellSession.sessions[key] = session
+            if ShellSession.reaper is None:
+                ShellSession.reaper = threading.Thread(target=ShellSession.__reap_idle, daemon=True)
+                ShellSession.reaper.start()
+
+        try:
+            session.__spawn(columns, rows)
+        except Exception:
+            with ShellSession.sessions_lock:
+                ShellSession.sessions.pop(key, None)
+            raise
+        return True
+
+    @staticmethod
+    def get(conn: Connection, session_id: bytes) -> 'ShellSession | None':
+        with ShellSession.sessions_lock:
+            return ShellSession.sessions.get((conn, session_id))
+
+    @staticmethod
+    def close_all(conn: Connection):
+        with ShellSession.sessions_lock:
+            sessions = [s for key, s in ShellSession.sessions.items() if key[0] == conn]
+        for session in sessions:
+            session.close("closed")
+
+    @staticmethod
+    def __reap_idle():
+        while True:
+            time.sleep(max(1, min(Options.SHELL_IDLE_TIMEOUT / 10, 30)))
+            now = time.monotonic()
+            with ShellSession.sessions_lock:
+                idle = [s for s in ShellSession.sessions.values() if now - s.last_activity > Options.SHELL_IDLE_TIMEOUT]
+            for session in idle:
+                Terminal.debug(f"Closing idle shell | SID: {session.session_id}")
+                session.close("idle")
+
+    def __spawn(self, columns: int, rows: int):
+        with self.lock:
+            output_fd = self.__start_process(columns, rows)
+        threading.Thread(target=self.__pump, args=(output_fd, ), daemon=True).start()
+
+    def __start_process(self, columns: int, rows: int) -> int:
+        if os.name == "nt":
+            self.process = subprocess.Popen(ShellSession.shell(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            output_fd = self.process.stdout.fileno()
+        else:
+            master_fd, slave_fd = pty.openpty()
+            env = dict(os.environ, TERM=os.environ.get("TERM", "xterm-256color"))
+            try:
+                fcntl.ioctl(master_fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, columns, 0, 0))
+                # The shell gets its own session with the PTY as its controlling terminal, otherwise job control
+                # (and with it Ctrl+C and interactive shells) doesn't work. The preexec only does a single ioctl
+                self.process = subprocess.Popen([ShellSession.shell(), "-i"], stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, start_new_session=True, env=env,
+                                                preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0))
+            except Exception:
+                os.close(master_fd)
+                raise
+            finally:
+                os.close(slave_fd)
+            self.master_fd = output_fd = master_fd
+
+        return output_fd
+
+    def __pump(self, fd: int):
+        # Reading the PTY fails with EIO once the shell and everything it started are gone
+        try:
+            while chunk := os.read(fd, Options.COMMAND_CHUNK_SIZE):
+                self.last_activity = time.monotonic()
+                self.conn.send_event(Events.ShellOutput_Response, [self.session_id, chunk])
+        except OSError:
+            pass
+
+        code = self.process.wait()
+
+        # Unpublished first so no new input finds it, then the fd is closed before its number can be reused
+        with ShellSession.sessions_lock:
+            ShellSession.sessions.pop((self.conn, self.session_id), None)
+        with self.lock:
+            if self.master_fd >= 0: os.close(self.master_fd)
+            self.master_fd = -1
+
+        status = self.status or str(code)
+        self.conn.send_event(Events.ShellEnd_Response, [self.session_id, status])
+        Terminal.debug(f"Shell ended ({status}) | SID: {self.session_id}")
+
+    def write(self, data: bytes) -> bool:
+        # False when the shell isn't running (not spawned yet or already gone)
+        self.last_activity = time.monotonic()
+        view = memoryview(data)
+        # The lock only covers the checks, a shell that stops reading its input would otherwise block resize and close.
+        # Writing to a duplicate keeps the PTY open (and its fd number taken) even if the pump closes master_fd meanwhile
+        with self.lock:
+            if self.process is None: return False
+            if os.name == "nt":
+                stdin = self.process.stdin
+            else:
+                if self.master_fd < 0: return False
+                fd = os.dup(self.master_fd)
+
+        try:
+            if os.name == "nt":
+                stdin.write(view)
+                stdin.flush()
+                return True
+
+            while view:
+                view = view[os.write(fd, view):]
+            return True
+        except OSError:
+            return False
+        finally:
+            if os.name != "nt": os.close(fd)
+
+    def resize(self, columns: int, rows: int):
+        if os.name == "nt": return
+        with self.lock:
+            if self.master_fd < 0: return
+            fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, struct.pack("HHHH", rows, columns, 0, 0))
+
+    def close(self, status: str):
+        if self.process is None or self.process.poll() is not None: return
+        self.status = self.status or status
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(self.process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(self.process.pid, signal.SIGHUP)
+                try:
+                    self.process.wait(1)
+                except subprocess.TimeoutExpired:
+                    os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError as e:
+            Terminal.warning(f"Couldn't close shell: {e}")
+            self.process.kill()
@@ -0,0 +1,75 @@
+import os
+import struct
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from constants import DiffMask, Options
+from image_diff import decode_image_diff, encode_image_diff
+
+BLOCK = Options.IMAGE_DIFF_BLOCK_SIZE
+
+def mask_mode(data: bytes) -> DiffMask:
+    return DiffMask(struct.unpack_from(Options.IMAGE_DIFF_HEADER, data)[3])
+
+class ImageDiffRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_image(self, height: int, width: int) -> np.ndarray:
+        return self.rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+    def round_trip(self, prev: np.ndarray | None, img: np.ndarray) -> bytes:
+        data = encode_image_diff(prev, img)
+        decoded = decode_image_diff(prev, data)
+        self.assertEqual(decoded.shape, img.shape)
+        self.assertTrue(np.array_equal(decoded, img))
+        return data
+
+    def test_sizes_not_divisible_by_block(self):
+        for height, width in [(1, 1), (BLOCK - 1, BLOCK + 1), (BLOCK * 3 + 5, BLOCK * 2 + 7), (1080, 1920)]:
+            with self.subTest(size=(height, width)):
+                prev = self.random_image(height, width)
+                img = prev.copy()
+                img[height // 2:, :width // 2 + 1] = self.random_image(height - height // 2, width // 2 + 1)
+                self.round_trip(prev, img)
+
+    def test_without_previous_frame(self):
+        self.round_trip(None, self.random_image(BLOCK * 2 + 3, BLOCK + 9))
+        # Black pixels don't differ from the implicit black frame
+        self.round_trip(None, np.zeros((BLOCK + 1, BLOCK * 2, 3), dtype=np.uint8))
+
+    def test_no_pixels_changed(self):
+        prev = self.random_image(BLOCK * 4 + 1, BLOCK * 3 + 2)
+        data = self.round_trip(prev, prev.copy())
+        rows, columns = -(-prev.shape[0] // BLOCK), -(-prev.shape[1] // BLOCK)
+        # Header and an all zero block mask, nothing else
+        self.assertEqual(len(data), struct.calcsize(Options.IMAGE_DIFF_HEADER) + -(-rows * columns // 8))
+
+    def test_every_pixel_changed(self):
+        prev = self.random_image(BLOCK * 3 + 4, BLOCK * 5 + 6)
+        self.round_trip(prev, 255 - prev)
+
+    def test_noisy_changes_use_bitmap(self):
+        # Every other pixel changed, runs would cost far more than a bitmap
+        prev = self.random_image(BLOCK * 3 + 4, BLOCK * 5 + 6)
+        img = prev.copy()
+        img[::2, ::2] ^= 1
+        img[1::2, 1::2] ^= 1
+        data = self.round_trip(prev, img)
+        self.assertEqual(mask_mode(data), DiffMask.Bitmap)
+
+    def test_single_changed_channel_uses_runs(self):
+        prev = self.random_image(BLOCK * 4 + 3, BLOCK * 4 + 3)
+        for y, x, channel in [(0, 0, 0), (BLOCK + 3, BLOCK * 2 + 1, 1), (BLOCK * 4 + 2, BLOCK * 4 + 2, 2)]:
+            with self.subTest(pixel=(y, x, channel)):
+                img = prev.copy()
+                img[y, x, channel] ^= 0x80
+                data = self.round_trip(prev, img)
+                self.assertEqual(mask_mode(data), DiffMask.Runs)
+
+if __name__ == "__main__":
+    unittest.main()
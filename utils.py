@@ -1,42 +1,140 @@
 import struct
 import socket
+import asyncio
 import threading
-from typing import Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 
-from constants import DataType, Error, Options, Events
+from constants import DataType, Error, KeyExchange, Options, Events
 from encryption_manager import Encryption
+from compressor import MessageCompressor
 from terminal import Terminal
 import base64
 
 def byte_length(i):
     return (i.bit_length() + 7) // 8
 
+class FrameReader:
+    def __init__(self, s: socket.socket, size: int = Options.RECV_BUFFER_SIZE) -> None:
+        self.socket = s
+        self.size = size
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __fill(self, needed: int) -> bool:
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        pending = self.end - self.start
+        if len(self.buffer) > self.size and max(needed, pending) <= self.size:
+            # Back to the normal size once an oversized frame was consumed
+            buffer = bytearray(self.size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start = 0
+            self.end = pending
+
+        if self.start + needed > len(self.buffer):
+            if needed > len(self.buffer):
+                # Frames handed out earlier may still reference the old buffer, so grow into a new one instead of resizing
+                buffer = bytearray(max(needed, len(self.buffer) * 2, self.size))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+        while self.end - self.start < needed:
+            n = self.socket.recv_into(self.view[self.end:])
+            if n == 0: return False
+            self.end += n
+
+        return True
+
+    def read_frame(self) -> memoryview | None:
+        # The returned view points into the shared buffer and is only valid until the next call
+        if not self.__fill(Options.SIZE_OF_SIZE): return None
+        size = struct.unpack_from(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, self.buffer, self.start)[0]
+        self.start += Options.SIZE_OF_SIZE
+        if size > Options.MAX_FRAME_SIZE:
+            Terminal.error(f"Peer announced a {size} byte frame, the limit is {Options.MAX_FRAME_SIZE}")
+            return None
+
+        if not self.__fill(size): return None
+        frame = self.view[self.start:self.start+size]
+        self.start += size
+        return frame
+
 class Connection:
     def __init__(self, s: socket.socket, addr: tuple[str, int] | None) -> None:
         self.socket: socket.socket = s
         self.ip: str | None = addr[0] if addr is not None else None 
         self.port: int | None = addr[1] if addr is not None else None
         self.encryption_manager = Encryption()
-        
+        self.reader = FrameReader(s)
+        self.send_lock = threading.Lock()
+        self.compressor: MessageCompressor | None = None
+
     def initiate_key_switch(self):
         try:
-            private_k, public_k = self.encryption_manager.generate_rsa_keys()
-            public_bytes = public_k.dump_bytes()
-            self.send_event(Events.PublicKeyTransfer_Action, [public_bytes], encrypt=False)
+            ecdh = Options.KEY_EXCHANGE == KeyExchange.ECDH
+            if ecdh:
+                private_k, public_k = self.encryption_manager.generate_ecdh_keys()
+                self.send_event(Events.EphemeralKeyTransfer_Action, [public_k.dump_bytes()], encrypt=False)
+                expected = [Events.EphemeralKeyTransfer_Action.value.encode()]
+            else:
+                private_k, public_k = self.encryption_manager.generate_rsa_keys()
+                self.send_event(Events.PublicKeyTransfer_Action, [public_k.dump_bytes()], encrypt=False)
+                expected = [Events.SecretTransfer_Action.value.encode(), Events.SecretTransferSuites_Action.value.encode()]
 
             _, raw = self.recieve_parts(decrypt=False)
             parts = raw
-            if parts[0] == Events.SecretTransfer_Action.value.encode():
+            # RESM: [session ticket, client random], a rejected ticket falls back to a full handshake
+            if parts[0] == Events.ResumeSession_Action.value.encode():
+                if self.__resume_session(parts): return
+                _, parts = self.recieve_parts(decrypt=False)
+
+            # SECT: [secret] from clients that only know AES-EAX
+            # SECS: [offered suite ids (one byte each), secret], answered with the chosen suite in a CSEL
+            # EPKT: [offered suite ids, client's ephemeral public key], answered the same way
+            # Compression codec ids may be offered along with the suites, the chosen one follows the suite in the CSEL
+            if parts[0] in expected:
                 if len(parts) != 2:
                     self.send_failure(Error.FailureToSendKey, "Failed to complete end-to-end encryption", encrypt=False)
                     self.disconnect()
                     return
-                
-                secret_bytes = self.encryption_manager.rsa_decrypt(private_k, parts[1])
-                self.encryption_manager.set_sym_key(secret_bytes)
+
+                negotiate = parts[0] != Events.SecretTransfer_Action.value.encode()
+                offered, key_data = b"", parts[1]
+                if negotiate:
+                    offered, _, key_data = parts[1].partition(Options.SEPERATOR)
+
+                if ecdh:
+                    # Salted with both public keys (server's first) so the secret is bound to this exchange
+                    salt = public_k.dump_bytes() + key_data
+                    secret_bytes = self.encryption_manager.ecdh_derive_secret(private_k, key_data, salt)
+                else:
+                    secret_bytes = self.encryption_manager.rsa_decrypt(private_k, key_data)
+                suite = Encryption.choose_suite(offered, len(secret_bytes))
+                compressor = MessageCompressor.choose(offered)
+                if negotiate:
+                    selected = [suite.value] + ([compressor.codec.value] if compressor is not None else [])
+                    self.send_event(Events.CipherSuiteSelect_Action, [bytes(selected)], encrypt=False)
+
+                self.encryption_manager.set_sym_key(secret_bytes, suite)
+                self.compressor = compressor
+                Terminal.verbose(f"Using cipher suite {suite.name}")
+                if compressor is not None: Terminal.verbose(f"Using {compressor.codec.name} compression")
 
                 Terminal.verbose(f"Recieved secret: {'*'*len(secret_bytes)}")
                 self.send_success("Successfully established an end-to-end encryption channel!")
+                if negotiate: self.__issue_session_ticket()
             else:
                 self.send_failure(Error.FailureToSendKey, "Failed to complete end-to-end encryption (Wrong action)", encrypt=False)
                 self.disconnect()
@@ -45,6 +143,35 @@ class Connection:
             self.send_failure(Error.FailureToSendKey, f"Failed to complete end-to-end encryption: {e}", encrypt=False)
             self.disconnect()
 
+    def __resume_session(self, parts: list[bytes]) -> bool:
+        data = parts[1] if len(parts) == 2 else b""
+        ticket = data[:Options.SESSION_TICKET_SIZE]
+        client_random = data[Options.SESSION_TICKET_SIZE+1:]
+
+        session = None
+        if len(client_random) == Options.SESSION_RANDOM_SIZE:
+            session = Encryption.ticket_store.redeem(ticket)
+
+        if session is None:
+            self.send_failure(Error.InvalidSessionTicket, "Session ticket rejected, falling back to a full handshake", encrypt=False)
+            return False
+
+        resumption_secret, suite, codec = session
+        self.encryption_manager.set_sym_key(Encryption.derive_key(resumption_secret, client_random, b"session"), suite)
+        self.compressor = MessageCompressor(codec) if codec is not None else None
+        Terminal.verbose(f"Resumed session using cipher suite {suite.name}")
+
+        self.send_success("Successfully resumed the end-to-end encryption channel!")
+        self.__issue_session_ticket()
+        return True
+
+    def __issue_session_ticket(self):
+        # The client derives the same resumption secret from the session key and the ticket
+        if not Options.SESSION_TICKETS: return
+        codec = self.compressor.codec if self.compressor is not None else None
+        ticket = Encryption.ticket_store.issue(self.encryption_manager.sym_key, self.encryption_manager.suite, codec)
+        self.send_event(Events.SessionTicket_Response, [ticket, struct.pack('I', Options.SESSION_TICKET_LIFETIME)])
+
 
     def disconnect(self):
         try:
@@ -78,14 +205,106 @@ class Connection:
             return self.ip == other.ip and self.port == other.port
         return False
 
+# The *_async methods run on the event loop, the blocking ones are for handlers running in the executor
+class AsyncConnection(Connection):
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        super().__init__(writer.get_extra_info('socket'), writer.get_extra_info('peername'))
+        self.stream_reader = reader
+        self.stream_writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    async def recieve_parts_async(self, decrypt = True) -> tuple[list[bytes], list[bytes]] | None:
+        try:
+            size_bytes = await self.stream_reader.readexactly(Options.SIZE_OF_SIZE)
+            size = struct.unpack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, size_bytes)[0]
+            if size > Options.MAX_FRAME_SIZE:
+                Terminal.error(f"Peer announced a {size} byte frame, the limit is {Options.MAX_FRAME_SIZE}")
+                return None
+            data = await self.stream_reader.readexactly(size)
+        except (asyncio.IncompleteReadError, OSError):
+            return None
+
+        if decrypt:
+            data = self.encryption_manager.aes_net_decrypt(data)
+            if data is not None and self.compressor is not None:
+                data = self.compressor.decompress(data)
+            if data is None: return None
+
+        return NetworkUtils.split_parts(data)
+
+    async def write_async(self, buffers: list):
+        try:
+            self.stream_writer.writelines(buffers)
+            await self.stream_writer.drain()
+            return True
+        except (ConnectionError, OSError):
+            return False
+
+    async def send_async(self, parts, encrypt=True):
+        return await self.write_async(NetworkUtils.pack_frame(self, parts, encrypt=encrypt, reuse=False))
+
+    def send(self, parts, encrypt=True):
+        # Encrypt on the calling thread, only the write itself is handed to the loop.
+        # The transport may hold on to the buffers after drain, so they can't be reused
+        buffers = NetworkUtils.pack_frame(self, parts, encrypt=encrypt, reuse=False)
+        asyncio.run_coroutine_threadsafe(self.write_async(buffers), self.loop).result()
+
+    def recieve_parts(self, decrypt = True) -> tuple[list[bytes], list[bytes]] | None:
+        return asyncio.run_coroutine_threadsafe(self.recieve_parts_async(decrypt), self.loop).result()
+
+    def disconnect(self):
+        try:
+            self.loop.call_soon_threadsafe(self.stream_writer.close)
+        except RuntimeError:
+            pass
+
 class Event:
     @staticmethod
     def handle(data: list[bytes], conn: Connection):
         pass
 
+    @staticmethod
+    def transaction_id(data: list[bytes]) -> bytes | None:
+        # Events without a transaction id are handled in the order they arrived on the connection
+        return None
+
+class EventDispatcher:
+    def __init__(self, workers: int = Options.EVENT_WORKERS) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="event")
+        self.lock = threading.Lock()
+        self.lanes: dict[Any, deque] = {}
+
+    def submit(self, lane: Any, fn: Callable, *args, done: Callable | None = None):
+        # Jobs on the same lane run one after the other, different lanes run in parallel
+        with self.lock:
+            pending = self.lanes.get(lane)
+            if pending is not None:
+                pending.append((fn, args, done))
+                return
+            self.lanes[lane] = deque()
+
+        self.executor.submit(self.__run_lane, lane, fn, args, done)
+
+    def __run_lane(self, lane: Any, fn: Callable, args: tuple, done: Callable | None):
+        while True:
+            try:
+                fn(*args)
+            except Exception as e:
+                Terminal.error(f"Error occured while dispatching event: {e}")
+            finally:
+                if done is not None: done()
+
+            with self.lock:
+                pending = self.lanes[lane]
+                if not pending:
+                    del self.lanes[lane]
+                    return
+                fn, args, done = pending.popleft()
+
 class NetworkUtils:
     actions: dict[Events, tuple[type[Event], DataType]] = {}
     event_thread_status: dict[Connection, Any] = {}
+    dispatcher = EventDispatcher()
 
     @staticmethod
     def close(s: socket.socket):
@@ -98,21 +317,9 @@ class NetworkUtils:
         try:
             match client.socket.type:
                 case socket.SOCK_STREAM:
-                    size_bytes = b""
-                    for _ in range(Options.SIZE_OF_SIZE):
-                        b = client.socket.recv(1)
-                        if b == b"": return None
-                        size_bytes += b
-
-                    size = struct.unpack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, size_bytes)[0]
-
-                    data_bytes = b""
-                    for _ in range(size):
-                        b = client.socket.recv(1)
-                        if b == b"": return None
-                        data_bytes += b
-
-                    data = data_bytes
+                    frame = client.reader.read_frame()
+                    if frame is None: return None
+                    data = frame if decrypt else bytes(frame)
 
                 case socket.SOCK_DGRAM:
                     size_bytes, _ = client.socket.recvfrom(Options.SIZE_OF_SIZE)
@@ -127,29 +334,50 @@ class NetworkUtils:
 
         if not decrypt: return data
         decrypted = client.encryption_manager.aes_net_decrypt(data)
+        if decrypted is not None and client.compressor is not None:
+            return client.compressor.decompress(decrypted)
         return decrypted
 
+    @staticmethod
+    def split_parts(raw_data: bytes) -> tuple[list[bytes], list[bytes]]:
+        sep_parts = raw_data.split(Options.SEPERATOR)
+        raw_parts = raw_data.split(Options.SEPERATOR, 1)
+
+        return (sep_parts, raw_parts)
+
     @staticmethod
     def recieve_parts(client: Connection, decrypt = True) -> tuple[list[bytes], list[bytes]] | None:
         raw_data = NetworkUtils.__recieve_raw(client, decrypt)
         if raw_data is None: return None
 
-        sep_parts = raw_data.split(Options.SEPERATOR)
-        raw_parts = raw_data.split(Options.SEPERATOR, 1)
+        return NetworkUtils.split_parts(raw_data)
 
-        return (sep_parts, raw_parts)
+    @staticmethod
+    def __sendmsg_all(s: socket.socket, buffers: list):
+        if not hasattr(s, "sendmsg"):
+            s.sendall(b''.join(buffers))
+            return
+
+        views = [memoryview(b) for b in buffers]
+        while views:
+            sent = s.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if sent:
+                views[0] = views[0][sent:]
 
     @staticmethod
-    def __send_raw(client: Connection, bts: bytes):
+    def __send_raw(client: Connection, buffers: list):
         try:
-            length_b = struct.pack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, len(bts))
             match client.socket.type:
                 case socket.SOCK_STREAM:
-                    client.socket.sendall(length_b+bts)
+                    with client.send_lock:
+                        NetworkUtils.__sendmsg_all(client.socket, buffers)
                     return True
                 case socket.SOCK_DGRAM:
-                    client.socket.sendto(length_b, (client.ip, client.port))
-                    client.socket.sendto(bts,(client.ip, client.port))
+                    client.socket.sendto(buffers[0], (client.ip, client.port))
+                    client.socket.sendto(b''.join(buffers[1:]),(client.ip, client.port))
                     return True
 
             return False
@@ -157,15 +385,32 @@ class NetworkUtils:
             return False
 
     @staticmethod
-    def send_parts(client: Connection, parts: list, add_sep = True, encrypt = True):
+    def encode_parts(parts: list, add_sep = True) -> list:
         encoded_parts = [b if type(b) != str else b.encode() for b in parts]
         encoded_parts = [b if type(b) != int else int.to_bytes(b, byte_length(b)) for b in encoded_parts]
-        bts = (Options.SEPERATOR if add_sep else b'').join(encoded_parts)
+        if not add_sep or len(encoded_parts) < 2: return encoded_parts
+
+        with_sep = [Options.SEPERATOR] * (len(encoded_parts) * 2 - 1)
+        with_sep[::2] = encoded_parts
+        return with_sep
+
+    @staticmethod
+    def pack_frame(client: Connection, parts: list, add_sep = True, encrypt = True, reuse = True) -> list:
+        # Builds [length, *payload buffers] without joining, the payload is only copied by the cipher
+        buffers = NetworkUtils.encode_parts(parts, add_sep)
 
         if encrypt:
-            bts = client.encryption_manager.aes_net_encrypt(bts)
+            if client.compressor is not None:
+                buffers = client.compressor.compress_parts(buffers)
+            buffers = client.encryption_manager.aes_net_encrypt_parts(buffers, reuse)
 
-        return NetworkUtils.__send_raw(client, bts)
+        size = sum(len(b) for b in buffers)
+        return [struct.pack(Options.SIZE_OF_SIZE_ENCODING_PROTOCOL, size), *buffers]
+
+    @staticmethod
+    def send_parts(client: Connection, parts: list, add_sep = True, encrypt = True):
+        buffers = NetworkUtils.pack_frame(client, parts, add_sep, encrypt)
+        return NetworkUtils.__send_raw(client, buffers)
 
     @staticmethod
     def add_listener(event_id: Events, event: type[Event], data_type: DataType = DataType.Part):
@@ -191,23 +436,43 @@ class NetworkUtils:
             Terminal.error(f"Error occured while handling event {event_id}|{data_type}: {e}")
 
     @staticmethod
-    def listen_for_events(client: Connection):
-        def thread():
-            while NetworkUtils.event_thread_status[client]:
+    def __transaction_id(event_id: Events, data: list[Any], raw_data: list[bytes]) -> bytes | None:
+        event = NetworkUtils.actions.get(event_id)
+        if event is None: return None
 
-                parts = client.recieve_parts()
-                if parts == None:
-                    NetworkUtils.__callback_event(Events.ConnectionClosed, [], [] ,client)
-                    continue
+        event, data_type = event
+        try:
+            return event.transaction_id(raw_data if data_type == DataType.Raw else data)
+        except Exception:
+            return None
 
-                if len(parts) == 0: continue
+    @staticmethod
+    def dispatch_event(client: Connection, parts: tuple[list[bytes], list[bytes]] | None, done: Callable | None = None):
+        # Runs the handler on the dispatcher's pool, done is called once it finished
+        if parts == None:
+            event_id, data, raw_data = Events.ConnectionClosed, [], []
+        elif len(parts) == 0:
+            if done is not None: done()
+            return
+        else:
+            sep_parts, raw_parts = parts
 
-                sep_parts, raw_parts = parts
+            event_id_str: str = sep_parts[0].decode()
+            event_id: Events = Events.from_val(event_id_str)
+            data, raw_data = sep_parts[1:], raw_parts[1:]
 
-                event_id_str: str = sep_parts[0].decode()
-                event_id: Events = Events.from_val(event_id_str)
+        lane = (client, NetworkUtils.__transaction_id(event_id, data, raw_data))
+        NetworkUtils.dispatcher.submit(lane, NetworkUtils.__callback_event, event_id, data, raw_data, client, done=done)
 
-                NetworkUtils.__callback_event(event_id, sep_parts[1:], raw_parts[1:], client)
+    @staticmethod
+    def listen_for_events(client: Connection):
+        def thread():
+            slots = threading.BoundedSemaphore(Options.MAX_EVENTS_PER_CONNECTION)
+            while NetworkUtils.event_thread_status[client]:
+                parts = client.recieve_parts()
+                slots.acquire()
+                NetworkUtils.dispatch_event(client, parts, done=slots.release)
+                if parts is None: break
 
         NetworkUtils.event_thread_status[client] = True
         t = threading.Thread(target=thread, daemon=True)